@@ -0,0 +1,566 @@
+import datetime
+import hashlib
+import random
+import re
+import struct
+from decimal import Decimal
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+CLIENT_ANON_BLOCK_SIZE = 1024 * 1024  # size of block of whole tuples, which is sent to process pool
+
+COPY_BINARY_HEADER_SIZE = 19  # signature, flags and length of header extension
+INT4_STRUCT = struct.Struct("!i")  # length of field in COPY BINARY tuple
+
+TEXT_TYPES = {"text", "varchar", "bpchar", "name", "citext"}
+INT_TYPES = {"int2": ("!h", -2 ** 15, 2 ** 15 - 1), "int4": ("!i", -2 ** 31, 2 ** 31 - 1), "int8": ("!q", -2 ** 63, 2 ** 63 - 1)}
+FLOAT_TYPES = {"float4": "!f", "float8": "!d"}
+NUMBER_TYPES = {*INT_TYPES, *FLOAT_TYPES, "numeric"}
+DATETIME_TYPES = {"date", "timestamp", "timestamptz"}
+
+DIGEST_ALGORITHMS = {"md5", "sha1", "sha224", "sha256", "sha384", "sha512"}
+
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+PG_DAYS_PER_MONTH = 30  # used by PostgreSQL for fractional months of interval
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+
+# Parameters of functions: "text" - field or string literal, "int" / "float" - number literal,
+# "interval" / "timestamp" / "array" - literals, "number" / "datetime" - field only.
+# Result "same" means the type of field
+CLIENT_FUNCS = {
+    "digest": (("text", "text", "text"), "text"),
+    "partial": (("text", "int", "text", "int"), "text"),
+    "partial_email": (("text",), "text"),
+    "noise": (("number", "float"), "same"),
+    "dnoise": (("datetime", "interval"), "same"),
+    "random_string": (("int",), "text"),
+    "random_zip": ((), "text"),
+    "random_inn": ((), "text"),
+    "random_int_between": (("int", "int"), "int"),
+    "random_bigint_between": (("int", "int"), "int"),
+    "random_phone": (("text",), "text"),
+    "random_hash": (("text", "text"), "text"),
+    "random_date": ((), "timestamptz"),
+    "random_date_between": (("timestamp", "timestamp"), "timestamptz"),
+    "random_in": (("array",), "text"),
+}
+
+RULE_RE = re.compile(r"^\s*anon_funcs\.(\w+)\s*\((.*)\)\s*$", re.S)
+CAST_RE = re.compile(r"::\s*\w+(\s+with(out)?\s+time\s+zone)?\s*$", re.I)
+INTERVAL_UNITS = {
+    "year": (12, 0, 0), "years": (12, 0, 0), "y": (12, 0, 0),
+    "mon": (1, 0, 0), "mons": (1, 0, 0), "month": (1, 0, 0), "months": (1, 0, 0),
+    "week": (0, 7, 0), "weeks": (0, 7, 0), "w": (0, 7, 0),
+    "day": (0, 1, 0), "days": (0, 1, 0), "d": (0, 1, 0),
+    "hour": (0, 0, 3600 * 10 ** 6), "hours": (0, 0, 3600 * 10 ** 6), "h": (0, 0, 3600 * 10 ** 6),
+    "minute": (0, 0, 60 * 10 ** 6), "minutes": (0, 0, 60 * 10 ** 6), "min": (0, 0, 60 * 10 ** 6),
+    "mins": (0, 0, 60 * 10 ** 6),
+    "second": (0, 0, 10 ** 6), "seconds": (0, 0, 10 ** 6), "sec": (0, 0, 10 ** 6), "secs": (0, 0, 10 ** 6),
+}
+
+
+class ClientRule(NamedTuple):
+    func: str
+    args: Tuple  # arguments of function, the field value is passed instead of None at value_index
+    value_index: Optional[int]
+    udt_name: str  # type of field in COPY stream
+
+
+class KeepOriginal(Exception):
+    """
+    Value can't be changed by client-side function, e.g. infinity date, so it is written as is
+    """
+
+
+def _split_args(args: str) -> List[str]:
+    result = []
+    current = ""
+    in_quotes = False
+    depth = 0
+    for char in args:
+        if char == "'":
+            in_quotes = not in_quotes
+        elif not in_quotes and char in "([":
+            depth += 1
+        elif not in_quotes and char in ")]":
+            depth -= 1
+            if depth < 0:
+                raise ValueError("Unbalanced brackets")
+        elif not in_quotes and depth == 0 and char == ",":
+            result.append(current.strip())
+            current = ""
+            continue
+        current += char
+    if in_quotes or depth != 0:
+        raise ValueError("Unbalanced quotes or brackets")
+    if current.strip():
+        result.append(current.strip())
+    return result
+
+
+def _parse_string_literal(arg: str) -> str:
+    arg = CAST_RE.sub("", arg).strip()
+    if len(arg) < 2 or arg[0] != "'" or arg[-1] != "'" or "'" in arg[1:-1].replace("''", ""):
+        raise ValueError(f"Not a string literal: {arg}")
+    return arg[1:-1].replace("''", "'")
+
+
+def _parse_interval(arg: str) -> Tuple[int, int, int]:
+    """
+    Parse interval literal like interval '1 month' or '2 days 3 hours'::interval
+    :return: months, days and microseconds of interval
+    """
+    arg = re.sub(r"^interval\s+", "", arg.strip(), flags=re.I)
+    tokens = _parse_string_literal(arg).lower().split()
+    if not tokens or len(tokens) % 2:
+        raise ValueError(f"Not supported interval: {arg}")
+    months, days, microseconds = 0, 0, 0
+    for amount, unit in zip(tokens[::2], tokens[1::2]):
+        unit_months, unit_days, unit_microseconds = INTERVAL_UNITS[unit]
+        amount = float(amount)
+        months += amount * unit_months
+        days += amount * unit_days
+        microseconds += amount * unit_microseconds
+    if months != int(months) or days != int(days):
+        raise ValueError(f"Not supported interval: {arg}")
+    return int(months), int(days), int(microseconds)
+
+
+def _parse_timestamp(arg: str) -> datetime.datetime:
+    value = datetime.datetime.fromisoformat(_parse_string_literal(arg))
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _parse_column(arg: str, column_name: str) -> bool:
+    arg = re.sub(r"::\s*text\s*$", "", arg, flags=re.I).strip()
+    if arg.startswith('"') and arg.endswith('"'):
+        return arg[1:-1].replace('""', '"') == column_name
+    return arg.lower() == column_name
+
+
+def compile_client_rule(rule: str, column_name: str, udt_name: str) -> Optional[ClientRule]:
+    """
+    Compile rule of field into Python equivalent of anon_funcs function
+    :param rule: rule of field from dictionary, e.g. anon_funcs.digest("email", 'salt', 'md5')
+    :param column_name: name of field
+    :param udt_name: type of field
+    :return: rule for anonymize_tuples(), or None if the rule must be evaluated by database
+    """
+    match = RULE_RE.match(rule)
+    if match is None or match.group(1) not in CLIENT_FUNCS:
+        return None
+
+    func = match.group(1)
+    params, result = CLIENT_FUNCS[func]
+    try:
+        args = _split_args(match.group(2))
+    except ValueError:
+        return None
+    if func == "random_phone" and not args:
+        args = ["'0'"]
+    if len(args) != len(params):
+        return None
+
+    parsed_args = []
+    value_index = None
+    for index, (param, arg) in enumerate(zip(params, args)):
+        try:
+            if param in ("text", "number", "datetime") and _parse_column(arg, column_name):
+                if ((param == "text" and udt_name not in TEXT_TYPES and udt_name not in INT_TYPES)
+                        or (param == "number" and udt_name not in NUMBER_TYPES)
+                        or (param == "datetime" and udt_name not in DATETIME_TYPES)):
+                    return None
+                value_index = index
+                parsed_args.append(None)
+            elif param == "text":
+                parsed_args.append(_parse_string_literal(arg))
+            elif param == "int":
+                parsed_args.append(int(CAST_RE.sub("", arg)))
+            elif param == "float":
+                parsed_args.append(float(CAST_RE.sub("", arg)))
+            elif param == "interval":
+                parsed_args.append(_parse_interval(arg))
+            elif param == "timestamp":
+                parsed_args.append(_parse_timestamp(arg))
+            elif param == "array":
+                items = re.match(r"^array\s*\[(.*)\]$", CAST_RE.sub("", arg).strip(), re.I | re.S)
+                parsed_args.append(tuple(_parse_string_literal(v) for v in _split_args(items.group(1))))
+            else:
+                # function of field, which references another field
+                return None
+        except (ValueError, KeyError, AttributeError):
+            return None
+
+    if func in ("digest", "random_hash") and parsed_args[-1] not in DIGEST_ALGORITHMS:
+        return None
+    if ((result == "text" and udt_name not in TEXT_TYPES)
+            or (result == "int" and udt_name not in INT_TYPES and udt_name not in TEXT_TYPES)
+            or (result == "timestamptz" and udt_name not in DATETIME_TYPES)):
+        return None
+
+    return ClientRule(func=func, args=tuple(parsed_args), value_index=value_index, udt_name=udt_name)
+
+
+def _decode_numeric(data: bytes) -> Decimal:
+    ndigits, weight, sign, dscale = struct.unpack_from("!hhHH", data)
+    if sign not in (NUMERIC_POS, NUMERIC_NEG):
+        raise KeepOriginal()  # NaN and infinity
+    digits = "".join("%04d" % v for v in struct.unpack_from(f"!{ndigits}H", data, 8)) or "0"
+    exponent = (weight - ndigits + 1) * 4 if ndigits else -dscale
+    return Decimal((1 if sign == NUMERIC_NEG else 0, tuple(int(v) for v in digits), exponent))
+
+
+def _encode_numeric(value: Decimal) -> bytes:
+    sign, digits, exponent = value.as_tuple()
+    dscale = max(0, -exponent)
+    digits = "".join(str(v) for v in digits)
+    # digits are aligned to groups of base 10000
+    pad = exponent % 4
+    digits += "0" * pad
+    exponent -= pad
+    digits = "0" * (-len(digits) % 4) + digits
+    groups = [int(digits[i:i + 4]) for i in range(0, len(digits), 4)]
+    weight = len(groups) - 1 + exponent // 4
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return struct.pack(
+        f"!hhHH{len(groups)}H", len(groups), weight, NUMERIC_NEG if sign else NUMERIC_POS, dscale, *groups
+    )
+
+
+def decode_value(udt_name: str, data: bytes):
+    """
+    Decode value of field from PostgreSQL binary format
+    """
+    if udt_name in TEXT_TYPES:
+        return data.decode("utf-8")
+    if udt_name in INT_TYPES:
+        return struct.unpack(INT_TYPES[udt_name][0], data)[0]
+    if udt_name in FLOAT_TYPES:
+        return struct.unpack(FLOAT_TYPES[udt_name], data)[0]
+    if udt_name == "numeric":
+        return _decode_numeric(data)
+    if udt_name == "date":
+        days = struct.unpack("!i", data)[0]
+        if days in (-2 ** 31, 2 ** 31 - 1):
+            raise KeepOriginal()  # -infinity and infinity
+        try:
+            return PG_EPOCH + datetime.timedelta(days=days)
+        except OverflowError:
+            raise KeepOriginal()
+    if udt_name in ("timestamp", "timestamptz"):
+        microseconds = struct.unpack("!q", data)[0]
+        if microseconds in (-2 ** 63, 2 ** 63 - 1):
+            raise KeepOriginal()
+        try:
+            return PG_EPOCH + datetime.timedelta(microseconds=microseconds)
+        except OverflowError:
+            raise KeepOriginal()
+    raise ValueError(f"Not supported type {udt_name}")
+
+
+def encode_value(udt_name: str, value) -> bytes:
+    """
+    Encode value of field into PostgreSQL binary format, the same conversion as cast of function result to field type
+    """
+    if udt_name in TEXT_TYPES:
+        return str(value).encode("utf-8")
+    if udt_name in INT_TYPES:
+        struct_format, min_value, max_value = INT_TYPES[udt_name]
+        value = round(value)
+        if not min_value <= value <= max_value:
+            raise OverflowError(f"{value} is out of range for type {udt_name}")
+        return struct.pack(struct_format, value)
+    if udt_name in FLOAT_TYPES:
+        return struct.pack(FLOAT_TYPES[udt_name], value)
+    if udt_name == "numeric":
+        # float is converted to numeric with 15 significant digits, as in PostgreSQL
+        return _encode_numeric(Decimal("%.15g" % value) if isinstance(value, float) else Decimal(value))
+    if udt_name == "date":
+        return struct.pack("!i", (value - PG_EPOCH).days)
+    if udt_name in ("timestamp", "timestamptz"):
+        delta = value - PG_EPOCH
+        return struct.pack("!q", (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds)
+    raise ValueError(f"Not supported type {udt_name}")
+
+
+def _sql_substring(value: str, start: int, count: int) -> str:
+    if count < 0:
+        raise ValueError("negative substring length not allowed")
+    end = start + count
+    start = max(start, 1)
+    return value[start - 1:end - 1] if end > start else ""
+
+
+def _sql_right(value: str, count: int) -> str:
+    # negative count means all characters except the first ones, as in PostgreSQL
+    return value[-count:] if count != 0 else ""
+
+
+def _add_months(value: datetime.datetime, months: int) -> datetime.datetime:
+    month_index = value.year * 12 + value.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    next_month = datetime.date(year + (month == 12), month % 12 + 1, 1)
+    last_day = (next_month - datetime.timedelta(days=1)).day
+    return value.replace(year=year, month=month, day=min(value.day, last_day))
+
+
+def _add_interval(value: datetime.datetime, interval: Tuple[int, int, int], factor: float) -> datetime.datetime:
+    """
+    Add interval multiplied by factor, fractional months and days are spilled down as by PostgreSQL
+    """
+    months, days, microseconds = interval
+    result_months = months * factor
+    result_days = days * factor + (result_months - int(result_months)) * PG_DAYS_PER_MONTH
+    result_microseconds = microseconds * factor + (result_days - int(result_days)) * 86400 * 10 ** 6
+    value = _add_months(value, int(result_months))
+    return value + datetime.timedelta(days=int(result_days), microseconds=round(result_microseconds))
+
+
+def _random_chars(rnd: random.Random, chars: str, length: int) -> str:
+    return "".join(chars[round(rnd.random() * (len(chars) - 1) + 1) - 1] for _ in range(length))
+
+
+def _digest(seed: str, salt: str, algorithm: str) -> str:
+    return hashlib.new(algorithm, (seed + salt).encode("utf-8")).hexdigest()
+
+
+def _random_int_between(rnd: random.Random, start: int, stop: int) -> int:
+    return round(rnd.random() * (stop - start) + start)
+
+
+def call_client_func(rule: ClientRule, value, rnd: random.Random):
+    """
+    Call Python equivalent of anon_funcs function
+    :param rule: compiled rule of field
+    :param value: decoded value of field
+    :param rnd: random generator
+    :return: result of function, or None for NULL
+    """
+    args = list(rule.args)
+    if rule.value_index is not None:
+        if value is None:
+            return None
+        args[rule.value_index] = str(value) if CLIENT_FUNCS[rule.func][0][rule.value_index] == "text" else value
+
+    func = rule.func
+    if func == "digest":
+        return _digest(*args)
+    if func == "partial":
+        ov, prefix, padding, suffix = args
+        return _sql_substring(ov, 1, prefix) + padding + _sql_substring(ov, len(ov) - suffix + 1, suffix)
+    if func == "partial_email":
+        ov = args[0]
+        dot_position = ov[::-1].find(".") + 1
+        return (
+            _sql_substring(ov, 1, 2) + "******" + "@"
+            + _sql_substring(ov, ov.find("@") + 2, dot_position - 2)
+            + "******" + "." + _sql_right(ov, dot_position - 1)
+        )
+    if func == "noise":
+        noise_value, ratio = args
+        ran = (2.0 * rnd.random() - 1.0) * ratio
+        try:
+            return encode_value(rule.udt_name, float(noise_value) * (1.0 - ran))
+        except OverflowError:
+            return encode_value(rule.udt_name, float(noise_value) * (1.0 + ran))
+    if func == "dnoise":
+        noise_value, noise_range = args
+        factor = 2.0 * rnd.random() - 1.0
+        try:
+            return _add_interval(noise_value, noise_range, factor)
+        except (OverflowError, ValueError):
+            return _add_interval(noise_value, noise_range, -factor)
+    if func == "random_string":
+        return _random_chars(rnd, "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", args[0])
+    if func == "random_zip":
+        return _random_chars(rnd, "0123456789", 6)
+    if func == "random_inn":
+        return _random_chars(rnd, "0123456789", 8)
+    if func in ("random_int_between", "random_bigint_between"):
+        return _random_int_between(rnd, *args)
+    if func == "random_phone":
+        return args[0] + str(_random_int_between(rnd, 100000000, 999999999))
+    if func == "random_hash":
+        return _digest(args[0], _random_chars(rnd, "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", 6), args[1])
+    if func == "random_date":
+        return _random_date_between(
+            rnd,
+            datetime.datetime(1900, 1, 1),
+            datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None),
+        )
+    if func == "random_date_between":
+        return _random_date_between(rnd, *args)
+    if func == "random_in":
+        return rnd.choice(args[0])
+    raise ValueError(f"Not supported function {func}")
+
+
+def _random_date_between(rnd: random.Random, date_start: datetime.datetime, date_end: datetime.datetime):
+    return date_start + (date_end - date_start) * rnd.random()
+
+
+def anonymize_value(rule: ClientRule, data: Optional[bytes], rnd: random.Random) -> Optional[bytes]:
+    """
+    Anonymize value of field in binary format
+    :param rule: compiled rule of field
+    :param data: value in binary format, None for NULL
+    :param rnd: random generator
+    :return: anonymized value in binary format, None for NULL
+    """
+    try:
+        value = decode_value(rule.udt_name, data) if data is not None else None
+        result = call_client_func(rule, value, rnd)
+    except KeepOriginal:
+        return data
+    if result is None or isinstance(result, bytes):
+        return result
+    if rule.udt_name == "date" and isinstance(result, datetime.datetime):
+        # timestamp is truncated by cast to date
+        result = datetime.datetime.combine(result.date(), datetime.time())
+    return encode_value(rule.udt_name, result)
+
+
+_random = random.Random()
+
+
+def anonymize_tuples(rules: Dict[int, ClientRule], data: bytes) -> bytes:
+    """
+    Anonymize block of whole tuples of COPY BINARY stream, it is called in process pool
+    :param rules: compiled rules with key by index of field in tuple
+    :param data: tuples in COPY BINARY format without header and trailer
+    :return: tuples with anonymized fields in the same format
+    """
+    result = bytearray()
+    pos = 0
+    while pos < len(data):
+        fields_count = struct.unpack_from("!h", data, pos)[0]
+        result += data[pos:pos + 2]
+        pos += 2
+        for index in range(fields_count):
+            length = struct.unpack_from("!i", data, pos)[0]
+            end = pos + 4 + max(length, 0)
+            rule = rules.get(index)
+            if rule is None:
+                result += data[pos:end]
+            else:
+                value = anonymize_value(rule, data[pos + 4:end] if length >= 0 else None, _random)
+                if value is None:
+                    result += struct.pack("!i", -1)
+                else:
+                    result += struct.pack("!i", len(value)) + value
+            pos = end
+    return bytes(result)
+
+
+def split_tuples(data: bytes, fields_counts: List[int]) -> List[bytes]:
+    """
+    Split block of whole tuples of COPY BINARY stream by fields, e.g. tuples of the query with fields of all
+    profiles of dump into tuples of each profile
+    :param data: tuples in COPY BINARY format without header and trailer
+    :param fields_counts: amount of consecutive fields of each part of tuple
+    :return: tuples of each part in the same format
+    """
+    # it is the hot loop of dump with several profiles, so lookups are made once and fields are copied by memoryview
+    unpack_length = INT4_STRUCT.unpack_from
+    view = memoryview(data)
+    results = [bytearray() for _ in fields_counts]
+    parts = [
+        (result, struct.pack("!h", fields_count), range(fields_count))
+        for result, fields_count in zip(results, fields_counts)
+    ]
+    pos = 0
+    size = len(data)
+    while pos < size:
+        pos += 2
+        for result, fields_count_data, fields in parts:
+            start = pos
+            for _ in fields:
+                length = unpack_length(data, pos)[0]
+                pos += 4 + length if length > 0 else 4
+            result += fields_count_data
+            result += view[start:pos]
+    return [bytes(result) for result in results]
+
+
+class CopyBinarySplitter:
+    """
+    Splitter of COPY BINARY stream into header, blocks of whole tuples and trailer,
+    so blocks can be anonymized independently of the chunks of the stream
+    """
+
+    def __init__(self, block_size: int = CLIENT_ANON_BLOCK_SIZE):
+        self._buffer = bytearray()
+        self._header_done = False
+        self._scanned = 0  # end of the last whole tuple in the buffer
+        self._block_size = block_size
+
+    def feed(self, chunk: bytes) -> List[Tuple[bytes, bool]]:
+        """
+        :param chunk: next chunk of COPY BINARY stream
+        :return: list of (data, True if data is block of tuples)
+        """
+        self._buffer += chunk
+        result = []
+        buffer = self._buffer
+
+        if not self._header_done:
+            if len(buffer) < COPY_BINARY_HEADER_SIZE:
+                return result
+            header_size = COPY_BINARY_HEADER_SIZE + struct.unpack_from("!i", buffer, 15)[0]
+            if len(buffer) < header_size:
+                return result
+            result.append((bytes(buffer[:header_size]), False))
+            del buffer[:header_size]
+            self._header_done = True
+
+        pos = self._scanned
+        while pos + 2 <= len(buffer):
+            fields_count = struct.unpack_from("!h", buffer, pos)[0]
+            if fields_count == -1:
+                # trailer of the stream
+                if pos:
+                    result.append((bytes(buffer[:pos]), True))
+                result.append((bytes(buffer[pos:]), False))
+                buffer.clear()
+                pos = 0
+                break
+
+            end = pos + 2
+            for _ in range(fields_count):
+                if end + 4 > len(buffer):
+                    end = None
+                    break
+                end += 4 + max(struct.unpack_from("!i", buffer, end)[0], 0)
+                if end > len(buffer):
+                    end = None
+                    break
+            if end is None:
+                break
+
+            pos = end
+            if pos >= self._block_size:
+                result.append((bytes(buffer[:pos]), True))
+                del buffer[:pos]
+                pos = 0
+
+        self._scanned = pos
+        return result
+
+    def finish(self) -> List[Tuple[bytes, bool]]:
+        result = []
+        if self._scanned:
+            result.append((bytes(self._buffer[:self._scanned]), True))
+        if len(self._buffer) > self._scanned:
+            result.append((bytes(self._buffer[self._scanned:]), False))
+        self._buffer.clear()
+        self._scanned = 0
+        return result
@@ -0,0 +1,267 @@
+import gzip
+import hashlib
+import io
+from typing import BinaryIO, Optional, Tuple
+
+from pg_anon.common.enums import OutputCodec
+
+CODEC_FILE_EXTENSIONS = {
+    OutputCodec.GZIP: ".bin.gz",
+    OutputCodec.ZSTD: ".bin.zst",
+    OutputCodec.LZ4: ".bin.lz4",
+    OutputCodec.NONE: ".bin",
+}
+
+CODEC_DEFAULT_LEVELS = {
+    OutputCodec.GZIP: 9,  # same as gzip.open() default
+    OutputCodec.ZSTD: 3,
+    OutputCodec.LZ4: 0,
+    OutputCodec.NONE: None,
+}
+
+CODEC_LEVELS_RANGE = {
+    OutputCodec.GZIP: (0, 9),
+    OutputCodec.ZSTD: (1, 22),
+    OutputCodec.LZ4: (0, 16),
+}
+
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Codec "zstd" requires "zstandard" package. Install it by: pip install zstandard')
+    return zstandard
+
+
+def _import_lz4_frame():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImportError('Codec "lz4" requires "lz4" package. Install it by: pip install lz4')
+    return lz4.frame
+
+
+def get_codec_file_extension(codec: OutputCodec) -> str:
+    return CODEC_FILE_EXTENSIONS[codec]
+
+
+def get_codec_level(codec: OutputCodec, level: Optional[int] = None) -> Optional[int]:
+    """
+    Get compression level for codec and check it
+    :param codec: output codec
+    :param level: level from arguments, if it is None, then default level of codec will be returned
+    :return: compression level or None for codec without compression
+    """
+    if codec == OutputCodec.NONE:
+        return None
+
+    if level is None:
+        return CODEC_DEFAULT_LEVELS[codec]
+
+    min_level, max_level = CODEC_LEVELS_RANGE[codec]
+    if not min_level <= level <= max_level:
+        raise ValueError(
+            f'Compression level of codec "{codec.value}" must be in range [{min_level}, {max_level}], got {level}'
+        )
+    return level
+
+
+def check_codec_available(codec: OutputCodec):
+    if codec == OutputCodec.ZSTD:
+        _import_zstandard()
+    elif codec == OutputCodec.LZ4:
+        _import_lz4_frame()
+
+
+class _NonClosingWriter(io.RawIOBase):
+    """
+    Writer into shared file object, which is flushed but not closed by close()
+    """
+
+    def __init__(self, fileobj: BinaryIO):
+        super().__init__()
+        self._fileobj = fileobj
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        return self._fileobj.write(data)
+
+    def close(self):
+        if not self.closed:
+            self._fileobj.flush()
+        super().close()
+
+
+class ChecksumWriter(io.RawIOBase):
+    """
+    Writer, which calculates sha256 checksum and size of the data written through it into the file object
+    """
+
+    def __init__(self, fileobj: BinaryIO, closefd: bool = True):
+        super().__init__()
+        self._fileobj = fileobj
+        self._closefd = closefd
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        written = self._fileobj.write(data)
+        self._hash.update(memoryview(data)[:written])
+        self.size += written
+        return written
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def close(self):
+        if not self.closed:
+            if self._closefd:
+                self._fileobj.close()
+            else:
+                self._fileobj.flush()
+        super().close()
+
+
+class SegmentReader(io.RawIOBase):
+    """
+    Reader of the part of file with [offset, offset + length) range, e.g. table stream in archive segment
+    """
+
+    def __init__(self, path: str, offset: int, length: int):
+        super().__init__()
+        self._file = open(path, "rb")
+        self._file.seek(offset)
+        self._remaining = length
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        read_size = self._file.readinto(memoryview(buffer)[:size])
+        self._remaining -= read_size
+        return read_size
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+class _CloseSourceReader:
+    """
+    Decompressing reader, which closes its source file object too
+    """
+
+    def __init__(self, reader, source: BinaryIO):
+        self._reader = reader
+        self._source = source
+
+    def read(self, size: int = -1) -> bytes:
+        return self._reader.read(size)
+
+    def close(self):
+        self._reader.close()
+        self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_codec_writer(
+    path: Optional[str],
+    codec: OutputCodec,
+    level: Optional[int] = None,
+    fileobj: Optional[BinaryIO] = None,
+):
+    """
+    Open file for writing with compression by codec
+    :param path: output file path, it is not used if fileobj is specified
+    :param codec: output codec
+    :param level: compression level, if it is None, then default level of codec will be used
+    :param fileobj: already opened binary file, e.g. archive segment, compressed stream is written from its
+                    current position and the file is not closed by close() of returned object
+    :return: binary file-like object with write() and close() methods
+    """
+    level = get_codec_level(codec, level)
+
+    if codec == OutputCodec.GZIP:
+        if fileobj is not None:
+            return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level)
+        return gzip.open(path, "wb", compresslevel=level)
+
+    if codec == OutputCodec.ZSTD:
+        zstandard = _import_zstandard()
+        if fileobj is not None:
+            return zstandard.ZstdCompressor(level=level).stream_writer(fileobj, closefd=False)
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(path, "wb"), closefd=True)
+
+    if codec == OutputCodec.LZ4:
+        lz4_frame = _import_lz4_frame()
+        # LZ4FrameFile does not close file object passed to it
+        return lz4_frame.open(fileobj if fileobj is not None else path, "wb", compression_level=level)
+
+    if fileobj is not None:
+        return _NonClosingWriter(fileobj)
+    return open(path, "wb")
+
+
+def open_codec_reader(path: str, codec: OutputCodec, offset: Optional[int] = None, length: Optional[int] = None):
+    """
+    Open compressed by codec file for reading
+    :param path: input file path
+    :param codec: codec which was used for writing the file
+    :param offset: start of compressed stream in archive segment, if it is None, then whole file is read
+    :param length: length of compressed stream in archive segment
+    :return: binary file-like object with read() and close() methods
+    """
+    fileobj = SegmentReader(path, offset, length) if offset is not None else None
+
+    if codec == OutputCodec.GZIP:
+        if fileobj is not None:
+            return _CloseSourceReader(gzip.GzipFile(fileobj=fileobj, mode="rb"), fileobj)
+        return gzip.open(path, "rb")
+
+    if codec == OutputCodec.ZSTD:
+        zstandard = _import_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj if fileobj is not None else open(path, "rb"), closefd=True
+        )
+
+    if codec == OutputCodec.LZ4:
+        lz4_frame = _import_lz4_frame()
+        if fileobj is not None:
+            return _CloseSourceReader(lz4_frame.open(fileobj, "rb"), fileobj)
+        return lz4_frame.open(path, "rb")
+
+    return io.BufferedReader(fileobj) if fileobj is not None else open(path, "rb")
+
+
+def get_file_checksum(path: str, offset: Optional[int] = None, length: Optional[int] = None) -> Tuple[str, int]:
+    """
+    Calculate sha256 checksum and size of the file as it is stored on disk, without decompression
+    :param path: file path
+    :param offset: start of compressed stream in archive segment, if it is None, then whole file is read
+    :param length: length of compressed stream in archive segment
+    :return: hex digest of sha256 checksum and size in bytes
+    """
+    file_hash = hashlib.sha256()
+    size = 0
+    with (SegmentReader(path, offset, length) if offset is not None else open(path, "rb", buffering=0)) as f:
+        while block := f.read(CHECKSUM_BLOCK_SIZE):
+            file_hash.update(block)
+            size += len(block)
+    return file_hash.hexdigest(), size
@@ -26,8 +26,23 @@ class AnonMode(Enum):
     CREATE_DICT = "create-dict"  # create dictionary
     VIEW_FIELDS = "view-fields"  # view fields
     VIEW_DATA = "view-data"  # view data using prepared-sens-dict-file
+    TRANSFER = "transfer"  # dump from source database straight into target database without intermediate files
+    VERIFY = "verify"  # check files of dump by checksums from metadata.json without database connection
+    DUMP_WORKER = "dump-worker"  # dump tasks claimed from the plan of distributed dump, which is made by dump mode
 
 
 class ScanMode(Enum):
     FULL = "full"
     PARTIAL = "partial"
+
+
+class OutputCodec(Enum):
+    GZIP = "gzip"
+    ZSTD = "zstd"
+    LZ4 = "lz4"
+    NONE = "none"  # without compression
+
+
+class AnonEngine(Enum):
+    SERVER = "server"  # rules are evaluated by source database
+    CLIENT = "client"  # supported anon_funcs functions are evaluated by pg_anon on decoded COPY BINARY stream
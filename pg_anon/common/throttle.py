@@ -0,0 +1,241 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+import asyncpg
+
+RATE_LIMITER_BURST = 1.0  # seconds of not used rate, which can be used at once after pause
+LOAD_LOW_RATIO = 0.8  # concurrency is increased only if all load values are below this ratio of their limits
+AUTO_CONCURRENCY_GAIN = 0.1  # auto concurrency is increased while throughput grows by more than this ratio
+AUTO_CONCURRENCY_CONTENTION_RATIO = 0.5  # ratio of active sessions waiting for locks, which is treated as contention
+
+
+class RateLimiter:
+    """
+    Limiter of bytes per second read from source database by all tasks of process
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next_time = time.monotonic()
+
+    async def acquire(self, size: int):
+        """
+        Wait until chunk of this size fits into the rate.
+        COPY reads the next chunk only after the previous one is handled, so the wait slows down the source query
+        """
+        now = time.monotonic()
+        self._next_time = max(self._next_time, now - RATE_LIMITER_BURST) + size / self.rate
+        delay = self._next_time - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class LoadMonitor:
+    """
+    Monitor of source database load, which scales the amount of concurrently running dump tasks between 1 and --threads.
+    Each check decreases the amount by one, if some load value is above its limit, or increases it by one,
+    if all values are well below their limits
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.concurrency = ctx.args.threads
+        self._prev_blks_read: Optional[int] = None
+        self._prev_time: Optional[float] = None
+
+    @staticmethod
+    def is_enabled(ctx) -> bool:
+        return bool(
+            ctx.args.load_max_active_sessions
+            or ctx.args.load_max_blocks_read
+            or ctx.args.load_max_replication_lag
+        )
+
+    async def get_load(self, db_conn) -> Dict[str, Optional[float]]:
+        """
+        Get load values of source database
+        :param db_conn: connection to source database without transaction, so statistics are not cached
+        :return: dict of active sessions, blocks read per second and replication lag in seconds
+        """
+        load = await db_conn.fetchrow(
+            """
+            SELECT
+                (
+                    SELECT count(1)
+                    FROM pg_stat_activity
+                    WHERE state = 'active' AND backend_type = 'client backend' AND pid <> pg_backend_pid()
+                ) AS active_sessions,
+                (SELECT sum(blks_read) FROM pg_stat_database)::bigint AS blks_read,
+                CASE
+                    WHEN pg_is_in_recovery()
+                    THEN extract(epoch FROM clock_timestamp() - pg_last_xact_replay_timestamp())
+                    ELSE (SELECT max(extract(epoch FROM replay_lag)) FROM pg_stat_replication)
+                END::float8 AS replication_lag
+            """
+        )
+        now = time.monotonic()
+        blocks_read = None
+        if self._prev_blks_read is not None and now > self._prev_time:
+            blocks_read = (load["blks_read"] - self._prev_blks_read) / (now - self._prev_time)
+        self._prev_blks_read = load["blks_read"]
+        self._prev_time = now
+
+        return {
+            "active_sessions": load["active_sessions"],
+            "blocks_read": blocks_read,
+            "replication_lag": load["replication_lag"],
+        }
+
+    def get_limits(self) -> Dict[str, float]:
+        limits = {
+            "active_sessions": self.ctx.args.load_max_active_sessions,
+            "blocks_read": self.ctx.args.load_max_blocks_read,
+            "replication_lag": self.ctx.args.load_max_replication_lag,
+        }
+        return {name: limit for name, limit in limits.items() if limit}
+
+    async def run(self):
+        db_conn = await asyncpg.connect(**self.ctx.conn_params)
+        try:
+            while True:
+                await asyncio.sleep(self.ctx.args.load_check_interval)
+                load = await self.get_load(db_conn)
+                limits = self.get_limits()
+                overloaded = [
+                    name for name, limit in limits.items() if load[name] is not None and load[name] > limit
+                ]
+                if overloaded and self.concurrency > 1:
+                    self.concurrency -= 1
+                    self.ctx.logger.info(
+                        "Load of source database is high by %s: %s, concurrency of tasks is decreased to %s"
+                        % (", ".join(overloaded), load, self.concurrency)
+                    )
+                elif (not overloaded and self.concurrency < self.ctx.args.threads
+                      and all(load[name] is None or load[name] < limit * LOAD_LOW_RATIO
+                              for name, limit in limits.items())):
+                    self.concurrency += 1
+                    self.ctx.logger.info(
+                        "Load of source database is low: %s, concurrency of tasks is increased to %s"
+                        % (load, self.concurrency)
+                    )
+                else:
+                    self.ctx.logger.debug("Load of source database: %s, concurrency of tasks: %s"
+                                          % (load, self.concurrency))
+        finally:
+            await db_conn.close()
+
+
+class ConcurrencyTuner:
+    """
+    Tuner of the amount of concurrently running tasks between 1 and max_concurrency by measured throughput.
+    Concurrency starts from 1 and is increased by one every --auto-concurrency-interval seconds, while throughput
+    of the interval grows by more than AUTO_CONCURRENCY_GAIN. On plateau or drop it returns to the best level and
+    keeps it. Contention of the server, i.e. active sessions waiting for locks, decreases the level by one
+    """
+
+    def __init__(self, ctx, max_concurrency: int, unit: str = "bytes"):
+        """
+        :param ctx: context with --auto-concurrency-interval argument and connection parameters
+        :param max_concurrency: upper bound of concurrency, e.g. --threads
+        :param unit: name of measured amount for logging, e.g. "bytes" of COPY or "fields" of scan
+        """
+        self.ctx = ctx
+        self.max_concurrency = max_concurrency
+        self.unit = unit
+        self.concurrency = 1
+        self.settled = False
+        self.best_concurrency = 1
+        self.best_throughput = 0.0
+        self._amount = 0
+        self._start_time = time.monotonic()
+
+    def add(self, amount: int):
+        """
+        Count amount of processed data, e.g. size of COPY chunk or one scanned field
+        """
+        self._amount += amount
+
+    def get_throughput(self) -> float:
+        """
+        Get throughput since the previous call and start the next interval
+        """
+        now = time.monotonic()
+        throughput = self._amount / (now - self._start_time) if now > self._start_time else 0.0
+        self._amount = 0
+        self._start_time = now
+        return throughput
+
+    @staticmethod
+    async def get_contention(db_conn) -> float:
+        """
+        Get ratio of active sessions in current database, which are waiting for heavyweight or lightweight locks
+        :param db_conn: connection without transaction, so statistics are not cached
+        """
+        return await db_conn.fetchval(
+            """
+            SELECT (
+                count(1) FILTER (WHERE wait_event_type IN ('Lock', 'LWLock', 'BufferPin'))::float8
+                / greatest(count(1), 1)
+            )
+            FROM pg_stat_activity
+            WHERE state = 'active' AND backend_type = 'client backend'
+                AND datname = current_database() AND pid <> pg_backend_pid()
+            """
+        )
+
+    def log_chosen_level(self):
+        self.ctx.logger.info(
+            "Auto concurrency: chosen level is %s (%s %s per second), it can be pinned by --threads=%s"
+            % (self.concurrency, round(self.best_throughput, 2), self.unit, self.concurrency)
+        )
+
+    def tune(self, throughput: float, contention: float = 0.0):
+        """
+        Change concurrency by throughput and contention of the last interval
+        :param throughput: amount of processed data per second
+        :param contention: ratio of active sessions waiting for locks
+        """
+        if contention > AUTO_CONCURRENCY_CONTENTION_RATIO:
+            if self.concurrency > 1:
+                self.concurrency -= 1
+                self.best_concurrency = min(self.best_concurrency, self.concurrency)
+                self.ctx.logger.info(
+                    "Auto concurrency: contention of server is %s, concurrency is decreased to %s"
+                    % (round(contention, 2), self.concurrency)
+                )
+                self.settled = True
+                self.log_chosen_level()
+            return
+
+        if self.settled or not throughput:
+            # nothing was processed, e.g. all tasks are waiting for long queries, so the level can't be rated
+            return
+
+        if throughput > self.best_throughput * (1 + AUTO_CONCURRENCY_GAIN):
+            self.best_throughput = throughput
+            self.best_concurrency = self.concurrency
+            if self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.ctx.logger.info(
+                    "Auto concurrency: throughput is %s %s per second, concurrency is increased to %s"
+                    % (round(throughput, 2), self.unit, self.concurrency)
+                )
+                return
+        else:
+            self.concurrency = self.best_concurrency
+
+        self.settled = True
+        self.log_chosen_level()
+
+    async def run(self):
+        db_conn = await asyncpg.connect(**self.ctx.conn_params)
+        try:
+            while True:
+                await asyncio.sleep(self.ctx.args.auto_concurrency_interval)
+                self.tune(self.get_throughput(), await self.get_contention(db_conn))
+        finally:
+            if not self.settled:
+                # work is finished before throughput stopped growing
+                self.log_chosen_level()
+            await db_conn.close()
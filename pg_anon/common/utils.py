@@ -6,11 +6,14 @@ import re
 import subprocess
 import sys
 import traceback
-from typing import List, Optional, Dict, Union
+from typing import List, Optional, Dict, Tuple, Union
 
 from pkg_resources import parse_version as version
 
+from pg_anon.common.client_anon import compile_client_rule
+from pg_anon.common.codecs import get_codec_file_extension, get_codec_level
 from pg_anon.common.db_utils import get_fields_list
+from pg_anon.common.enums import AnonEngine, AnonMode
 
 
 def get_pg_util_version(util_name):
@@ -128,6 +131,17 @@ def parse_comma_separated_list(value: str = None) -> Optional[List[str]]:
     return [item for item in value.split(',')]
 
 
+def parse_profile(value: str) -> Tuple[str, List[str]]:
+    """
+    Parse dictionary profile of dump in format NAME=DICT_FILE[,DICT_FILE...]
+    :return: name of profile and list of prepared sens dict files
+    """
+    name, _, dict_files = value.partition("=")
+    if not name or not dict_files or os.sep in name:
+        raise ValueError(f"Profile must be specified as NAME=DICT_FILE[,DICT_FILE...], got: {value}")
+    return name, parse_comma_separated_list(dict_files)
+
+
 def get_dict_rule_for_table(dictionary_rules: List[Dict], schema: str, table: str) -> Optional[Union[List[Dict], Dict]]:
     """
     Find matches rules for field in prepared dictionary
@@ -175,10 +189,43 @@ def get_dict_rule_for_table(dictionary_rules: List[Dict], schema: str, table: st
     return result
 
 
+def get_domain_field_expr(ctx, domain_name: str, table_name_full: str, column_name: str, cnt: int):
+    """
+    Get expression of field, which is anonymized by value domain of dictionary
+    :param ctx: context with prepared dictionary and mapping tables of domains
+    :param domain_name: name of domain from "domains" section of dictionary
+    :param table_name_full: quoted name of dumped table
+    :param column_name: name of field
+    :param cnt: number of field in table, it makes alias of mapping table unique in the query
+    :return: expression of anonymized value as text and JOIN clause with mapping table of domain
+    """
+    domain_rule = ctx.prepared_dictionary_obj.get("domains", {}).get(domain_name)
+    if domain_rule is None:
+        raise ValueError(f'Domain "{domain_name}" of field "{column_name}" is not found in "domains" of dictionary')
+
+    # rule of domain is calculated for each row, if there is no mapping table of domain
+    value_expr = f'(SELECT ({domain_rule})::text FROM (SELECT {table_name_full}."{column_name}"::text AS value) AS v)'
+    domain_table = ctx.domain_tables.get(domain_name)
+    if domain_table is None:
+        return value_expr, ""
+
+    # Columns of joined mapping table have unique names, so they don't conflict with fields used by other rules.
+    # Values, which are added after mapping table was built, are calculated for each row
+    alias = f"pg_anon_domain_{cnt}"
+    domain_join = (
+        f' LEFT JOIN (SELECT value, anon FROM {domain_table}) AS "{alias}"("{alias}_value", "{alias}_anon")'
+        f' ON "{alias}"."{alias}_value" = {table_name_full}."{column_name}"::text'
+    )
+    return f'coalesce("{alias}"."{alias}_anon", {value_expr})', domain_join
+
+
 async def get_dump_query(ctx, table_schema: str, table_name: str, table_rule,
-                         files: Dict, excluded_objs: List, included_objs: List):
+                         files: Dict, excluded_objs: List, included_objs: List,
+                         fields_list: Optional[List] = None, subset_condition: Optional[str] = None):
 
     table_name_full = f'"{table_schema}"."{table_name}"'
+    # only rows of subset are dumped, "raw_sql" of table is not restricted
+    subset_where = f" WHERE ({subset_condition})" if subset_condition else ""
 
     found_white_list = table_rule is not None
 
@@ -206,21 +253,30 @@ async def get_dump_query(ctx, table_schema: str, table_name: str, table_rule,
         (table_schema + "_" + table_name).encode()
     ).hexdigest()
 
-    files["%s.bin.gz" % hashed_name] = {"schema": table_schema, "table": table_name}
+    files[hashed_name + get_codec_file_extension(ctx.args.output_codec)] = {
+        "schema": table_schema,
+        "table": table_name,
+        "codec": ctx.args.output_codec.value,
+        "codec_level": get_codec_level(ctx.args.output_codec, ctx.args.output_codec_level),
+    }
 
     if not found_white_list:
         included_objs.append(
             [table_rule, table_schema, table_name, "if not found_white_list"]
         )
         # there is no table in the dictionary, so it will be transferred "as is"
-        if (ctx.args.dbg_stage_1_validate_dict
-                or ctx.args.dbg_stage_2_validate_data
+        if (ctx.args.dbg_stage_2_validate_data
                 or ctx.args.dbg_stage_3_validate_full):
-            query = "SELECT * FROM %s %s" % (table_name_full, ctx.validate_limit)
+            query = "SELECT * FROM %s%s %s" % (table_name_full, subset_where, ctx.validate_limit)
             ctx.logger.info(str(query))
             return query
         else:
-            query = f"SELECT * FROM {table_name_full}"
+            query = f"SELECT * FROM {table_name_full}{subset_where}"
+            if fields_list is not None:
+                # select list, FROM clause and count of fields, so dump of several profiles can read the table once
+                files[hashed_name + get_codec_file_extension(ctx.args.output_codec)]["query_parts"] = (
+                    "*", f"{table_name_full}{subset_where}", len(fields_list)
+                )
             return query
     else:
         included_objs.append(
@@ -229,8 +285,7 @@ async def get_dump_query(ctx, table_schema: str, table_name: str, table_rule,
         # table found in dictionary
         if "raw_sql" in table_rule:
             # the table is transferred using "raw_sql"
-            if (ctx.args.dbg_stage_1_validate_dict
-                    or ctx.args.dbg_stage_2_validate_data
+            if (ctx.args.dbg_stage_2_validate_data
                     or ctx.args.dbg_stage_3_validate_full):
                 query = table_rule["raw_sql"] + " " + ctx.validate_limit
                 ctx.logger.info(str(query))
@@ -240,13 +295,21 @@ async def get_dump_query(ctx, table_schema: str, table_name: str, table_rule,
                 return query
         else:
             # the table is transferred with the specific fields for anonymization
-            fields_list = await get_fields_list(
-                connection_params=ctx.conn_params,
-                table_schema=table_schema,
-                table_name=table_name
-            )
+            if fields_list is None:
+                fields_list = await get_fields_list(
+                    connection_params=ctx.conn_params,
+                    table_schema=table_schema,
+                    table_name=table_name
+                )
 
             sql_expr = ""
+            domain_joins = ""
+            client_rules = {}
+            # functions are evaluated by pg_anon only in dump modes, where the stream goes through get_dump_table()
+            use_client_engine = (
+                ctx.args.anon_engine == AnonEngine.CLIENT
+                and ctx.args.mode in (AnonMode.DUMP, AnonMode.SYNC_DATA_DUMP)
+            )
 
             def check_fld(fld_name):
                 if fld_name in table_rule["fields"]:
@@ -257,9 +320,22 @@ async def get_dump_query(ctx, table_schema: str, table_name: str, table_rule,
                 column_name = column_info["column_name"]
                 udt_name = column_info["udt_name"]
                 fld_name, fld_val = check_fld(column_name)
-                if fld_name:
+                client_rule = None
+                if fld_name and use_client_engine:
+                    client_rule = compile_client_rule(fld_val, column_name, udt_name)
+                if client_rule is not None:
+                    # source database only reads the field, it is anonymized in get_dump_table()
+                    sql_expr += f'"{column_name}" as "{fld_name}"'
+                    client_rules[cnt] = client_rule
+                elif fld_name:
                     if fld_val.find("SQL:") == 0:
                         sql_expr += f'({fld_val[4:]}) as "{fld_name}"'
+                    elif fld_val.find("DOMAIN:") == 0:
+                        domain_expr, domain_join = get_domain_field_expr(
+                            ctx, fld_val[7:].strip(), table_name_full, column_name, cnt
+                        )
+                        sql_expr += f'{domain_expr}::{udt_name} as "{fld_name}"'
+                        domain_joins += domain_join
                     else:
                         sql_expr += f'{fld_val}::{udt_name} as "{fld_name}"'
                 else:
@@ -273,19 +349,28 @@ async def get_dump_query(ctx, table_schema: str, table_name: str, table_rule,
                 if cnt != len(fields_list) - 1:
                     sql_expr += ",\n"
 
-            if (ctx.args.dbg_stage_1_validate_dict
-                    or ctx.args.dbg_stage_2_validate_data
+            if client_rules:
+                files[hashed_name + get_codec_file_extension(ctx.args.output_codec)]["client_rules"] = client_rules
+
+            if (ctx.args.dbg_stage_2_validate_data
                     or ctx.args.dbg_stage_3_validate_full):
-                query = "SELECT %s FROM %s %s" % (
+                query = "SELECT %s FROM %s%s%s %s" % (
                     sql_expr,
                     table_name_full,
+                    domain_joins,
+                    subset_where,
                     ctx.validate_limit,
                 )
                 return query
             else:
-                query = "SELECT %s FROM %s" % (
+                query = "SELECT %s FROM %s%s%s" % (
                     sql_expr,
                     table_name_full,
+                    domain_joins,
+                    subset_where,
+                )
+                files[hashed_name + get_codec_file_extension(ctx.args.output_codec)]["query_parts"] = (
+                    sql_expr, f"{table_name_full}{domain_joins}{subset_where}", len(fields_list)
                 )
                 return query
 
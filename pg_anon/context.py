@@ -2,10 +2,12 @@ import argparse
 import os
 from typing import Dict, Optional
 
-from pg_anon.common.enums import VerboseOptions, AnonMode, ScanMode
+from pg_anon.common.enums import VerboseOptions, AnonMode, ScanMode, OutputCodec, AnonEngine
+from pg_anon.common.throttle import RateLimiter
 from pg_anon.common.utils import (
     exception_handler,
     parse_comma_separated_list,
+    parse_profile,
 )
 
 
@@ -20,13 +22,30 @@ class Context:
         self.prepared_dictionary_obj: Dict = {}
         self.prepared_dictionary_contents: Dict = {}  # for dump process
         self.metadata = None  # for restore process
-        self.task_results = {}  # for dump process (key is hash() of SQL query)
+        self.task_results = {}  # for dump process (key is file name)
+        self.compression_executor = None  # for dump and restore processes
+        self.archive_segments = None  # for dump process with --archive-segments (queue of free segments)
+        self.files_stripes = {}  # for dump process with --stripe-dirs (key is file name, value is index of dir)
+        self.domain_tables = {}  # for dump process (key is domain name, value is mapping table of domain)
+        self.domains_mapping_id = None  # for dump process (id of run, which filled mapping tables of domains)
+        self.files_client_rules = {}  # for dump process with --anon-engine=client (key is file name)
+        self.anon_executor = None  # for dump process with --anon-engine=client or --profile (process pool)
+        self.replication_lag = None  # for dump process from standby (lag at start and end of dump)
+        self.rate_limiter = None  # for dump and transfer processes with --throttle-rate
+        self.load_monitor = None  # for dump process with --load-max-* options
+        self.concurrency_tuner = None  # for dump and restore processes with --auto-concurrency
+        self.profiles = {}  # for dump process with --profile (key is profile name, value is context of profile)
+        self.profile_name = None  # for context of one profile of dump
+        self.files_query_parts = {}  # for dump process (key is file name, value is select list, FROM and fields count)
         self.total_rows = 0
         self.create_dict_sens_matches = {}  # for create-dict mode
         self.create_dict_no_sens_matches = {}  # for create-dict mode
         self.exclude_schemas = ["anon_funcs", "columnar_internal"]
         self.logger = None
 
+        if args.throttle_rate:
+            self.rate_limiter = RateLimiter(args.throttle_rate * 1024 * 1024)
+
         if args.db_user_password == "" and os.environ.get("PGPASSWORD") is not None:
             args.db_user_password = os.environ["PGPASSWORD"]
 
@@ -182,6 +201,8 @@ class Context:
             "dictionary": [],
             "dictionary_exclude": [],
             "validate_tables": [],
+            "domains": {},
+            "subset": [],
         }
 
         for dict_file in self.args.prepared_sens_dict_files:
@@ -214,6 +235,12 @@ class Context:
             if validate_tables := dict_data.get("validate_tables", []):
                 self.prepared_dictionary_obj["validate_tables"].extend(validate_tables)
 
+            if domains := dict_data.get("domains", {}):
+                self.prepared_dictionary_obj["domains"].update(domains)
+
+            if subset := dict_data.get("subset", []):
+                self.prepared_dictionary_obj["subset"].extend(subset)
+
     @staticmethod
     def get_arg_parser():
         parser = argparse.ArgumentParser()
@@ -271,6 +298,13 @@ class Context:
             default=4,
             help="Amount of processes for multiprocessing operations.",
         )
+        parser.add_argument(
+            "--compress-threads",
+            type=int,
+            default=None,
+            help="Amount of threads for compression in dump mode and decompression in restore mode. "
+            "By default equals to --threads.",
+        )
         parser.add_argument(
             "--pg-dump",
             type=str,
@@ -285,11 +319,19 @@ class Context:
         )
         parser.add_argument("--output-dir", type=str, default="")
         parser.add_argument("--input-dir", type=str, default="")
+        parser.add_argument(
+            "--stripe-dirs",
+            type=parse_comma_separated_list,
+            default=None,
+            help="In 'dump' mode additional output directories (e.g. on other volumes), files of tables are spread "
+            "over --output-dir and these directories by expected size. In 'restore' mode directories with "
+            "the same files in the same order, by default directories from metadata.json are used",
+        )
         parser.add_argument(
             "--dbg-stage-1-validate-dict",
             action="store_true",
             default=False,
-            help="""Validate dictionary, show the tables and run SQL queries without data export""",
+            help="""Validate dictionary, show the tables and check SQL queries by EXPLAIN without data export""",
         )
         parser.add_argument(
             "--dbg-stage-2-validate-data",
@@ -304,6 +346,209 @@ class Context:
             help="""Makes all logic with "limit" in SQL queries""",
         )
         parser.add_argument("--clear-output-dir", action="store_true", default=False)
+        parser.add_argument(
+            "--split-table-size",
+            type=int,
+            default=0,
+            help="In 'dump' mode tables larger than this size in MB are dumped by ctid block ranges "
+            "in parallel tasks, each range into own file. Requires PostgreSQL 14 or higher. "
+            "By default = 0, tables are not split",
+        )
+        parser.add_argument(
+            "--batch-table-size",
+            type=int,
+            default=0,
+            help="In 'dump' mode tables smaller than this size in KB are dumped in batches, each batch "
+            "sequentially in one transaction. Restore mode loads each batch in one transaction too. "
+            "By default = 0, tables are not batched",
+        )
+        parser.add_argument(
+            "--batch-tables",
+            type=int,
+            default=1000,
+            help="In 'dump' mode max amount of tables in one batch of --batch-table-size. By default = 1000",
+        )
+        parser.add_argument(
+            "--prev-dump-dir",
+            type=str,
+            default="",
+            help="In 'dump' mode directory of previous dump. Durations of tasks from its metadata.json "
+            "are used for ordering of dump tasks. By default tasks are ordered by tables sizes",
+        )
+        parser.add_argument(
+            "--base-dir",
+            type=str,
+            default="",
+            help="In 'dump' and 'sync-data-dump' modes directory of previous dump. Files of tables which are not "
+            "changed since it are hard linked from it instead of dumping them again",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="In 'dump' and 'sync-data-dump' modes continue interrupted dump in not empty --output-dir. "
+            "Files which are already dumped according to its manifest.jsonl are skipped",
+        )
+        parser.add_argument(
+            "--snapshot",
+            type=str,
+            default="",
+            help="In 'dump' and 'sync-data-dump' modes use this snapshot exported by another open transaction "
+            "instead of exporting a new one. In 'dump-worker' mode snapshot of distributed dump to work on",
+        )
+        parser.add_argument(
+            "--task-retries",
+            type=int,
+            default=3,
+            help="In 'dump', 'sync-data-dump' and 'dump-worker' modes how many times a dump task is retried, "
+            "if it is cancelled by conflict with recovery on standby. By default = 3",
+        )
+        parser.add_argument(
+            "--task-retry-delay",
+            type=float,
+            default=1.0,
+            help="In 'dump', 'sync-data-dump' and 'dump-worker' modes delay in seconds before the first retry "
+            "of dump task, it is doubled for each next retry. By default = 1",
+        )
+        parser.add_argument(
+            "--throttle-rate",
+            type=float,
+            default=0,
+            help="In 'dump', 'sync-data-dump', 'dump-worker' and 'transfer' modes limit of data read from source "
+            "database by all tasks in MB per second. By default = 0, not limited",
+        )
+        parser.add_argument(
+            "--load-max-active-sessions",
+            type=int,
+            default=0,
+            help="In 'dump' and 'sync-data-dump' modes limit of active sessions in source database, including "
+            "sessions of dump. Concurrency of dump tasks is decreased above it and increased below it. "
+            "By default = 0, not checked",
+        )
+        parser.add_argument(
+            "--load-max-blocks-read",
+            type=int,
+            default=0,
+            help="In 'dump' and 'sync-data-dump' modes limit of blocks read per second by all databases "
+            "according to pg_stat_database. By default = 0, not checked",
+        )
+        parser.add_argument(
+            "--load-max-replication-lag",
+            type=float,
+            default=0,
+            help="In 'dump' and 'sync-data-dump' modes limit of replication lag in seconds, replay lag of "
+            "replicas on primary or own lag on standby. By default = 0, not checked",
+        )
+        parser.add_argument(
+            "--load-check-interval",
+            type=float,
+            default=5,
+            help="In 'dump' and 'sync-data-dump' modes interval in seconds between checks of --load-max-* limits. "
+            "By default = 5",
+        )
+        parser.add_argument(
+            "--auto-concurrency",
+            action="store_true",
+            default=False,
+            help="In 'dump', 'sync-data-dump', 'restore', 'sync-data-restore' and 'create-dict' modes tune amount "
+            "of concurrently running tasks between 1 and --threads: it is increased while measured throughput grows "
+            "and is decreased on plateau or contention of the server. Chosen level is logged",
+        )
+        parser.add_argument(
+            "--auto-concurrency-interval",
+            type=float,
+            default=5,
+            help="Interval in seconds, by which throughput is measured for --auto-concurrency. By default = 5",
+        )
+        parser.add_argument(
+            "--distributed",
+            action="store_true",
+            default=False,
+            help="In 'dump' and 'sync-data-dump' modes write the plan of dump tasks into the source database, "
+            "so they are dumped by this process together with processes of 'dump-worker' mode on other hosts, "
+            "started with --snapshot of this dump. Results of workers are merged into metadata.json",
+        )
+        parser.add_argument(
+            "--archive-segments",
+            type=int,
+            default=0,
+            help="In 'dump' mode data of all tables is appended into this amount of segment files "
+            "instead of one file per table, the index of tables streams is saved in metadata.json. "
+            "Each segment has one writer at a time, so it is recommended to set it equal to --threads. "
+            "By default = 0, each table is dumped into own file",
+        )
+        parser.add_argument(
+            "--anon-engine",
+            type=AnonEngine,
+            choices=list(AnonEngine),
+            default=AnonEngine.SERVER.value,
+            help="In 'dump' and 'sync-data-dump' modes where to evaluate anon_funcs functions of dictionary rules: "
+            "'server' - by source database, 'client' - by pg_anon in process pool on COPY BINARY stream. "
+            "Rules, which are not supported by client engine, are evaluated by source database",
+        )
+        parser.add_argument(
+            "--anon-processes",
+            type=int,
+            default=None,
+            help="In 'dump' mode amount of processes for --anon-engine=client and for split of streams "
+            "between profiles of --profile. By default equals to CPU count",
+        )
+        parser.add_argument(
+            "--output-codec",
+            type=OutputCodec,
+            choices=list(OutputCodec),
+            default=OutputCodec.GZIP.value,
+            help="In 'dump' mode codec for compression of data files",
+        )
+        parser.add_argument(
+            "--output-codec-level",
+            type=int,
+            default=None,
+            help="In 'dump' mode compression level of --output-codec. By default uses default level of codec",
+        )
+        parser.add_argument(
+            "--target-db-host",
+            type=str,
+            default=None,
+            help="In 'transfer' mode host of target database. By default equals to --db-host",
+        )
+        parser.add_argument(
+            "--target-db-port",
+            type=str,
+            default=None,
+            help="In 'transfer' mode port of target database. By default equals to --db-port",
+        )
+        parser.add_argument(
+            "--target-db-name",
+            type=str,
+            default="",
+            help="In 'transfer' mode name of target database",
+        )
+        parser.add_argument(
+            "--target-db-user",
+            type=str,
+            default=None,
+            help="In 'transfer' mode user of target database. By default equals to --db-user",
+        )
+        parser.add_argument(
+            "--target-db-user-password",
+            type=str,
+            default=None,
+            help="In 'transfer' mode password of target database user. By default equals to --db-user-password",
+        )
+        parser.add_argument(
+            "--target-db-passfile",
+            type=str,
+            default=None,
+            help="In 'transfer' mode passfile for target database. By default equals to --db-passfile",
+        )
+        parser.add_argument(
+            "--transfer-buffer-size",
+            type=int,
+            default=16,
+            help="In 'transfer' mode how many COPY chunks of one table can be buffered in memory "
+            "between source and target databases. By default = 16",
+        )
         parser.add_argument(
             "--drop-custom-check-constr",
             action="store_true",
@@ -324,6 +569,13 @@ class Context:
             default=False,
             help="Disable checks of disk space and PostgreSQL version.",
         )
+        parser.add_argument(
+            "--verify-before-restore",
+            action="store_true",
+            default=False,
+            help="In 'restore' and 'sync-data-restore' modes check sizes and checksums of all files "
+            "by metadata.json before restore of pre-data section",
+        )
         parser.add_argument(
             "--scan-mode",
             type=ScanMode,
@@ -348,6 +600,17 @@ class Context:
             type=parse_comma_separated_list,
             help="In 'create-dict' mode input file or file list with sensitive fields, which was obtained in previous use by option `--output-sens-dict-file` or prepared manually",
         )
+        parser.add_argument(
+            "--profile",
+            dest="profiles",
+            type=parse_profile,
+            action="append",
+            default=None,
+            help="In 'dump' mode dictionary profile in format NAME=DICT_FILE[,DICT_FILE...] instead of "
+            "--prepared-sens-dict-file, can be specified several times. Each profile is dumped into own "
+            "directory NAME in --output-dir, all profiles in one snapshot, and each table is read once "
+            "for all profiles, which select it from the same rows",
+        )
         parser.add_argument(
             "--prepared-no-sens-dict-file",
             dest="prepared_no_sens_dict_files",
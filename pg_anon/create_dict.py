@@ -14,6 +14,7 @@ from pg_anon.common.db_queries import get_data_from_field
 from pg_anon.common.db_utils import get_scan_fields_list, exec_data_scan_func_query
 from pg_anon.common.dto import PgAnonResult, FieldInfo
 from pg_anon.common.enums import ResultCode, ScanMode
+from pg_anon.common.throttle import ConcurrencyTuner
 from pg_anon.common.utils import (
     chunkify,
     exception_helper,
@@ -472,6 +473,9 @@ def process_impl(
             **conn_params, min_size=threads, max_size=threads
         )
         tasks = set()
+        # each process tunes amount of its threads by scanned fields per second
+        concurrency_tuner = ConcurrencyTuner(ctx, threads, unit="fields") if ctx.args.auto_concurrency else None
+        concurrency_tuner_task = loop.create_task(concurrency_tuner.run()) if concurrency_tuner else None
 
         ctx.logger.info(
             "============> Started collecting list_tagged_fields in mode: create-dict"
@@ -481,14 +485,18 @@ def process_impl(
         )
 
         for idx, field_info in enumerate(fields_info_chunk):
-            if len(tasks) >= threads:
+            while len(tasks) >= (concurrency_tuner.concurrency if concurrency_tuner else threads):
                 done, tasks = await asyncio.wait(
-                    tasks, return_when=asyncio.FIRST_COMPLETED
+                    tasks,
+                    timeout=ctx.args.auto_concurrency_interval if concurrency_tuner else None,
+                    return_when=asyncio.FIRST_COMPLETED,
                 )
-                exception = done.pop().exception()
-                if exception is not None:
-                    await pool.close()
-                    raise exception
+                for task in done:
+                    if task.exception() is not None:
+                        if concurrency_tuner_task is not None:
+                            concurrency_tuner_task.cancel()
+                        await pool.close()
+                        raise task.exception()
             task_res = loop.create_task(
                 scan_obj_func(
                     name,
@@ -500,6 +508,8 @@ def process_impl(
                     ctx.args.scan_partial_rows,
                 )
             )
+            if concurrency_tuner is not None:
+                task_res.add_done_callback(lambda _: concurrency_tuner.add(1))
             tasks_res.append(task_res)
             tasks.add(task_res)
             if idx % status_ratio:
@@ -509,6 +519,9 @@ def process_impl(
                 ctx.logger.info("Process [%s] Progress %s" % (name, str(progress)))
         if len(tasks) > 0:
             await asyncio.wait(tasks)
+        if concurrency_tuner_task is not None:
+            concurrency_tuner_task.cancel()
+            await asyncio.wait([concurrency_tuner_task])
         await pool.close()
 
     nest_asyncio.apply()
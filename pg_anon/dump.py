@@ -1,15 +1,27 @@
 import asyncio
-import gzip
+import copy
+import functools
 import hashlib
+import itertools
 import json
+import math
+import multiprocessing
 import os
 import re
-import subprocess
+import shutil
+import socket
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from hashlib import sha256
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 
 import asyncpg
 
+from pg_anon.common.client_anon import CopyBinarySplitter, anonymize_tuples, split_tuples
+from pg_anon.common.codecs import ChecksumWriter, check_codec_available, get_codec_level, open_codec_writer
+from pg_anon.common.throttle import ConcurrencyTuner, LoadMonitor
 from pg_anon.common.utils import (
     exception_helper,
     get_pg_util_version,
@@ -17,13 +29,33 @@ from pg_anon.common.utils import (
     get_dump_query,
     get_file_name_from_path,
 )
-from pg_anon.common.enums import ResultCode, VerboseOptions, AnonMode
+from pg_anon.common.enums import ResultCode, VerboseOptions, AnonMode, AnonEngine, OutputCodec
 from pg_anon.common.dto import PgAnonResult
+from pg_anon.context import Context
 
 DEFAULT_EXCLUDED_SCHEMAS = ["pg_catalog", "information_schema"]
+DUMP_MANIFEST_FILE_NAME = "manifest.jsonl"
+DOMAIN_MIN_ROWS_PER_VALUE = 2  # mapping table of domain is built if values are repeated at least so many times
+SUBSET_SAMPLE_SEED = 0  # seed of TABLESAMPLE ... REPEATABLE, so "sample" of subset is the same in all queries
+DUMP_TASKS_TABLE = "anon_funcs.dump_tasks"  # claim table of distributed dump
+DUMP_TASK_MAX_ATTEMPTS = 3  # task of distributed dump is not claimed again after so many failed attempts
+DUMP_PLAN_POLL_INTERVAL = 1  # seconds between checks of tasks, which are dumped by other workers
+# Errors of queries cancelled by conflict with recovery on standby, and of sessions terminated by it
+# Lock and buffer pin conflicts cancel only the query of the task, so it can be run again in the same snapshot
+RECOVERY_CONFLICT_ERRORS = (
+    asyncpg.exceptions.SerializationError,
+    asyncpg.exceptions.DeadlockDetectedError,
+    asyncpg.exceptions.ConnectionDoesNotExistError,
+)
 
 
-async def run_pg_dump(ctx, section):
+async def run_pg_dump(ctx, section: str, snapshot_id: Optional[str] = None):
+    """
+    Run pg_dump for one section of database structure without blocking the event loop
+    :param ctx: context with dump arguments
+    :param section: "pre-data" or "post-data"
+    :param snapshot_id: exported snapshot, if it is set, then structure will be dumped in the same snapshot as data
+    """
     os.environ["PGPASSWORD"] = ctx.args.db_user_password
 
     specific_tables = []
@@ -39,6 +71,8 @@ async def run_pg_dump(ctx, section):
         tmp_list.append(["--exclude-schema", v])
     exclude_schemas = [item for sublist in tmp_list for item in sublist]
 
+    snapshot = ["--snapshot", snapshot_id] if snapshot_id else []
+
     command = [
         ctx.args.pg_dump,
         "-h",
@@ -51,6 +85,7 @@ async def run_pg_dump(ctx, section):
         ctx.args.db_user,
         *exclude_schemas,
         *specific_tables,
+        *snapshot,
         "--section",
         section,
         "-E",
@@ -66,54 +101,462 @@ async def run_pg_dump(ctx, section):
         del command[command.index("-h"): command.index("-h") + 2]
 
     ctx.logger.debug(str(command))
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    err, out = proc.communicate()
-    if err.decode("utf-8") != "":
+    proc = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    out, err = await proc.communicate()
+    if proc.returncode != 0:
         msg = "ERROR: database schema dump has failed! \n%s" % err.decode("utf-8")
         ctx.logger.error(msg)
         raise RuntimeError(msg)
 
-    for v in out.decode("utf-8").split("\n"):
+    for v in err.decode("utf-8").split("\n"):
         ctx.logger.info(v)
 
 
-async def get_dump_table(ctx, query: str, file_name: str, db_conn, output_dir: str):
-    full_file_name = os.path.join(output_dir, file_name.split(".")[0])
+async def run_pg_dump_sections(ctx, snapshot_id: Optional[str] = None):
+    """
+    Run pg_dump of pre-data and post-data sections concurrently
+    :param ctx: context with dump arguments
+    :param snapshot_id: exported snapshot, which is shared with data dump tasks
+    """
+    sections = ["pre-data"]
+    if not ctx.args.dbg_stage_3_validate_full:
+        sections.append("post-data")
+
+    ctx.logger.info("-------------> Started pg_dump")
+    await asyncio.gather(*[run_pg_dump(ctx, section, snapshot_id) for section in sections])
+    ctx.logger.info("<------------- Finished pg_dump")
+
+
+async def run_profiles_pg_dump(ctx, snapshot_id: str):
+    """
+    Structure of database is the same for all profiles of --profile, so it is dumped once
+    into directory of the first profile and copied into directories of other profiles
+    :param ctx: context of dump with profiles
+    :param snapshot_id: exported snapshot, which is shared with data dump tasks
+    """
+    profiles = list(ctx.profiles.values())
+    await run_pg_dump_sections(profiles[0], snapshot_id)
+    for profile_ctx in profiles[1:]:
+        for file_name in os.listdir(profiles[0].args.output_dir):
+            if file_name.endswith(".backup"):
+                shutil.copy(
+                    os.path.join(profiles[0].args.output_dir, file_name),
+                    os.path.join(profile_ctx.args.output_dir, file_name),
+                )
+
+
+def compress_chunk(f_out, chunk: bytes) -> float:
+    start_t = time.time()
+    f_out.write(chunk)
+    return time.time() - start_t
+
+
+def sync_file(f) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def close_compressed_file(f_out) -> float:
+    start_t = time.time()
+    f_out.close()
+    return time.time() - start_t
+
+
+async def get_dump_table(ctx, query: str, file_name: str, db_conn, output_dir: str, fileobj=None):
+    """
+    Dump result of query into file compressed by --output-codec
+    :param fileobj: already opened archive segment, if it is None, then separate file is written into output_dir
+    :return: result of COPY and dict with sha256 checksum and size of written file and size of uncompressed data
+    """
     try:
-        if ctx.args.dbg_stage_1_validate_dict:
-            result = await db_conn.execute(query)
-            return result
-        result = await db_conn.copy_from_query(
-            query, output=f"{full_file_name}.bin", format="binary"
+        # COPY BINARY stream is passed chunk by chunk straight into the compressor,
+        # so every byte is written to disk once and no temporary .bin file is needed.
+        # Compression runs in ctx.compression_executor, so the event loop keeps serving other tasks.
+        # Each chunk is awaited before the next one is read from the connection, that gives backpressure
+        loop = asyncio.get_event_loop()
+        compression_time = 0.0
+        anon_time = 0.0
+        raw_size = 0
+        # With --anon-engine=client the stream is split into blocks of whole tuples,
+        # which are anonymized in ctx.anon_executor process pool before compression
+        client_rules = ctx.files_client_rules.get(file_name)
+        splitter = CopyBinarySplitter() if client_rules else None
+        # Checksum is calculated over the compressed stream on its way to disk, so file is not read again
+        f_checksum = ChecksumWriter(
+            fileobj if fileobj is not None else open(os.path.join(output_dir, file_name), "wb"),
+            closefd=fileobj is None,
         )
-        with open(f"{full_file_name}.bin", "rb") as f_in, gzip.open(
-                f"{full_file_name}.bin.gz", "wb"
-        ) as f_out:
-            f_out.writelines(f_in)
-        os.remove(f"{full_file_name}.bin")
-        return result
+        f_out = open_codec_writer(
+            path=None,
+            codec=ctx.args.output_codec,
+            level=ctx.args.output_codec_level,
+            fileobj=f_checksum,
+        )
+        try:
+            async def write_data(data: bytes):
+                nonlocal compression_time, raw_size
+                raw_size += len(data)
+                compression_time += await loop.run_in_executor(
+                    ctx.compression_executor, compress_chunk, f_out, data
+                )
+
+            async def write_blocks(blocks: List[Tuple[bytes, bool]]):
+                nonlocal anon_time
+                for data, is_tuples in blocks:
+                    if is_tuples:
+                        anon_start_t = time.time()
+                        data = await loop.run_in_executor(ctx.anon_executor, anonymize_tuples, client_rules, data)
+                        anon_time += time.time() - anon_start_t
+                    await write_data(data)
+
+            async def write_chunk(chunk: bytes):
+                if ctx.rate_limiter is not None:
+                    await ctx.rate_limiter.acquire(len(chunk))
+                if ctx.concurrency_tuner is not None:
+                    ctx.concurrency_tuner.add(len(chunk))
+                if splitter is None:
+                    await write_data(chunk)
+                else:
+                    await write_blocks(splitter.feed(chunk))
+
+            start_t = time.time()
+            result = await db_conn.copy_from_query(
+                query, output=write_chunk, format="binary"
+            )
+            if splitter is not None:
+                await write_blocks(splitter.finish())
+        finally:
+            try:
+                compression_time += await loop.run_in_executor(
+                    ctx.compression_executor, close_compressed_file, f_out
+                )
+            finally:
+                # file is closed even if trailer of codec can't be written, e.g. on full disk
+                f_checksum.close()
+
+        if splitter is not None:
+            ctx.logger.debug("Anonymized %s by client engine in %s sec" % (file_name, round(anon_time, 2)))
+        ctx.logger.debug(
+            "Dumped %s: COPY %s sec, compression %s sec"
+            % (file_name, round(time.time() - start_t - compression_time, 2), round(compression_time, 2))
+        )
+        return result, {"sha256": f_checksum.hexdigest(), "size": f_checksum.size, "raw_size": raw_size}
+    except Exception as exc:
+        ctx.logger.error(exc)
+        raise exc
+
+
+async def get_dump_profiles_table(ctx, query: str, db_conn, targets: List[Tuple[Context, str, str]]):
+    """
+    Dump result of query with fields of several profiles into file of each profile.
+    COPY BINARY stream is split into blocks of whole tuples, and each tuple is split by fields of profiles
+    :param targets: list of (context of profile, file name, query of profile), fields of profiles in the query
+                    are in the same order
+    :return: result of COPY and list of dicts with checksum and sizes of files in the same order as targets
+    """
+    try:
+        loop = asyncio.get_event_loop()
+        compression_time = 0.0
+        split_time = 0.0
+        raw_sizes = [0] * len(targets)
+        fields_counts = [profile_ctx.files_query_parts[file_name][2] for profile_ctx, file_name, _ in targets]
+        splitter = CopyBinarySplitter()
+        f_checksums = []
+        f_outs = []
+        try:
+            for profile_ctx, file_name, _ in targets:
+                f_checksums.append(ChecksumWriter(open(os.path.join(profile_ctx.args.output_dir, file_name), "wb")))
+                f_outs.append(
+                    open_codec_writer(
+                        path=None,
+                        codec=ctx.args.output_codec,
+                        level=ctx.args.output_codec_level,
+                        fileobj=f_checksums[-1],
+                    )
+                )
+
+            async def write_parts(parts: List[bytes]):
+                nonlocal compression_time
+                for index, data in enumerate(parts):
+                    raw_sizes[index] += len(data)
+                # files of profiles are compressed in parallel
+                compression_time += max(
+                    await asyncio.gather(
+                        *[
+                            loop.run_in_executor(ctx.compression_executor, compress_chunk, f_out, data)
+                            for f_out, data in zip(f_outs, parts)
+                        ]
+                    )
+                )
+
+            async def write_blocks(blocks: List[Tuple[bytes, bool]]):
+                nonlocal split_time
+                for data, is_tuples in blocks:
+                    if is_tuples:
+                        split_start_t = time.time()
+                        # split is CPU bound python code, so it runs in process pool to avoid the GIL
+                        parts = await loop.run_in_executor(ctx.anon_executor, split_tuples, data, fields_counts)
+                        split_time += time.time() - split_start_t
+                        await write_parts(parts)
+                    else:
+                        # header and trailer of the stream are the same for all profiles
+                        await write_parts([data] * len(targets))
+
+            async def write_chunk(chunk: bytes):
+                if ctx.rate_limiter is not None:
+                    await ctx.rate_limiter.acquire(len(chunk))
+                if ctx.concurrency_tuner is not None:
+                    ctx.concurrency_tuner.add(len(chunk))
+                await write_blocks(splitter.feed(chunk))
+
+            start_t = time.time()
+            result = await db_conn.copy_from_query(
+                query, output=write_chunk, format="binary"
+            )
+            await write_blocks(splitter.finish())
+        finally:
+            try:
+                for f_out in f_outs:
+                    compression_time += await loop.run_in_executor(
+                        ctx.compression_executor, close_compressed_file, f_out
+                    )
+            finally:
+                # files are closed even if trailer of codec can't be written, e.g. on full disk
+                for f_checksum in f_checksums:
+                    f_checksum.close()
+
+        ctx.logger.debug(
+            "Dumped %s for %s profiles: COPY %s sec, split %s sec, compression %s sec"
+            % (
+                targets[0][1],
+                len(targets),
+                round(time.time() - start_t - compression_time - split_time, 2),
+                round(split_time, 2),
+                round(compression_time, 2),
+            )
+        )
+        return result, [
+            {"sha256": f_checksum.hexdigest(), "size": f_checksum.size, "raw_size": raw_size}
+            for f_checksum, raw_size in zip(f_checksums, raw_sizes)
+        ]
     except Exception as exc:
         ctx.logger.error(exc)
         raise exc
 
 
+def get_output_dirs(ctx) -> List[str]:
+    """
+    Get output directories of dump, the first one is --output-dir with metadata.json, others are --stripe-dirs
+    """
+    return [ctx.args.output_dir, *(ctx.args.stripe_dirs or [])]
+
+
+def get_query_hash(query: str, client_rules: Optional[Dict] = None,
+                   domains_mapping_id: Optional[str] = None) -> str:
+    """
+    Get hash of dump task, which is used to check that task is not changed by --resume and --base-dir
+    :param query: query of dump task
+    :param client_rules: rules of --anon-engine=client with key by index of field, they are not a part of query
+    :param domains_mapping_id: id of run, which filled mapping tables of domains joined by query
+    """
+    task = query
+    if client_rules:
+        task += "\n" + repr(sorted(client_rules.items()))
+    if domains_mapping_id:
+        task += "\n" + domains_mapping_id
+    return sha256(task.encode("utf-8")).hexdigest()
+
+
+def is_query_with_domains(ctx, query: str) -> bool:
+    return any(domain_table in query for domain_table in ctx.domain_tables.values())
+
+
+def get_file_query_hash(ctx, file_name: str, query: str) -> str:
+    """
+    Get hash of dump task of file. Mapping tables of domains are filled by new values on each run
+    under the same names, so files, which join them, are not reused from another run
+    """
+    domains_mapping_id = ctx.domains_mapping_id if is_query_with_domains(ctx, query) else None
+    return get_query_hash(query, ctx.files_client_rules.get(file_name), domains_mapping_id)
+
+
+def append_dump_manifest(ctx, file_name: str, query: str, sn_id: str):
+    """
+    Append result of finished dump task to manifest, so interrupted dump can be resumed by --resume
+    :param ctx: context with results of dump tasks
+    :param file_name: name of dumped file
+    :param query: query of dump task, its hash is used to check that task is not changed in resumed dump
+    :param sn_id: snapshot in which the file was dumped
+    """
+    entry = {
+        "file": file_name,
+        "query_hash": get_file_query_hash(ctx, file_name, query),
+        "snapshot": sn_id,
+        **ctx.task_results[file_name],
+    }
+    with open(os.path.join(ctx.args.output_dir, DUMP_MANIFEST_FILE_NAME), "a", encoding="utf-8") as manifest_file:
+        manifest_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+
+
+def read_dump_manifest(ctx) -> Dict[str, Dict]:
+    """
+    Read manifest of previous run of dump in the same output directory
+    :param ctx: context with dump arguments
+    :return: dict of manifest entries with key by file name
+    """
+    manifest = {}
+    manifest_file_name = os.path.join(ctx.args.output_dir, DUMP_MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_file_name):
+        return manifest
+
+    with open(manifest_file_name, "r", encoding="utf-8") as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line can be written partially if dump was killed
+                ctx.logger.warning(f"Skipped broken line of {manifest_file_name}: {line}")
+                continue
+            manifest[entry["file"]] = entry
+    return manifest
+
+
+def skip_dumped_tasks(ctx, queries: Dict[str, str], sn_id: str) -> Dict[str, str]:
+    """
+    Remove tasks which are already dumped according to the manifest of previous run.
+    Results of these tasks are taken from the manifest for metadata.json
+    :param ctx: context with dump arguments
+    :param queries: dict of dump queries with key by file name
+    :param sn_id: snapshot of current run
+    :return: dict of dump queries which must be dumped
+    """
+    manifest = read_dump_manifest(ctx)
+    prev_snapshots = set()
+    remaining_queries = {}
+    for file_name, query in queries.items():
+        entry = manifest.get(file_name)
+        # in archive mode file is a part of segment
+        file_path = os.path.join(
+            get_output_dirs(ctx)[entry.get("stripe", 0)], entry.get("segment", file_name)
+        ) if entry else None
+        if (entry is not None and entry["query_hash"] == get_file_query_hash(ctx, file_name, query)
+                and os.path.exists(file_path)):
+            ctx.task_results[file_name] = {
+                k: v for k, v in entry.items() if k not in ("file", "query_hash", "snapshot")
+            }
+            prev_snapshots.add(entry["snapshot"])
+        else:
+            remaining_queries[file_name] = query
+
+    ctx.logger.info(
+        "Resumed dump: %s files are already dumped, %s files remain"
+        % (len(queries) - len(remaining_queries), len(remaining_queries))
+    )
+    if prev_snapshots - {sn_id}:
+        ctx.logger.warning(
+            "Resumed dump: already dumped files were made in snapshots %s, remaining files are dumped in snapshot %s. "
+            "Data of tables from different snapshots can be inconsistent, for consistent dump resume it "
+            "with --snapshot of still open transaction or run dump from scratch"
+            % (", ".join(sorted(prev_snapshots - {sn_id})), sn_id)
+        )
+    return remaining_queries
+
+
+async def dump_file(ctx, db_conn, task: str, sn_id: str, file_name: str):
+    """
+    Dump one file in already started transaction with exported snapshot and save result of the task
+    """
+    start_t = time.time()
+    location = {}
+    if ctx.archive_segments is None:
+        stripe = ctx.files_stripes.get(file_name, 0)
+        res, file_stats = await get_dump_table(
+            ctx,
+            query=task,
+            file_name=file_name,
+            db_conn=db_conn,
+            output_dir=get_output_dirs(ctx)[stripe],
+        )
+        if stripe:
+            location = {"stripe": stripe}
+    else:
+        # Stream of the table is appended to a free segment, segment has only one writer at a time
+        segment_name, f_segment, stripe = await ctx.archive_segments.get()
+        try:
+            offset = f_segment.tell()
+            res, file_stats = await get_dump_table(
+                ctx,
+                query=task,
+                file_name=file_name,
+                db_conn=db_conn,
+                output_dir=get_output_dirs(ctx)[stripe],
+                fileobj=f_segment,
+            )
+            location = {"segment": segment_name, "offset": offset, "length": f_segment.tell() - offset}
+            if stripe:
+                location["stripe"] = stripe
+            # the stream must be on disk before manifest entry, which is trusted by --resume
+            await asyncio.get_event_loop().run_in_executor(ctx.compression_executor, sync_file, f_segment)
+        finally:
+            ctx.archive_segments.put_nowait((segment_name, f_segment, stripe))
+
+    count_rows = re.findall(r"(\d+)", res)[0]
+    ctx.task_results[file_name] = {
+        **location,
+        **file_stats,
+        "rows": count_rows,
+        "elapsed": round(time.time() - start_t, 2),
+    }
+    ctx.logger.debug("COPY %s [rows] Task: %s " % (count_rows, str(task)))
+    append_dump_manifest(ctx, file_name, task, sn_id)
+
+
+async def retry_on_recovery_conflict(ctx, func, task_name: str):
+    """
+    Run dump task again with exponential backoff, if it is cancelled by conflict with recovery on standby.
+    Task is run in new transaction with the same exported snapshot, so its result is the same.
+    If the session, which exported the snapshot, is terminated too, the snapshot is lost and dump can't be continued
+    :param ctx: context with --task-retries and --task-retry-delay
+    :param func: coroutine function of the task
+    :param task_name: name of task for log
+    """
+    delay = ctx.args.task_retry_delay
+    for attempt in range(1, ctx.args.task_retries + 2):
+        try:
+            return await func()
+        except asyncpg.exceptions.UndefinedObjectError as exc:
+            if "snapshot" not in str(exc):
+                raise
+            raise Exception(
+                "Task %s can't be run: exported snapshot is lost, its session is terminated. "
+                "Run dump with --resume, remaining files are dumped in new snapshot" % task_name
+            ) from exc
+        except RECOVERY_CONFLICT_ERRORS as exc:
+            if attempt > ctx.args.task_retries:
+                raise
+            ctx.logger.warning(
+                "Task %s is cancelled (%s: %s), retry %s of %s in %s sec"
+                % (task_name, type(exc).__name__, exc, attempt, ctx.args.task_retries, delay)
+            )
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
 async def dump_obj_func(ctx, pool, task, sn_id, file_name):
     ctx.logger.info("================> Started task %s" % str(task))
 
-    try:
+    async def dump_task():
         async with pool.acquire() as db_conn:
             async with db_conn.transaction(isolation='repeatable_read', readonly=True):
                 await db_conn.execute("SET TRANSACTION SNAPSHOT '%s';" % sn_id)
-                res = await get_dump_table(
-                    ctx,
-                    query=task,
-                    file_name=file_name,
-                    db_conn=db_conn,
-                    output_dir=ctx.args.output_dir,
-                )
-                count_rows = re.findall(r"(\d+)", res)[0]
-                ctx.task_results[hash(task)] = count_rows
-                ctx.logger.debug("COPY %s [rows] Task: %s " % (count_rows, str(task)))
+                await dump_file(ctx, db_conn, task, sn_id, file_name)
+
+    try:
+        await retry_on_recovery_conflict(ctx, dump_task, file_name)
     except Exception as e:
         ctx.logger.error("Exception in dump_obj_func:\n" + exception_helper())
         raise Exception("Can't execute task: %s" % task)
@@ -121,49 +564,818 @@ async def dump_obj_func(ctx, pool, task, sn_id, file_name):
     ctx.logger.info("<================ Finished task %s" % str(task))
 
 
+async def dump_batch_func(ctx, pool, batch: Dict[str, str], sn_id):
+    """
+    Dump batch of small tables sequentially in one transaction,
+    so pool acquire, transaction and snapshot import are made once for all tables of the batch
+    :param ctx: context with dump arguments
+    :param pool: connection pool
+    :param batch: dict of dump queries with key by file name
+    :param sn_id: exported snapshot
+    """
+    ctx.logger.info("================> Started batch task of %s tables" % len(batch))
+
+    task = None
+
+    async def dump_batch():
+        nonlocal task
+        async with pool.acquire() as db_conn:
+            async with db_conn.transaction(isolation='repeatable_read', readonly=True):
+                await db_conn.execute("SET TRANSACTION SNAPSHOT '%s';" % sn_id)
+                for file_name, task in batch.items():
+                    await dump_file(ctx, db_conn, task, sn_id, file_name)
+
+    try:
+        # the whole batch is dumped again, files of its tables are overwritten
+        await retry_on_recovery_conflict(ctx, dump_batch, "batch of %s tables" % len(batch))
+    except Exception as e:
+        ctx.logger.error("Exception in dump_batch_func:\n" + exception_helper())
+        raise Exception("Can't execute task: %s" % task)
+
+    ctx.logger.info("<================ Finished batch task of %s tables" % len(batch))
+
+
+async def dump_profiles_func(ctx, pool, query: str, sn_id: str, targets: List[Tuple[Context, str, str]]):
+    """
+    Dump table once for several profiles by query with fields of all of them
+    :param ctx: context of dump with profiles
+    :param pool: connection pool
+    :param query: query with fields of all profiles
+    :param sn_id: exported snapshot
+    :param targets: list of (context of profile, file name, query of profile)
+    """
+    ctx.logger.info("================> Started task %s" % str(query))
+
+    async def dump_task():
+        async with pool.acquire() as db_conn:
+            async with db_conn.transaction(isolation='repeatable_read', readonly=True):
+                await db_conn.execute("SET TRANSACTION SNAPSHOT '%s';" % sn_id)
+                start_t = time.time()
+                res, files_stats = await get_dump_profiles_table(ctx, query, db_conn, targets)
+                count_rows = re.findall(r"(\d+)", res)[0]
+                for (profile_ctx, file_name, profile_query), file_stats in zip(targets, files_stats):
+                    profile_ctx.task_results[file_name] = {
+                        **file_stats,
+                        "rows": count_rows,
+                        "elapsed": round(time.time() - start_t, 2),
+                    }
+                    append_dump_manifest(profile_ctx, file_name, profile_query, sn_id)
+
+    try:
+        await retry_on_recovery_conflict(ctx, dump_task, targets[0][1])
+    except Exception as e:
+        ctx.logger.error("Exception in dump_profiles_func:\n" + exception_helper())
+        raise Exception("Can't execute task: %s" % query)
+
+    ctx.logger.info("<================ Finished task %s" % str(query))
+
+
 async def get_tables_to_dump(excluded_schemas: list, db_conn: asyncpg.Connection):
-    excluded_schemas_str = ", ".join(
-        [f"'{v}'" for v in [*excluded_schemas, *DEFAULT_EXCLUDED_SCHEMAS]]
+    query_db_obj = """
+        SELECT n.nspname AS table_schema, c.relname AS table_name, c.relkind
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE
+            n.nspname <> ALL($1::text[]) AND
+            c.relkind IN ('r', 'p') AND
+            c.relpersistence <> 't'
+    """
+    db_objs = await db_conn.fetch(query_db_obj, [*excluded_schemas, *DEFAULT_EXCLUDED_SCHEMAS])
+    return db_objs
+
+
+async def get_partitions(excluded_schemas: list, db_conn: asyncpg.Connection) -> Dict[Tuple[str, str], Dict]:
+    """
+    Get all partitions of partitioned tables, including sub-partitioned ones
+    :param excluded_schemas: schemas which are not dumped
+    :param db_conn: connection with exported snapshot
+    :return: dict of partitions info with key by (schema, table) of partition
+    """
+    query = """
+        WITH RECURSIVE tree AS (
+            SELECT i.inhrelid AS relid, i.inhparent AS parent_relid, i.inhparent AS root_relid
+            FROM pg_inherits i
+            JOIN pg_class r ON r.oid = i.inhparent
+            WHERE r.relkind = 'p' AND NOT r.relispartition
+            UNION ALL
+            SELECT i.inhrelid, i.inhparent, tree.root_relid
+            FROM pg_inherits i
+            JOIN tree ON tree.relid = i.inhparent
+        )
+        SELECT
+            n.nspname AS schema,
+            c.relname AS table,
+            c.relkind,
+            pn.nspname AS parent_schema,
+            p.relname AS parent_table,
+            rn.nspname AS root_schema,
+            r.relname AS root_table
+        FROM tree
+        JOIN pg_class c ON c.oid = tree.relid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_class p ON p.oid = tree.parent_relid
+        JOIN pg_namespace pn ON pn.oid = p.relnamespace
+        JOIN pg_class r ON r.oid = tree.root_relid
+        JOIN pg_namespace rn ON rn.oid = r.relnamespace
+        WHERE rn.nspname <> ALL($1::text[])
+    """
+    partitions = {}
+    for v in await db_conn.fetch(query, [*excluded_schemas, *DEFAULT_EXCLUDED_SCHEMAS]):
+        partitions[(v["schema"], v["table"])] = dict(v)
+    return partitions
+
+
+def get_roots_dumped_whole(ctx, partitions: Dict[Tuple[str, str], Dict]) -> set:
+    """
+    Get partitioned tables which must be dumped by one query through the root table instead of dump of partitions:
+    tables with "raw_sql" rule and tables with not regular partitions (e.g. foreign tables)
+    :param ctx: context with prepared dictionary
+    :param partitions: partitions info from get_partitions()
+    :return: set of (schema, table) of root partitioned tables
+    """
+    roots_dumped_whole = set()
+    for partition in partitions.values():
+        root = (partition["root_schema"], partition["root_table"])
+        root_rule = get_dict_rule_for_table(
+            dictionary_rules=ctx.prepared_dictionary_obj["dictionary"],
+            schema=root[0],
+            table=root[1],
+        )
+        if (root_rule and "raw_sql" in root_rule) or partition["relkind"] not in ("r", "p"):
+            roots_dumped_whole.add(root)
+    return roots_dumped_whole
+
+
+async def get_tables_fields(excluded_schemas: list, db_conn: asyncpg.Connection) -> Dict[Tuple[str, str], List]:
+    """
+    Get fields of all tables by one query instead of query for each table
+    :param excluded_schemas: schemas which are not dumped
+    :param db_conn: connection with exported snapshot
+    :return: dict of fields lists in the same format as db_utils.get_fields_list() with key by (schema, table)
+    """
+    # udt_name is calculated the same way as in information_schema.columns
+    query = """
+        SELECT
+            n.nspname,
+            c.relname,
+            a.attname AS column_name,
+            coalesce(bt.typname, t.typname) AS udt_name
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_type t ON t.oid = a.atttypid
+        LEFT JOIN pg_type bt ON t.typtype = 'd' AND bt.oid = t.typbasetype
+        WHERE
+            a.attnum > 0 AND
+            NOT a.attisdropped AND
+            n.nspname <> ALL($1::text[]) AND
+            c.relkind IN ('r', 'p')
+        ORDER BY n.nspname, c.relname, a.attnum
+    """
+    tables_fields = {}
+    for field in await db_conn.fetch(query, [*excluded_schemas, *DEFAULT_EXCLUDED_SCHEMAS]):
+        tables_fields.setdefault((field["nspname"], field["relname"]), []).append(field)
+    return tables_fields
+
+
+async def get_tables_to_split(ctx, db_conn: asyncpg.Connection) -> Dict[Tuple[str, str], List[str]]:
+    """
+    Get tables which are larger than --split-table-size and conditions of their ctid block ranges.
+    Each range is dumped by own task under the same snapshot
+    :param ctx: context with dump arguments
+    :param db_conn: connection with exported snapshot
+    :return: dict of ctid range conditions with key by (schema, table)
+    """
+    if not ctx.args.split_table_size:
+        return {}
+
+    if (ctx.args.dbg_stage_1_validate_dict
+            or ctx.args.dbg_stage_2_validate_data
+            or ctx.args.dbg_stage_3_validate_full):
+        return {}
+
+    # TID Range Scan is available since PostgreSQL 14, on older versions each range would read the whole table
+    if int(await db_conn.fetchval("SHOW server_version_num")) < 140000:
+        ctx.logger.warning("Option --split-table-size requires PostgreSQL 14 or higher, tables will not be split")
+        return {}
+
+    split_size = ctx.args.split_table_size * 1024 * 1024
+    block_size = int(await db_conn.fetchval("SHOW block_size"))
+    large_tables = await db_conn.fetch(
+        """
+        SELECT n.nspname, c.relname, pg_relation_size(c.oid)
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind = 'r' AND pg_relation_size(c.oid) > $1
+        """,
+        split_size,
+    )
+
+    tables_ranges = {}
+    for table_schema, table_name, table_size in large_tables:
+        blocks = table_size // block_size
+        parts = math.ceil(table_size / split_size)
+        blocks_per_part = math.ceil(blocks / parts)
+        conditions = []
+        for part in range(parts):
+            range_conditions = []
+            if part > 0:
+                range_conditions.append(f"ctid >= '({part * blocks_per_part},0)'::tid")
+            if part < parts - 1:
+                # the last range is open, so it catches all blocks regardless of the measured size
+                range_conditions.append(f"ctid < '({(part + 1) * blocks_per_part},0)'::tid")
+            conditions.append(" AND ".join(range_conditions))
+        tables_ranges[(table_schema, table_name)] = conditions
+
+    return tables_ranges
+
+
+class SubsetGraph(NamedTuple):
+    rules: Dict[Tuple[str, str], Dict]  # "subset" rules of dictionary with key by (schema, table)
+    restricted: Set[Tuple[str, str]]  # tables with rules and tables referenced by them, directly or not
+    filtered: Set[Tuple[str, str]]  # tables referencing restricted tables, directly or not
+    references: Dict[Tuple[str, str], List]  # foreign keys between dumped tables with key by referenced table
+    foreign_keys: Dict[Tuple[str, str], List]  # foreign keys between dumped tables with key by referencing table
+    cycles: Dict[Tuple[str, str], frozenset]  # tables of cycle of foreign keys with key by each table of cycle
+
+
+async def get_foreign_keys(db_conn: asyncpg.Connection) -> List:
+    """
+    Get foreign keys with their columns. Keys of partitioned tables are taken once, without their clones on partitions
+    :param db_conn: connection with exported snapshot
+    :return: list of foreign keys
+    """
+    query = """
+        SELECT
+            cn.nspname AS child_schema,
+            c.relname AS child_table,
+            pn.nspname AS parent_schema,
+            p.relname AS parent_table,
+            array(
+                SELECT a.attname
+                FROM unnest(con.conkey) WITH ORDINALITY AS k(attnum, n)
+                JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+                ORDER BY k.n
+            ) AS child_columns,
+            array(
+                SELECT a.attname
+                FROM unnest(con.confkey) WITH ORDINALITY AS k(attnum, n)
+                JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.attnum
+                ORDER BY k.n
+            ) AS parent_columns
+        FROM pg_constraint con
+        JOIN pg_class c ON c.oid = con.conrelid
+        JOIN pg_namespace cn ON cn.oid = c.relnamespace
+        JOIN pg_class p ON p.oid = con.confrelid
+        JOIN pg_namespace pn ON pn.oid = p.relnamespace
+        WHERE con.contype = 'f' AND con.conparentid = 0
+        ORDER BY con.oid
+    """
+    return await db_conn.fetch(query)
+
+
+def is_table_excluded(ctx, table_schema: str, table_name: str) -> bool:
+    """
+    Check that table is skipped by "dictionary_exclude" the same way as in get_dump_query()
+    """
+    if not ctx.prepared_dictionary_obj.get("dictionary_exclude"):
+        return False
+    if get_dict_rule_for_table(ctx.prepared_dictionary_obj["dictionary"], table_schema, table_name) is not None:
+        return False
+    exclude_rule = get_dict_rule_for_table(ctx.prepared_dictionary_obj["dictionary_exclude"], table_schema, table_name)
+    return exclude_rule is not None
+
+
+async def get_subset_graph(ctx, db_conn, tables: List, partitions: Dict) -> Optional[SubsetGraph]:
+    """
+    Get tables of subset dump by "subset" rules of dictionary and foreign keys between tables.
+    Partitioned tables are handled as a whole by their root tables
+    :param ctx: context with prepared dictionary
+    :param db_conn: connection with exported snapshot
+    :param tables: tables from get_tables_to_dump()
+    :param partitions: partitions info from get_partitions()
+    :return: graph of subset or None, if dictionary has no "subset" rules
+    """
+    if not ctx.prepared_dictionary_obj.get("subset"):
+        return None
+
+    dumped_tables = {
+        (table_schema, table_name)
+        for table_schema, table_name, _ in tables
+        if (table_schema, table_name) not in partitions and not is_table_excluded(ctx, table_schema, table_name)
+    }
+
+    rules = {}
+    raw_sql_tables = set()
+    for table in dumped_tables:
+        table_rule = get_dict_rule_for_table(ctx.prepared_dictionary_obj["dictionary"], *table)
+        if table_rule and "raw_sql" in table_rule:
+            raw_sql_tables.add(table)
+
+        rule = get_dict_rule_for_table(ctx.prepared_dictionary_obj["subset"], *table)
+        if rule is None:
+            continue
+        if "sample" not in rule and "where" not in rule:
+            raise ValueError(f'Subset rule of table "{table[0]}"."{table[1]}" must have "sample" or "where"')
+        if "sample" in rule and not 0 < rule["sample"] <= 1:
+            raise ValueError(f'"sample" of subset rule of table "{table[0]}"."{table[1]}" must be in range (0, 1]')
+        if table in raw_sql_tables:
+            ctx.logger.warning(f'Table "{table[0]}"."{table[1]}" is dumped by "raw_sql", its subset rule is ignored')
+            continue
+        rules[table] = rule
+
+    references = {}
+    foreign_keys = {}
+    for fk in await get_foreign_keys(db_conn):
+        child = (fk["child_schema"], fk["child_table"])
+        parent = (fk["parent_schema"], fk["parent_table"])
+        if child in dumped_tables and parent in dumped_tables:
+            references.setdefault(parent, []).append(fk)
+            foreign_keys.setdefault(child, []).append(fk)
+
+    # Referenced tables are restricted too, they contain only rows referenced by rows of subset
+    restricted = set()
+    tables_to_check = list(rules)
+    while tables_to_check:
+        table = tables_to_check.pop()
+        if table in restricted or table in raw_sql_tables:
+            continue
+        restricted.add(table)
+        tables_to_check.extend((fk["parent_schema"], fk["parent_table"]) for fk in foreign_keys.get(table, []))
+
+    # Referencing tables are filtered, they contain only rows referencing rows of subset
+    filtered = set()
+    tables_to_check = [
+        (fk["child_schema"], fk["child_table"]) for table in restricted for fk in references.get(table, [])
+    ]
+    while tables_to_check:
+        table = tables_to_check.pop()
+        if table in restricted or table in filtered or table in raw_sql_tables:
+            continue
+        filtered.add(table)
+        tables_to_check.extend((fk["child_schema"], fk["child_table"]) for fk in references.get(table, []))
+
+    cycles = get_subset_cycles(restricted | filtered, foreign_keys)
+
+    ctx.logger.info(
+        "Subset: %s tables by rules, %s referenced tables, %s referencing tables, %s tables in cycles"
+        % (len(rules), len(restricted) - len(rules), len(filtered), len(cycles))
     )
-    query_db_obj = f"""
-            SELECT table_schema, table_name
-            FROM information_schema.tables
-            WHERE
-                table_schema not in ({excluded_schemas_str}) and
-                table_type = 'BASE TABLE'
+    return SubsetGraph(
+        rules=rules,
+        restricted=restricted,
+        filtered=filtered,
+        references=references,
+        foreign_keys=foreign_keys,
+        cycles=cycles,
+    )
+
+
+def get_subset_cycles(tables: Set[Tuple[str, str]], foreign_keys: Dict) -> Dict[Tuple[str, str], frozenset]:
+    """
+    Get cycles of foreign keys between tables of subset, including references of tables to themselves.
+    Restricted and filtered tables can't be in one cycle, because parent of restricted table is restricted
+    :param tables: restricted and filtered tables
+    :param foreign_keys: foreign keys with key by referencing table
+    :return: tables of cycle (strongly connected component of graph) with key by each table of cycle
+    """
+    def get_reachable(table):
+        reachable = set()
+        tables_to_check = [table]
+        while tables_to_check:
+            for fk in foreign_keys.get(tables_to_check.pop(), []):
+                parent = (fk["parent_schema"], fk["parent_table"])
+                if parent in tables and parent not in reachable:
+                    reachable.add(parent)
+                    tables_to_check.append(parent)
+        return reachable
+
+    reachable_tables = {table: get_reachable(table) for table in tables}
+    cycles = {}
+    for table, reachable in reachable_tables.items():
+        if table in reachable:
+            cycles[table] = frozenset(other for other in reachable if table in reachable_tables[other])
+    return cycles
+
+
+def get_subset_sample_clause(rule: Dict) -> str:
+    if "sample" not in rule:
+        return ""
+    # blocks are chosen by hash of block number and seed, so they are the same in all queries under the same snapshot,
+    # and only sampled blocks are read
+    return f" TABLESAMPLE SYSTEM ({rule['sample'] * 100}) REPEATABLE ({SUBSET_SAMPLE_SEED})"
+
+
+def get_subset_key_columns(subset: SubsetGraph, table: Tuple[str, str]) -> List[str]:
+    """
+    Get columns of table in foreign keys between tables of subset, only they are selected into CTE of table
+    """
+    columns = []
+    for fk in subset.references.get(table, []):
+        columns.extend(fk["parent_columns"])
+    for fk in subset.foreign_keys.get(table, []):
+        columns.extend(fk["child_columns"])
+    return list(dict.fromkeys(columns))
+
+
+def get_columns_list(columns: List[str], ref: Optional[str] = None) -> str:
+    return ", ".join(f'{ref}."{column}"' if ref else f'"{column}"' for column in columns)
+
+
+def get_fk_join_condition(fk, child_ref: str, parent_ref: str) -> str:
+    return " AND ".join(
+        f'{child_ref}."{child_column}" = {parent_ref}."{parent_column}"'
+        for child_column, parent_column in zip(fk["child_columns"], fk["parent_columns"])
+    )
+
+
+def get_fk_null_condition(fk, child_ref: str) -> str:
+    # foreign key with NULL in any column is not checked (MATCH SIMPLE)
+    return " OR ".join(f'{child_ref}."{child_column}" IS NULL' for child_column in fk["child_columns"])
+
+
+class SubsetCTEs:
+    """
+    Common table expressions of one subquery in condition of subset. Rows of each table of subset are selected once
+    into CTE with key columns of the table, in order of dependencies, and other CTEs refer to it by name.
+    So condition grows linearly with amount of tables, and each table is read once, even with diamonds of foreign keys
+    """
+
+    def __init__(self, subset: SubsetGraph, aliases: itertools.count):
+        self.subset = subset
+        self.aliases = aliases
+        self.names = {}  # name of CTE with key by table, or by cycle for closure of cycle
+        self.ctes = []
+        self.recursive = False
+
+    def get_alias(self) -> str:
+        return f'"pg_anon_subset_{next(self.aliases)}"'
+
+    def get_with_clause(self) -> str:
+        if not self.ctes:
+            return ""
+        return f"WITH {'RECURSIVE ' if self.recursive else ''}{', '.join(self.ctes)} "
+
+    def get_rows(self, table: Tuple[str, str]) -> str:
         """
-    db_objs = await db_conn.fetch(query_db_obj)
-    return db_objs
+        Get CTE with key columns of rows of table, which are in subset
+        :param table: (schema, table) of restricted or filtered table
+        :return: name of CTE
+        """
+        if table in self.names:
+            return self.names[table]
+
+        alias = self.get_alias()
+        select = (
+            f"SELECT {get_columns_list(get_subset_key_columns(self.subset, table), alias)}"
+            f' FROM "{table[0]}"."{table[1]}" AS {alias}'
+        )
+        cycle = self.subset.cycles.get(table)
+        if cycle is not None:
+            closure = self.get_closure(cycle)
+            query = (
+                f"{select} JOIN {closure}"
+                f" ON {alias}.tableoid = {closure}.tableoid AND {alias}.ctid = {closure}.ctid::tid"
+            )
+        elif table in self.subset.restricted:
+            query = " UNION ALL ".join(self.get_selected_rows(table))
+        else:
+            query = f"{select} WHERE {self.get_referencing_condition(table, alias)}"
 
+        name = self.get_alias()
+        self.ctes.append(f"{name} AS ({query})")
+        self.names[table] = name
+        return name
+
+    def get_selected_rows(self, table: Tuple[str, str], row_id: bool = False,
+                          cycle: frozenset = frozenset()) -> List[str]:
+        """
+        Get queries of rows of restricted table: rows matched by subset rule of table
+        and rows referenced by rows of subset in other tables. References inside of cycle are not included
+        :param table: (schema, table) of restricted table
+        :param row_id: select (tableoid, ctid) of rows instead of key columns
+        :param cycle: tables of cycle, which is handled by closure
+        :return: list of queries, rows of table are union of them
+        """
+        def select(alias, sample_clause=""):
+            if row_id:
+                columns = f"{alias}.tableoid, {alias}.ctid::text"
+            else:
+                columns = get_columns_list(get_subset_key_columns(self.subset, table), alias)
+            return f'SELECT {columns} FROM "{table[0]}"."{table[1]}" AS {alias}{sample_clause}'
 
-async def generate_dump_queries(ctx, db_conn):
+        queries = []
+        rule = self.subset.rules.get(table)
+        if rule is not None:
+            query = select(self.get_alias(), get_subset_sample_clause(rule))
+            if "where" in rule:
+                query += f" WHERE ({rule['where']})"
+            queries.append(query)
+
+        for fk in self.subset.references.get(table, []):
+            child = (fk["child_schema"], fk["child_table"])
+            if child in self.subset.filtered or child in cycle:
+                # rows of filtered child reference only rows of subset, cycle is handled by closure
+                continue
+            alias = self.get_alias()
+            if child in self.subset.restricted:
+                queries.append(
+                    f"{select(alias)} WHERE ({get_columns_list(fk['parent_columns'], alias)})"
+                    f" IN (SELECT {get_columns_list(fk['child_columns'])} FROM {self.get_rows(child)})"
+                )
+            else:
+                # child dumped by "raw_sql" is not restricted, so all rows referenced by it are taken
+                child_alias = self.get_alias()
+                queries.append(
+                    f'{select(alias)} WHERE EXISTS (SELECT 1 FROM "{child[0]}"."{child[1]}" AS {child_alias}'
+                    f" WHERE {get_fk_join_condition(fk, child_alias, alias)})"
+                )
+
+        if not queries:
+            queries.append(f"{select(self.get_alias())} WHERE false")
+        return queries
+
+    def get_referencing_condition(self, table: Tuple[str, str], ref: str, cycle: frozenset = frozenset()) -> str:
+        """
+        Get condition of rows of filtered table: rows, which foreign keys are NULL or reference rows of subset.
+        References inside of cycle are not included
+        """
+        conditions = []
+        for fk in self.subset.foreign_keys.get(table, []):
+            parent = (fk["parent_schema"], fk["parent_table"])
+            if parent in cycle or (parent not in self.subset.restricted and parent not in self.subset.filtered):
+                continue
+            conditions.append(
+                f"{get_fk_null_condition(fk, ref)} OR ({get_columns_list(fk['child_columns'], ref)})"
+                f" IN (SELECT {get_columns_list(fk['parent_columns'])} FROM {self.get_rows(parent)})"
+            )
+
+        if not conditions:
+            return "true"
+        return " AND ".join(f"({condition})" for condition in conditions)
+
+    def get_closure(self, cycle: frozenset) -> str:
+        """
+        Get recursive CTE of rows of all tables of cycle, which are in subset, as (tableoid, ctid).
+        For restricted tables closure starts from selected rows and adds rows referenced by rows of closure.
+        For filtered tables closure starts from rows, which don't reference rows of cycle,
+        and adds rows referencing rows of closure. Such rows must not reference other rows of cycle,
+        so rows with several not NULL references inside of cycle are not dumped
+        :param cycle: tables of cycle
+        :return: name of CTE
+        """
+        if cycle in self.names:
+            return self.names[cycle]
+
+        closure = self.get_alias()
+        is_restricted = next(iter(cycle)) in self.subset.restricted
+        cycle_fks = {
+            table: [fk for fk in self.subset.foreign_keys.get(table, [])
+                    if (fk["parent_schema"], fk["parent_table"]) in cycle]
+            for table in sorted(cycle)
+        }
+
+        seeds = []
+        steps = []
+        for table, fks in cycle_fks.items():
+            # ctid is kept as text, because recursive UNION needs hashable types, and old versions can't hash tid.
+            # It is converted back to tid in steps of closure, so rows of closure are fetched by TID Scan
+            if is_restricted:
+                seeds.extend(self.get_selected_rows(table, row_id=True, cycle=cycle))
+            else:
+                alias = self.get_alias()
+                seed_condition = self.get_referencing_condition(table, alias, cycle)
+                seed_condition += "".join(f" AND ({get_fk_null_condition(fk, alias)})" for fk in fks)
+                seeds.append(
+                    f'SELECT {alias}.tableoid, {alias}.ctid::text FROM "{table[0]}"."{table[1]}" AS {alias}'
+                    f" WHERE {seed_condition}"
+                )
+
+            for fk in fks:
+                parent = (fk["parent_schema"], fk["parent_table"])
+                child_alias = self.get_alias()
+                parent_alias = self.get_alias()
+                join = (
+                    f'FROM "{table[0]}"."{table[1]}" AS {child_alias}'
+                    f' JOIN "{parent[0]}"."{parent[1]}" AS {parent_alias}'
+                    f" ON {get_fk_join_condition(fk, child_alias, parent_alias)}"
+                )
+                if is_restricted:
+                    steps.append(
+                        f"SELECT {parent_alias}.tableoid, {parent_alias}.ctid::text {join}"
+                        f" WHERE {child_alias}.tableoid = {closure}.tableoid"
+                        f" AND {child_alias}.ctid = {closure}.ctid::tid"
+                    )
+                else:
+                    step_condition = self.get_referencing_condition(table, child_alias, cycle)
+                    step_condition += "".join(
+                        f" AND ({get_fk_null_condition(other_fk, child_alias)})"
+                        for other_fk in fks if other_fk is not fk
+                    )
+                    steps.append(
+                        f"SELECT {child_alias}.tableoid, {child_alias}.ctid::text {join}"
+                        f" WHERE {parent_alias}.tableoid = {closure}.tableoid"
+                        f" AND {parent_alias}.ctid = {closure}.ctid::tid AND {step_condition}"
+                    )
+
+        step_alias = self.get_alias()
+        self.ctes.append(
+            f"{closure}(tableoid, ctid) AS ("
+            f"{' UNION '.join(seeds)}"
+            f" UNION SELECT {step_alias}.tableoid, {step_alias}.ctid FROM {closure}"
+            f" CROSS JOIN LATERAL ({' UNION ALL '.join(steps)}) AS {step_alias})"
+        )
+        self.recursive = True
+        self.names[cycle] = closure
+        return closure
+
+
+def get_subset_condition(subset: SubsetGraph, table: Tuple[str, str], ref: str) -> str:
+    """
+    Get condition of rows of table, which are in subset.
+    Restricted table contains rows matched by subset rule of table and rows referenced by rows of subset,
+    filtered table contains rows, which foreign keys to restricted and filtered tables are NULL
+    or reference rows of subset. Each subquery of condition selects rows of other tables by own SubsetCTEs
+    :param subset: graph of subset from get_subset_graph()
+    :param table: (schema, table) of restricted or filtered table, root table for partitions
+    :param ref: name of dumped table in query, partition for partitioned table
+    :return: SQL condition
+    """
+    aliases = itertools.count(1)
+
+    cycle = subset.cycles.get(table)
+    if cycle is not None:
+        ctes = SubsetCTEs(subset, aliases)
+        closure = ctes.get_closure(cycle)
+        # rows of closure are fetched by TID Scan
+        return (
+            f"{ref}.ctid = ANY (ARRAY({ctes.get_with_clause()}SELECT ctid::tid FROM {closure}"
+            f" WHERE tableoid = '{ref.replace(chr(39), chr(39) * 2)}'::regclass))"
+        )
+
+    conditions = []
+    if table in subset.restricted:
+        for fk in subset.references.get(table, []):
+            child = (fk["child_schema"], fk["child_table"])
+            if child in subset.filtered:
+                continue
+            if child in subset.restricted:
+                ctes = SubsetCTEs(subset, aliases)
+                rows = ctes.get_rows(child)
+                conditions.append(
+                    f"({get_columns_list(fk['parent_columns'], ref)}) IN ("
+                    f"{ctes.get_with_clause()}SELECT {get_columns_list(fk['child_columns'])} FROM {rows})"
+                )
+            else:
+                # child dumped by "raw_sql" is not restricted, so all rows referenced by it are taken
+                alias = f'"pg_anon_subset_{next(aliases)}"'
+                conditions.append(
+                    f'EXISTS (SELECT 1 FROM "{child[0]}"."{child[1]}" AS {alias}'
+                    f" WHERE {get_fk_join_condition(fk, alias, ref)})"
+                )
+
+        rule = subset.rules.get(table)
+        if rule is not None:
+            rule_conditions = []
+            if "sample" in rule:
+                alias = f'"pg_anon_subset_{next(aliases)}"'
+                sample = f"FROM {ref} AS {alias}{get_subset_sample_clause(rule)}"
+                if conditions:
+                    rule_conditions.append(f"{ref}.ctid::text IN (SELECT {alias}.ctid::text {sample})")
+                else:
+                    # table is restricted only by rule, so sampled rows are fetched by TID Scan
+                    rule_conditions.append(f"{ref}.ctid = ANY (ARRAY(SELECT {alias}.ctid {sample}))")
+            if "where" in rule:
+                rule_conditions.append(f"({rule['where']})")
+            conditions.insert(0, " AND ".join(rule_conditions))
+
+        if not conditions:
+            return "false"
+        return " OR ".join(f"({condition})" for condition in conditions)
+
+    for fk in subset.foreign_keys.get(table, []):
+        parent = (fk["parent_schema"], fk["parent_table"])
+        if parent not in subset.restricted and parent not in subset.filtered:
+            continue
+        ctes = SubsetCTEs(subset, aliases)
+        rows = ctes.get_rows(parent)
+        conditions.append(
+            f"{get_fk_null_condition(fk, ref)} OR ({get_columns_list(fk['child_columns'], ref)}) IN ("
+            f"{ctes.get_with_clause()}SELECT {get_columns_list(fk['parent_columns'])} FROM {rows})"
+        )
+
+    if not conditions:
+        return "true"
+    return " AND ".join(f"({condition})" for condition in conditions)
+
+
+async def generate_dump_queries(ctx, db_conn, partitions: Optional[Dict] = None):
     tables = await get_tables_to_dump(
         excluded_schemas=ctx.exclude_schemas, db_conn=db_conn
     )
-    queries = []
+    if partitions is None:
+        partitions = await get_partitions(excluded_schemas=ctx.exclude_schemas, db_conn=db_conn)
+    roots_dumped_whole = get_roots_dumped_whole(ctx, partitions)
+    tables_fields = await get_tables_fields(
+        excluded_schemas=ctx.exclude_schemas, db_conn=db_conn
+    )
+    tables_ranges = await get_tables_to_split(ctx, db_conn)
+    subset = await get_subset_graph(ctx, db_conn, tables, partitions)
+    queries = {}
     files = {}
 
     included_objs = []  # for debug purposes
     excluded_objs = []  # for debug purposes
 
-    for table_schema, table_name in tables:
+    for table_schema, table_name, relkind in tables:
         table_rule = get_dict_rule_for_table(
             dictionary_rules=ctx.prepared_dictionary_obj["dictionary"],
             schema=table_schema,
             table=table_name,
         )
+
+        # Partitioned table is dumped by its leaf partitions in parallel tasks,
+        # and they are restored straight into the leaves without tuple routing through the root
+        partition = partitions.get((table_schema, table_name))
+        if partition is not None:
+            root = (partition["root_schema"], partition["root_table"])
+            if root in roots_dumped_whole or relkind == "p":
+                continue
+
+            root_rule = get_dict_rule_for_table(
+                dictionary_rules=ctx.prepared_dictionary_obj["dictionary"],
+                schema=root[0],
+                table=root[1],
+            )
+            if table_rule is None and root_rule is None and ctx.prepared_dictionary_obj.get("dictionary_exclude"):
+                root_exclude_rule = get_dict_rule_for_table(
+                    dictionary_rules=ctx.prepared_dictionary_obj["dictionary_exclude"],
+                    schema=root[0],
+                    table=root[1],
+                )
+                if root_exclude_rule is not None:
+                    excluded_objs.append([root_exclude_rule, table_schema, table_name, "partition of excluded table"])
+                    ctx.logger.info(f'Skipping: "{table_schema}"."{table_name}"')
+                    continue
+            if table_rule is None:
+                table_rule = root_rule
+        elif relkind == "p" and (table_schema, table_name) not in roots_dumped_whole:
+            ctx.logger.debug(f'Partitioned table "{table_schema}"."{table_name}" is dumped by its partitions')
+            continue
+
+        subset_condition = None
+        subset_table = (partition["root_schema"], partition["root_table"]) if partition else (table_schema, table_name)
+        if subset is not None and (subset_table in subset.restricted or subset_table in subset.filtered):
+            subset_condition = get_subset_condition(subset, subset_table, f'"{table_schema}"."{table_name}"')
+
+        table_files = {}
         query = await get_dump_query(
             ctx=ctx,
             table_schema=table_schema,
             table_name=table_name,
             table_rule=table_rule,
-            files=files,
+            files=table_files,
             included_objs=included_objs,
-            excluded_objs=excluded_objs
+            excluded_objs=excluded_objs,
+            fields_list=tables_fields.get((table_schema, table_name), []),
+            subset_condition=subset_condition,
         )
-        if query:
+        if not query:
+            continue
+
+        file_name, file_info = table_files.popitem()
+        client_rules = file_info.pop("client_rules", None)
+        query_parts = file_info.pop("query_parts", None)
+        if partition is not None:
+            file_info["partition_root"] = {"schema": partition["root_schema"], "table": partition["root_table"]}
+        if subset_condition:
+            file_info["subset"] = True
+        ranges = tables_ranges.get((table_schema, table_name))
+        if ranges and not (table_rule and "raw_sql" in table_rule):
+            # the table is dumped by parts, each part into own file
+            file_base_name, file_ext = file_name.split(".", 1)
+            for part, condition in enumerate(ranges, start=1):
+                part_file_name = f"{file_base_name}_part_{part}.{file_ext}"
+                files[part_file_name] = {**file_info, "part": part, "parts": len(ranges)}
+                queries[part_file_name] = f"{query} {'AND' if subset_condition else 'WHERE'} {condition}"
+                if client_rules:
+                    ctx.files_client_rules[part_file_name] = client_rules
+                if query_parts:
+                    select_list, from_clause, fields_count = query_parts
+                    ctx.files_query_parts[part_file_name] = (
+                        select_list,
+                        f"{from_clause} {'AND' if subset_condition else 'WHERE'} {condition}",
+                        fields_count,
+                    )
+                ctx.logger.info(str(queries[part_file_name]))
+        else:
+            files[file_name] = file_info
+            queries[file_name] = query
+            if client_rules:
+                ctx.files_client_rules[file_name] = client_rules
+            if query_parts:
+                ctx.files_query_parts[file_name] = query_parts
             ctx.logger.info(str(query))
-            queries.append(query)
 
     if ctx.args.verbose == VerboseOptions.DEBUG:
         ctx.logger.debug("included_objs:\n" + json.dumps(included_objs, indent=4))
@@ -172,75 +1384,959 @@ async def generate_dump_queries(ctx, db_conn):
     return queries, files
 
 
-async def make_dump_impl(ctx, db_conn, sn_id):
-    loop = asyncio.get_event_loop()
-    tasks = set()
-    pool = await asyncpg.create_pool(
-        **ctx.conn_params, min_size=ctx.args.threads, max_size=ctx.args.threads
+def read_prev_dump_durations(ctx) -> Dict[Tuple[str, str, int], float]:
+    """
+    Read durations of dump tasks from metadata.json of previous dump
+    :param ctx: context with --prev-dump-dir argument
+    :return: dict of durations in seconds with key by (schema, table, part)
+    """
+    if not ctx.args.prev_dump_dir:
+        return {}
+
+    metadata_file_name = os.path.join(ctx.args.prev_dump_dir, "metadata.json")
+    if not os.path.exists(metadata_file_name):
+        ctx.logger.warning(f"File {metadata_file_name} is not found, dump tasks will be ordered by tables sizes")
+        return {}
+
+    with open(metadata_file_name, "r", encoding="utf-8") as metadata_file:
+        prev_metadata = json.loads(metadata_file.read())
+
+    durations = {}
+    for file_info in prev_metadata.get("files", {}).values():
+        if "elapsed" in file_info:
+            key = (file_info["schema"], file_info["table"], file_info.get("part", 1))
+            durations[key] = float(file_info["elapsed"])
+    return durations
+
+
+async def get_tables_signatures(db_conn: asyncpg.Connection) -> Dict[Tuple[str, str], Optional[str]]:
+    """
+    Get change signatures of tables. Signature is changed by any insert, update, delete or rewrite of table.
+    Must be read before export of the snapshot, then changes made between reading and export
+    only lead to extra dump of the table in the next incremental dump
+    :param db_conn: connection to source database
+    :return: dict of signatures with key by (schema, table), signature is None if it is unknown
+    """
+    # Statistics is not collected for partitioned tables themselves, so they are always dumped
+    query = """
+        SELECT
+            n.nspname,
+            c.relname,
+            CASE WHEN c.relkind = 'r' AND s.relid IS NOT NULL
+                THEN concat_ws(':', c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del)
+            END AS signature
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.relkind IN ('r', 'p')
+        """
+    return {(v[0], v[1]): v[2] for v in await db_conn.fetch(query)}
+
+
+def link_unchanged_files(ctx, queries: Dict[str, str], files: Dict) -> Dict[str, str]:
+    """
+    Reference files of tables which are not changed since dump in --base-dir instead of dumping them again.
+    Files are hard linked, or copied if base dump is on another file system
+    :param ctx: context with dump arguments
+    :param queries: dict of dump queries with key by file name
+    :param files: dict of files info with key by file name, which contains signatures of tables
+    :return: dict of dump queries which must be dumped
+    """
+    metadata_file_name = os.path.join(ctx.args.base_dir, "metadata.json")
+    if not os.path.exists(metadata_file_name):
+        ctx.logger.warning(f"File {metadata_file_name} is not found, all tables will be dumped")
+        return queries
+
+    with open(metadata_file_name, "r", encoding="utf-8") as metadata_file:
+        base_metadata = json.loads(metadata_file.read())
+    base_files = base_metadata.get("files", {})
+    base_dirs = [ctx.args.base_dir, *base_metadata.get("stripe_dirs", [])]
+
+    remaining_queries = {}
+    for file_name, query in queries.items():
+        base_file_info = base_files.get(file_name)
+        base_file_path = os.path.join(base_dirs[base_file_info.get("stripe", 0)], file_name) if base_file_info else None
+        if (base_file_info is None
+                or "segment" in base_file_info  # file in archive segment can't be linked
+                or files[file_name]["signature"] is None
+                or base_file_info.get("signature") != files[file_name]["signature"]
+                or base_file_info.get("query_hash") != files[file_name]["query_hash"]
+                or not os.path.exists(base_file_path)):
+            remaining_queries[file_name] = query
+            continue
+
+        file_path = os.path.join(ctx.args.output_dir, file_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(base_file_path, file_path)
+        except OSError:
+            shutil.copy2(base_file_path, file_path)
+        ctx.task_results[file_name] = {
+            k: base_file_info[k] for k in ("sha256", "size", "raw_size", "rows", "elapsed") if k in base_file_info
+        }
+        ctx.logger.debug(f"Table {files[file_name]['schema']}.{files[file_name]['table']} is not changed, "
+                         f"file {file_name} is taken from {ctx.args.base_dir}")
+
+    ctx.logger.info(
+        "Incremental dump: %s files are taken from %s, %s files will be dumped"
+        % (len(queries) - len(remaining_queries), ctx.args.base_dir, len(remaining_queries))
     )
+    return remaining_queries
 
-    queries, files = await generate_dump_queries(ctx, db_conn)
-    if not queries:
-        await pool.close()
-        raise Exception("No objects for dump!")
 
-    zipped_list = list(zip([hash(v) for v in queries], files))
+async def order_dump_tasks(ctx, db_conn, queries: Dict[str, str], files: Dict) -> Dict[str, str]:
+    """
+    Order dump tasks largest first (LPT scheduling), so the largest tables do not start at the end of the dump.
+    Weight of task is table size, or duration of the same task in previous dump if --prev-dump-dir is specified
+    :param ctx: context with dump arguments
+    :param db_conn: connection with exported snapshot
+    :param queries: dict of dump queries with key by file name
+    :param files: dict of files info with key by file name
+    :return: ordered dict of dump queries with key by file name
+    """
+    weights = await get_dump_tasks_weights(ctx, db_conn, files)
+    ordered_file_names = sorted(queries.keys(), key=lambda v: weights[v], reverse=True)
 
-    for file_name, query in zip(files.keys(), queries):
-        if len(tasks) >= ctx.args.threads:
-            # Wait for some dump to finish before adding a new one
-            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-            exception = done.pop().exception()
-            if exception is not None:
-                await pool.close()
-                raise exception
-        tasks.add(loop.create_task(dump_obj_func(ctx, pool, query, sn_id, file_name)))
+    if ctx.args.verbose == VerboseOptions.DEBUG:
+        plan = [
+            [file_name, files[file_name]["schema"], files[file_name]["table"], weights[file_name][0]]
+            for file_name in ordered_file_names
+        ]
+        ctx.logger.debug(
+            "Dump plan (%s):\n%s"
+            % ("seconds by previous dump" if ctx.args.prev_dump_dir else "bytes",
+               json.dumps(plan, indent=4, ensure_ascii=False))
+        )
+
+    return {file_name: queries[file_name] for file_name in ordered_file_names}
+
+
+async def get_dump_tasks_weights(ctx, db_conn, files: Dict) -> Dict[str, Tuple[float, float]]:
+    """
+    Get expected weights of dump tasks: table size and amount of rows, both divided by amount of table parts.
+    If --prev-dump-dir is specified, then duration of the same task in previous dump is used instead of size
+    :param ctx: context with dump arguments
+    :param db_conn: connection with exported snapshot
+    :param files: dict of files info with key by file name
+    :return: dict of weights with key by file name
+    """
+    tables_sizes = {}
+    for table_schema, table_name, table_size, reltuples in await db_conn.fetch(
+        """
+        SELECT n.nspname, c.relname, pg_table_size(c.oid), c.reltuples
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p')
+        """
+    ):
+        tables_sizes[(table_schema, table_name)] = (table_size, reltuples)
+
+    weights = {}
+    for file_name, file_info in files.items():
+        table_size, reltuples = tables_sizes.get((file_info["schema"], file_info["table"]), (0, 0))
+        parts = file_info.get("parts", 1)
+        weights[file_name] = (table_size / parts, reltuples / parts)
+
+    prev_durations = read_prev_dump_durations(ctx)
+    if prev_durations:
+        # tasks without previous duration get estimation by average throughput of previous dump
+        known_size = 0
+        known_duration = 0.0
+        for file_name, file_info in files.items():
+            key = (file_info["schema"], file_info["table"], file_info.get("part", 1))
+            if key in prev_durations:
+                known_size += weights[file_name][0]
+                known_duration += prev_durations[key]
+        throughput = known_size / known_duration if known_duration > 0 else 0
+
+        for file_name, file_info in files.items():
+            key = (file_info["schema"], file_info["table"], file_info.get("part", 1))
+            table_size, reltuples = weights[file_name]
+            if key in prev_durations:
+                weights[file_name] = (prev_durations[key], reltuples)
+            elif throughput > 0:
+                weights[file_name] = (table_size / throughput, reltuples)
+
+    return weights
+
+
+async def distribute_files_by_stripes(ctx, db_conn, queries: Dict[str, str], files: Dict):
+    """
+    Distribute files of dump tasks over --output-dir and --stripe-dirs, so each directory gets about the same
+    expected amount of data. Files are taken largest first and each one is placed into the least loaded directory
+    :param ctx: context with dump arguments
+    :param db_conn: connection with exported snapshot
+    :param queries: dict of dump queries with key by file name
+    :param files: dict of files info with key by file name
+    """
+    weights = await get_dump_tasks_weights(ctx, db_conn, files)
+    stripes_load = [0.0] * len(get_output_dirs(ctx))
+    for file_name in sorted(queries.keys(), key=lambda v: weights[v], reverse=True):
+        stripe = stripes_load.index(min(stripes_load))
+        # empty tables have zero weight, they are distributed evenly anyway
+        stripes_load[stripe] += max(weights[file_name][0], 1)
+        ctx.files_stripes[file_name] = stripe
+
+    ctx.logger.debug("Expected load of output directories: %s" % stripes_load)
+
+
+async def make_dump_batches(ctx, db_conn, queries: Dict[str, str], files: Dict) -> List[Dict[str, str]]:
+    """
+    Group dump tasks of tables smaller than --batch-table-size into batches of up to --batch-tables tasks.
+    Tables dumped by parts are not batched. Number of batch is saved in files info for restore
+    :param ctx: context with dump arguments
+    :param db_conn: connection with exported snapshot
+    :param queries: ordered dict of dump queries with key by file name
+    :param files: dict of files info with key by file name
+    :return: list of dump tasks, each task is dict of dump queries with key by file name,
+             task with one query is dumped by dump_obj_func(), other ones by dump_batch_func()
+    """
+    if not ctx.args.batch_table_size:
+        return [{file_name: query} for file_name, query in queries.items()]
+
+    small_tables = set()
+    for table_schema, table_name in await db_conn.fetch(
+        """
+        SELECT n.nspname, c.relname
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE
+            (n.nspname, c.relname) IN (SELECT * FROM unnest($1::text[], $2::text[]))
+            AND pg_table_size(c.oid) < $3::bigint * 1024
+        """,
+        *get_files_tables(files),
+        ctx.args.batch_table_size,
+    ):
+        small_tables.add((table_schema, table_name))
+
+    tasks = []
+    batch = {}
+    for file_name, query in queries.items():
+        file_info = files[file_name]
+        if "parts" in file_info or (file_info["schema"], file_info["table"]) not in small_tables:
+            tasks.append({file_name: query})
+            continue
+
+        batch[file_name] = query
+        if len(batch) >= ctx.args.batch_tables:
+            tasks.append(batch)
+            batch = {}
+    if batch:
+        tasks.append(batch)
+
+    batches_count = 0
+    for task in tasks:
+        if len(task) > 1:
+            batches_count += 1
+            for file_name in task:
+                files[file_name]["batch"] = batches_count
+
+    ctx.logger.info(
+        "%s small tables are grouped into %s batches"
+        % (sum(len(task) for task in tasks if len(task) > 1), batches_count)
+    )
+    return tasks
+
+
+def open_archive_segments(ctx) -> List[str]:
+    """
+    Open segments of archive for appending of tables streams, by --archive-segments
+    :param ctx: context with dump arguments
+    :return: list of segments names
+    """
+    segments_names = [f"segment_{n}.seg" for n in range(1, ctx.args.archive_segments + 1)]
+    output_dirs = get_output_dirs(ctx)
+    ctx.archive_segments = asyncio.Queue()
+    for n, segment_name in enumerate(segments_names):
+        # segments are spread over --stripe-dirs round-robin,
+        # segment is opened for appending, so segments of interrupted dump are continued by --resume
+        stripe = n % len(output_dirs)
+        ctx.archive_segments.put_nowait(
+            (segment_name, open(os.path.join(output_dirs[stripe], segment_name), "ab"), stripe)
+        )
+    return segments_names
+
+
+def close_archive_segments(ctx):
+    if ctx.archive_segments is None:
+        return
+    while not ctx.archive_segments.empty():
+        _, f_segment, _ = ctx.archive_segments.get_nowait()
+        f_segment.close()
+    ctx.archive_segments = None
+
+
+def get_files_tables(files: Dict) -> Tuple[List[str], List[str]]:
+    """
+    Get distinct tables of dump files as two arrays for unnest() in queries
+    :param files: dict of files info with key by file name
+    :return: list of schemas and list of tables, where items with the same index make a table
+    """
+    tables = {(v["schema"], v["table"]) for v in files.values()}
+    return [schema for schema, _ in tables], [table for _, table in tables]
 
-    # Wait for the remaining dumps to finish
-    await asyncio.wait(tasks)
-    await pool.close()
 
-    # Generate metadata.json
+async def get_seq_lastvals(ctx, db_conn, files: Dict) -> Dict:
+    """
+    Get last values of sequences owned by columns of dumped tables by one query
+    :param ctx: context with dump arguments
+    :param db_conn: connection with exported snapshot
+    :param files: dict of files info with key by file name
+    :return: dict of sequences info for metadata.json with key by "schema.sequence"
+    """
+    # pg_sequences.last_value is NULL if the sequence was never called, then it has start value
     query = """
         SELECT
             pn_t.nspname,
             t.relname AS table_name,
             a.attname AS column_name,
             pn_s.nspname,
-            s.relname AS sequence_name
+            s.relname AS sequence_name,
+            coalesce(ps.last_value, ps.start_value) AS last_value
         FROM pg_class AS t
         JOIN pg_attribute AS a ON a.attrelid = t.oid
         JOIN pg_depend AS d ON d.refobjid = t.oid AND d.refobjsubid = a.attnum
         JOIN pg_class AS s ON s.oid = d.objid
         JOIN pg_namespace AS pn_t ON pn_t.oid = t.relnamespace
         JOIN pg_namespace AS pn_s ON pn_s.oid = s.relnamespace
+        JOIN pg_sequences AS ps ON ps.schemaname = pn_s.nspname AND ps.sequencename = s.relname
         WHERE
             t.relkind IN ('r', 'p')
             AND s.relkind = 'S'
             AND d.deptype = 'a'
             AND d.classid = 'pg_catalog.pg_class'::regclass
             AND d.refclassid = 'pg_catalog.pg_class'::regclass
+            AND (pn_t.nspname, t.relname) IN (SELECT * FROM unnest($1::text[], $2::text[]))
         """
     ctx.logger.debug(str(query))
 
-    seq_res = await db_conn.fetch(query)
     seq_res_dict = {}
-    for v in seq_res:
-        seq_name = v[3] + "." + v[4]
-        seq_val = await db_conn.fetchval(
-            f'select last_value from "{v[3]}"."{v[4]}"'
-        )
+    for v in await db_conn.fetch(query, *get_files_tables(files)):
+        seq_val = v[5]
         if ((ctx.args.dbg_stage_2_validate_data or ctx.args.dbg_stage_3_validate_full)
                 and seq_val > int(ctx.validate_limit.split()[1])):
             seq_val = 100
 
-        for _, f in files.items():
-            if v[0] == f["schema"] and v[1] == f["table"]:
-                seq_res_dict[seq_name] = {
-                    "schema": v[3],
-                    "seq_name": v[4],
-                    "value": seq_val,
-                }
+        seq_res_dict[v[3] + "." + v[4]] = {
+            "schema": v[3],
+            "seq_name": v[4],
+            "value": seq_val,
+        }
+    return seq_res_dict
+
+
+async def get_tables_total_size(db_conn, files: Dict) -> int:
+    """
+    Get total size of dumped tables by one query, table dumped by parts is counted once
+    :param db_conn: connection with exported snapshot
+    :param files: dict of files info with key by file name
+    :return: sum of pg_total_relation_size() of tables
+    """
+    return await db_conn.fetchval(
+        """
+        SELECT coalesce(sum(pg_total_relation_size(c.oid)), 0)::bigint
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE (n.nspname, c.relname) IN (SELECT * FROM unnest($1::text[], $2::text[]))
+        """,
+        *get_files_tables(files),
+    )
+
+
+async def explain_dump_query(pool, query: str) -> Dict:
+    """
+    Plan dump query without its execution
+    :param pool: pool of connections to source database
+    :param query: dump query
+    :return: dict with estimated cost and amount of rows, or with error if query is not valid
+    """
+    try:
+        async with pool.acquire() as db_conn:
+            plan = json.loads(await db_conn.fetchval("EXPLAIN (FORMAT JSON) " + query))[0]["Plan"]
+        return {"cost": plan["Total Cost"], "rows": plan["Plan Rows"]}
+    except Exception as exc:
+        return {"error": str(exc).strip()}
+
+
+async def validate_dump_queries(ctx, pool, queries: Dict[str, str], files: Dict):
+    """
+    Validate dictionary by EXPLAIN of all dump queries in parallel by --threads connections.
+    Queries are parsed and planned by database, but anon functions are not executed and no data is read
+    :param ctx: context with dump arguments
+    :param pool: pool of connections to source database
+    :param queries: dict of dump queries with key by file name
+    :param files: dict of files info with key by file name
+    """
+    plans = await asyncio.gather(*[explain_dump_query(pool, query) for query in queries.values()])
+
+    failed = 0
+    for file_name, plan in zip(queries.keys(), plans):
+        table_name_full = f'"{files[file_name]["schema"]}"."{files[file_name]["table"]}"'
+        if "error" in plan:
+            failed += 1
+            ctx.logger.error(
+                "Validation of %s failed: %s\nQuery: %s" % (table_name_full, plan["error"], queries[file_name])
+            )
+        else:
+            ctx.logger.info(
+                "Validated %s: estimated rows %s, cost %s" % (table_name_full, plan["rows"], plan["cost"])
+            )
+
+    ctx.logger.info(
+        "Validated %s tables by EXPLAIN, %s tables failed" % (len(queries), failed)
+    )
+    if failed:
+        raise Exception("Dictionary validation failed for %s tables" % failed)
+
+
+async def get_domains_columns(ctx, db_conn) -> Dict[str, List[Tuple[str, str, str]]]:
+    """
+    Find fields of dumped tables, which are anonymized by value domains of dictionary
+    :param ctx: context with prepared dictionary
+    :param db_conn: connection to source database
+    :return: dict of (schema, table, column) lists with key by domain name
+    """
+    tables = await get_tables_to_dump(excluded_schemas=ctx.exclude_schemas, db_conn=db_conn)
+    tables_fields = await get_tables_fields(excluded_schemas=ctx.exclude_schemas, db_conn=db_conn)
+
+    domains_columns = {domain_name: [] for domain_name in ctx.prepared_dictionary_obj["domains"]}
+    for table_schema, table_name, _ in tables:
+        # partitions without own rules are read through the partitioned table with the rule
+        table_rule = get_dict_rule_for_table(
+            dictionary_rules=ctx.prepared_dictionary_obj["dictionary"],
+            schema=table_schema,
+            table=table_name,
+        )
+        if table_rule is None or "raw_sql" in table_rule:
+            continue
+
+        for column_info in tables_fields.get((table_schema, table_name), []):
+            fld_val = table_rule.get("fields", {}).get(column_info["column_name"])
+            if fld_val is not None and fld_val.find("DOMAIN:") == 0 and fld_val[7:].strip() in domains_columns:
+                domains_columns[fld_val[7:].strip()].append((table_schema, table_name, column_info["column_name"]))
+    return domains_columns
+
+
+async def get_columns_distinct_values(db_conn, columns: List[Tuple[str, str, str]]) -> Optional[Tuple[float, float]]:
+    """
+    Estimate amount of rows and distinct values of columns by pg_class.reltuples and pg_stats.n_distinct
+    :param db_conn: connection to source database
+    :param columns: list of (schema, table, column)
+    :return: sum of rows and sum of distinct values of columns, or None if some columns are not analyzed
+    """
+    stats = await db_conn.fetch(
+        """
+        SELECT c.reltuples, s.n_distinct
+        FROM unnest($1::text[], $2::text[], $3::text[]) AS v(schema_name, table_name, column_name)
+        LEFT JOIN pg_namespace n ON n.nspname = v.schema_name
+        LEFT JOIN pg_class c ON c.relnamespace = n.oid AND c.relname = v.table_name
+        LEFT JOIN pg_stats s ON s.schemaname = v.schema_name AND s.tablename = v.table_name
+            AND s.attname = v.column_name AND s.inherited = (c.relkind = 'p')
+        """,
+        *[list(v) for v in zip(*columns)],
+    )
+    total_rows = 0.0
+    total_distinct = 0.0
+    for reltuples, n_distinct in stats:
+        if reltuples is None or reltuples < 0 or n_distinct is None:
+            return None
+        total_rows += reltuples
+        # negative n_distinct is a fraction of rows
+        total_distinct += n_distinct if n_distinct >= 0 else -n_distinct * reltuples
+    return total_rows, total_distinct
+
+
+async def is_volatile_rule(db_conn, rule: str) -> bool:
+    """
+    Check that SQL expression calls volatile functions (e.g. random()), functions are found in pg_proc by their names
+    :param db_conn: connection to source database
+    :param rule: SQL expression of rule
+    :return: True if some called function is volatile
+    """
+    names = {name.lower() for name in re.findall(r"([A-Za-z_][\w$]*(?:\.[A-Za-z_][\w$]*)?)\s*\(", rule)}
+    if not names:
+        return False
+    return await db_conn.fetchval(
+        """
+        SELECT coalesce(bool_or(p.provolatile = 'v'), false)
+        FROM pg_proc p
+        JOIN pg_namespace n ON n.oid = p.pronamespace
+        WHERE p.proname = ANY($1::text[]) OR n.nspname || '.' || p.proname = ANY($1::text[])
+        """,
+        list(names),
+    )
+
+
+async def build_domain_tables(ctx, db_conn):
+    """
+    Build mapping table (value -> anonymized value) for each value domain of dictionary.
+    Rule of domain is calculated once per distinct value of all fields of the domain, so the same value gets
+    the same anonymized value in all tables, and dump queries join the mapping table instead of calling the rule
+    for each row. Mapping table is always built for domain of several fields and for volatile rule,
+    for deterministic rule of one field it is built only if the field has repeated values according to pg_stats
+    :param ctx: context with prepared dictionary
+    :param db_conn: connection to source database, it keeps locks of mapping tables until the end of dump
+    """
+    ctx.domains_mapping_id = uuid.uuid4().hex
+    for domain_name, columns in (await get_domains_columns(ctx, db_conn)).items():
+        if not columns:
+            continue
+
+        domain_rule = ctx.prepared_dictionary_obj["domains"][domain_name]
+        if len(columns) == 1 and not await is_volatile_rule(db_conn, domain_rule):
+            estimation = await get_columns_distinct_values(db_conn, columns)
+            if estimation is not None and estimation[1] * DOMAIN_MIN_ROWS_PER_VALUE > estimation[0]:
+                ctx.logger.info(
+                    'Domain "%s": %s distinct values in %s rows, rule is calculated for each row'
+                    % (domain_name, round(estimation[1]), round(estimation[0]))
+                )
+                continue
+
+        domain_table = 'anon_funcs."domain_%s"' % hashlib.md5(domain_name.encode()).hexdigest()
+        if not await db_conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", domain_table):
+            raise Exception(f'Mapping table of domain "{domain_name}" is used by another dump')
+
+        start_t = time.time()
+        values_query = " UNION ".join(
+            f'SELECT "{column}"::text AS value FROM "{schema}"."{table}"' for schema, table, column in columns
+        )
+        async with db_conn.transaction():
+            await db_conn.execute(f"DROP TABLE IF EXISTS {domain_table}")
+            await db_conn.execute(f"CREATE UNLOGGED TABLE {domain_table} (value text PRIMARY KEY, anon text)")
+            res = await db_conn.execute(
+                f"INSERT INTO {domain_table} (value, anon) "
+                f"SELECT value, ({domain_rule})::text "
+                f"FROM ({values_query}) AS v WHERE value IS NOT NULL"
+            )
+        await db_conn.execute(f"ANALYZE {domain_table}")
+        ctx.domain_tables[domain_name] = domain_table
+        ctx.logger.info(
+            'Domain "%s": mapping table %s with %s values of %s fields is built in %s sec'
+            % (domain_name, domain_table, re.findall(r"(\d+)", res)[-1], len(columns), round(time.time() - start_t, 2))
+        )
+
+
+async def warn_domains_without_mapping(ctx, db_conn, reason: str):
+    """
+    Warn about domains with volatile rules, when mapping tables can't be built: their rules are calculated
+    for each row, so the same value gets different anonymized values in different rows and tables
+    :param ctx: context with prepared dictionary
+    :param db_conn: connection to source database
+    :param reason: why mapping tables are not built
+    """
+    domains = [
+        domain_name
+        for domain_name, columns in (await get_domains_columns(ctx, db_conn)).items()
+        if columns and await is_volatile_rule(db_conn, ctx.prepared_dictionary_obj["domains"][domain_name])
+    ]
+    if domains:
+        ctx.logger.warning(
+            "Mapping tables of domains are not built %s, volatile rules of domains %s are calculated for each row, "
+            "so the same value gets different anonymized values in different fields"
+            % (reason, ", ".join(f'"{domain_name}"' for domain_name in domains))
+        )
+
+
+async def drop_domain_tables(ctx, db_conn):
+    for domain_table in ctx.domain_tables.values():
+        try:
+            await db_conn.execute(f"DROP TABLE IF EXISTS {domain_table}")
+            await db_conn.execute("SELECT pg_advisory_unlock(hashtext($1))", domain_table)
+        except Exception as exc:
+            ctx.logger.error(f"Mapping table {domain_table} is not dropped: {exc}")
+    ctx.domain_tables = {}
+
+
+async def get_replication_lag(db_conn) -> Dict:
+    """
+    Get replication lag of standby: time since the last replayed transaction was committed on primary
+    and WAL positions, which are received and replayed
+    :param db_conn: connection to standby, functions are not affected by the snapshot of transaction
+    :return: dict of lag in seconds (None if nothing is replayed yet) and LSNs
+    """
+    lag = await db_conn.fetchrow(
+        """
+        SELECT
+            extract(epoch FROM clock_timestamp() - pg_last_xact_replay_timestamp())::float8 AS seconds,
+            pg_last_wal_receive_lsn()::text AS receive_lsn,
+            pg_last_wal_replay_lsn()::text AS replay_lsn
+        """
+    )
+    return {"measured": datetime.now().strftime("%d/%m/%Y %H:%M:%S"), **dict(lag)}
+
+
+async def check_standby(ctx, db_conn):
+    """
+    Detect dump from standby, save replication lag at start of dump and check settings,
+    which are needed for dump from standby
+    :param ctx: context with dump arguments
+    :param db_conn: connection to source database without transaction
+    """
+    if not await db_conn.fetchval("SELECT pg_is_in_recovery()"):
+        return
+
+    if ctx.args.distributed:
+        raise ValueError("Option --distributed is not supported on standby, the plan can't be written into it")
+
+    ctx.replication_lag = {"start": await get_replication_lag(db_conn)}
+    ctx.logger.info("Dump from standby, replication lag: %s" % ctx.replication_lag["start"])
+    if await db_conn.fetchval("SHOW hot_standby_feedback") != "on":
+        # the session, which exports the snapshot, is idle in transaction, so snapshot conflict terminates it,
+        # and tasks can't import the lost snapshot anymore
+        raise ValueError(
+            "Dump from standby requires hot_standby_feedback=on, otherwise the exported snapshot is lost "
+            "by conflict with recovery after max_standby_streaming_delay"
+        )
+    if ctx.args.base_dir:
+        ctx.logger.warning(
+            "Dump from standby: statistics counters of tables are not updated by WAL replay, "
+            "so changes of tables can't be detected and all tables are dumped despite --base-dir"
+        )
+
+
+def get_dump_task_lock_key(sn_id: str, file_name: str) -> str:
+    return f"{sn_id}/{file_name}"
+
+
+async def write_dump_plan(ctx, db_conn, plan_conn, sn_id: str, queries: Dict[str, str], files: Dict):
+    """
+    Write tasks of distributed dump into claim table of source database, so dump workers can claim them
+    :param ctx: context with dump arguments
+    :param db_conn: connection with exported snapshot
+    :param plan_conn: connection without transaction, the plan must be committed to be visible for workers
+    :param sn_id: exported snapshot, it identifies the plan
+    :param queries: ordered dict of dump queries with key by file name
+    :param files: dict of files info with key by file name
+    """
+    weights = await get_dump_tasks_weights(ctx, db_conn, files)
+    await plan_conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {DUMP_TASKS_TABLE} (
+            snapshot text NOT NULL,
+            file_name text NOT NULL,
+            query text NOT NULL,
+            file_info jsonb NOT NULL,
+            weight float8 NOT NULL,
+            attempts int NOT NULL DEFAULT 0,
+            worker text,
+            claimed_at timestamptz,
+            finished_at timestamptz,
+            result jsonb,
+            error text,
+            PRIMARY KEY (snapshot, file_name)
+        )
+        """
+    )
+    await plan_conn.executemany(
+        f"INSERT INTO {DUMP_TASKS_TABLE} (snapshot, file_name, query, file_info, weight) VALUES ($1, $2, $3, $4, $5)",
+        [
+            (sn_id, file_name, query, json.dumps(files[file_name], ensure_ascii=False), weights[file_name][0])
+            for file_name, query in queries.items()
+        ],
+    )
+
+
+async def claim_dump_task(claim_conn, sn_id: str, worker: str) -> Tuple[Optional[asyncpg.Record], int]:
+    """
+    Claim the largest free task of distributed dump. Task is claimed by session advisory lock of claim connection,
+    so the task of failed worker becomes free again, when its connection is closed
+    :param claim_conn: connection without transaction, which keeps advisory lock until the task is finished
+    :param sn_id: snapshot of distributed dump
+    :param worker: name of worker, which is saved for the task
+    :return: claimed task or None, and amount of tasks which are being dumped by other workers
+    """
+    in_progress = 0
+    unfinished = await claim_conn.fetch(
+        f"SELECT file_name FROM {DUMP_TASKS_TABLE} WHERE snapshot = $1 AND finished_at IS NULL ORDER BY weight DESC",
+        sn_id,
+    )
+    for (file_name,) in unfinished:
+        lock_key = get_dump_task_lock_key(sn_id, file_name)
+        if not await claim_conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", lock_key):
+            in_progress += 1
+            continue
+
+        # task can be finished by other worker after the list was read
+        task = await claim_conn.fetchrow(
+            f"""
+            UPDATE {DUMP_TASKS_TABLE}
+            SET attempts = attempts + 1, worker = $3, claimed_at = now(), error = NULL
+            WHERE snapshot = $1 AND file_name = $2 AND finished_at IS NULL AND attempts < $4
+            RETURNING file_name, query, file_info
+            """,
+            sn_id,
+            file_name,
+            worker,
+            DUMP_TASK_MAX_ATTEMPTS,
+        )
+        if task is not None:
+            return task, in_progress
+        await claim_conn.execute("SELECT pg_advisory_unlock(hashtext($1))", lock_key)
+
+    return None, in_progress
+
+
+async def run_dump_plan_tasks(ctx, pool, sn_id: str, wait_for_workers: bool) -> List[str]:
+    """
+    Dump tasks of distributed dump claimed from the plan in --threads parallel loops.
+    Result of each task is saved into the plan, the same as into manifest.jsonl of --output-dir
+    :param ctx: context with dump arguments
+    :param pool: connection pool for dump_obj_func()
+    :param sn_id: snapshot of distributed dump
+    :param wait_for_workers: wait until tasks of other workers are finished, failed ones are claimed again
+    :return: list of files, which are failed by this process
+    """
+    worker = f"{socket.gethostname()}:{ctx.args.output_dir}"
+    failed_files = []
+
+    async def run_tasks():
+        claim_conn = await asyncpg.connect(**ctx.conn_params)
+        try:
+            while True:
+                task, in_progress = await claim_dump_task(claim_conn, sn_id, worker)
+                if task is None:
+                    if in_progress and wait_for_workers:
+                        await asyncio.sleep(DUMP_PLAN_POLL_INTERVAL)
+                        continue
+                    return
+
+                file_name = task["file_name"]
+                file_info = json.loads(task["file_info"])
+                # file names are made by codec of coordinator
+                ctx.args.output_codec = OutputCodec(file_info["codec"])
+                ctx.args.output_codec_level = file_info["codec_level"]
+                try:
+                    await dump_obj_func(ctx, pool, task["query"], sn_id, file_name)
+                except Exception as exc:
+                    failed_files.append(file_name)
+                    await claim_conn.execute(
+                        f"UPDATE {DUMP_TASKS_TABLE} SET error = $3 WHERE snapshot = $1 AND file_name = $2",
+                        sn_id,
+                        file_name,
+                        str(exc),
+                    )
+                else:
+                    await claim_conn.execute(
+                        f"UPDATE {DUMP_TASKS_TABLE} SET finished_at = now(), result = $3 "
+                        f"WHERE snapshot = $1 AND file_name = $2",
+                        sn_id,
+                        file_name,
+                        json.dumps(ctx.task_results[file_name], ensure_ascii=False),
+                    )
+                finally:
+                    await claim_conn.execute(
+                        "SELECT pg_advisory_unlock(hashtext($1))", get_dump_task_lock_key(sn_id, file_name)
+                    )
+        finally:
+            await claim_conn.close()
+
+    await asyncio.gather(*[run_tasks() for _ in range(ctx.args.threads)])
+    return failed_files
+
+
+async def run_distributed_dump(ctx, db_conn, pool, sn_id: str, queries: Dict[str, str], files: Dict):
+    """
+    Coordinator of distributed dump: write the plan of tasks into the source database, dump tasks together with
+    workers started by --mode=dump-worker --snapshot=<sn_id>, and merge results of workers for metadata.json
+    :param ctx: context with dump arguments
+    :param db_conn: connection with exported snapshot, the snapshot is kept exported until all tasks are finished
+    :param pool: connection pool
+    :param sn_id: exported snapshot
+    :param queries: ordered dict of dump queries with key by file name
+    :param files: dict of files info with key by file name
+    """
+    plan_conn = await asyncpg.connect(**ctx.conn_params)
+    try:
+        await write_dump_plan(ctx, db_conn, plan_conn, sn_id, queries, files)
+        ctx.logger.info(
+            "Distributed dump: plan of %s tasks is written into %s, start workers by: "
+            "--mode=dump-worker --snapshot=%s" % (len(queries), DUMP_TASKS_TABLE, sn_id)
+        )
+
+        await run_dump_plan_tasks(ctx, pool, sn_id, wait_for_workers=True)
+
+        failed_tasks = await plan_conn.fetch(
+            f"SELECT file_name, worker, error FROM {DUMP_TASKS_TABLE} WHERE snapshot = $1 AND finished_at IS NULL",
+            sn_id,
+        )
+        if failed_tasks:
+            raise Exception(
+                "Distributed dump: tasks are failed after %s attempts:\n%s"
+                % (
+                    DUMP_TASK_MAX_ATTEMPTS,
+                    "\n".join(f"{v['file_name']} ({v['worker']}): {v['error']}" for v in failed_tasks),
+                )
+            )
+
+        # results of workers are merged with the same keys as in their manifests
+        for file_name, worker, result in await plan_conn.fetch(
+            f"SELECT file_name, worker, result FROM {DUMP_TASKS_TABLE} WHERE snapshot = $1", sn_id
+        ):
+            ctx.task_results[file_name] = {**json.loads(result), "worker": worker}
+    finally:
+        await plan_conn.execute(f"DELETE FROM {DUMP_TASKS_TABLE} WHERE snapshot = $1", sn_id)
+        await plan_conn.close()
+
+
+async def make_dump_worker(ctx):
+    result = PgAnonResult()
+    ctx.logger.info("-------------> Started dump-worker mode")
+
+    try:
+        if not ctx.args.snapshot:
+            raise ValueError("Option --snapshot is required in dump-worker mode")
+        if not ctx.args.output_dir:
+            raise ValueError("Option --output-dir is required in dump-worker mode")
+        if ctx.args.output_dir.find("""/""") == -1 and ctx.args.output_dir.find("""\\""") == -1:
+            ctx.args.output_dir = os.path.join(ctx.current_dir, "output", ctx.args.output_dir)
+        os.makedirs(ctx.args.output_dir, exist_ok=True)
+    except:
+        ctx.logger.error("<------------- make_dump_worker failed\n" + exception_helper())
+        result.result_code = ResultCode.FAIL
+        return result
+
+    ctx.compression_executor = ThreadPoolExecutor(
+        max_workers=ctx.args.compress_threads or ctx.args.threads
+    )
+    pool = await asyncpg.create_pool(
+        **ctx.conn_params, min_size=ctx.args.threads, max_size=ctx.args.threads
+    )
+    try:
+        failed_files = await run_dump_plan_tasks(ctx, pool, ctx.args.snapshot, wait_for_workers=False)
+        if failed_files:
+            raise Exception("Tasks of files are failed: %s" % ", ".join(failed_files))
+        result.result_code = ResultCode.DONE
+    except:
+        ctx.logger.error("<------------- make_dump_worker failed\n" + exception_helper())
+        result.result_code = ResultCode.FAIL
+    finally:
+        await pool.close()
+        ctx.compression_executor.shutdown()
+
+    if result.result_code == ResultCode.DONE:
+        ctx.logger.info("<------------- Finished dump-worker mode (%s files dumped)" % len(ctx.task_results))
+    return result
+
+
+def get_dump_concurrency(ctx) -> int:
+    """
+    Get amount of dump tasks, which can run concurrently: --threads or the least of current limits
+    of load monitor and concurrency tuner
+    """
+    concurrency = ctx.args.threads
+    if ctx.load_monitor is not None:
+        concurrency = min(concurrency, ctx.load_monitor.concurrency)
+    if ctx.concurrency_tuner is not None:
+        concurrency = min(concurrency, ctx.concurrency_tuner.concurrency)
+    return concurrency
+
+
+async def wait_for_dump_concurrency(ctx, pool, tasks: Set[asyncio.Task]) -> Set[asyncio.Task]:
+    """
+    Wait until amount of running dump tasks is below current concurrency, so a new task can be added
+    :param ctx: context with dump arguments
+    :param pool: connection pool, it is closed if some task is failed
+    :param tasks: running tasks
+    :return: tasks, which are still running
+    """
+    while len(tasks) >= get_dump_concurrency(ctx):
+        # Wait for some dump to finish before adding a new one,
+        # limits of load monitor and concurrency tuner can be increased meanwhile, so they are checked by timeout
+        intervals = []
+        if ctx.load_monitor is not None:
+            intervals.append(ctx.args.load_check_interval)
+        if ctx.concurrency_tuner is not None:
+            intervals.append(ctx.args.auto_concurrency_interval)
+        done, tasks = await asyncio.wait(
+            tasks,
+            timeout=min(intervals) if intervals else None,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for task in done:
+            if task.exception() is not None:
+                await pool.close()
+                raise task.exception()
+    return tasks
+
+
+async def make_dump_impl(ctx, db_conn, sn_id, signatures: Optional[Dict] = None):
+    loop = asyncio.get_event_loop()
+    tasks = set()
+    pool = await asyncpg.create_pool(
+        **ctx.conn_params, min_size=ctx.args.threads, max_size=ctx.args.threads
+    )
+
+    partitions = await get_partitions(excluded_schemas=ctx.exclude_schemas, db_conn=db_conn)
+    queries, files = await generate_dump_queries(ctx, db_conn, partitions)
+    if not queries:
+        await pool.close()
+        raise Exception("No objects for dump!")
+
+    if ctx.args.dbg_stage_1_validate_dict:
+        try:
+            await validate_dump_queries(ctx, pool, queries, files)
+        finally:
+            await pool.close()
+        return
+
+    queries = await order_dump_tasks(ctx, db_conn, queries, files)
+    for file_name, query in queries.items():
+        files[file_name]["signature"] = (signatures or {}).get((files[file_name]["schema"], files[file_name]["table"]))
+        if files[file_name].get("subset") or is_query_with_domains(ctx, query):
+            # rows of subset depend on other tables, which can be changed, and mapping tables are new in each run
+            files[file_name]["signature"] = None
+        files[file_name]["query_hash"] = get_file_query_hash(ctx, file_name, query)
+
+    if ctx.args.resume:
+        queries = skip_dumped_tasks(ctx, queries, sn_id)
+    if ctx.args.base_dir:
+        queries = link_unchanged_files(ctx, queries, files)
+
+    segments_names = []
+    if ctx.args.archive_segments:
+        segments_names = open_archive_segments(ctx)
+    elif ctx.args.stripe_dirs:
+        await distribute_files_by_stripes(ctx, db_conn, queries, files)
+
+    if ctx.args.distributed:
+        # tasks are claimed from the plan by this process and by dump workers
+        dump_tasks = []
+        try:
+            await run_distributed_dump(ctx, db_conn, pool, sn_id, queries, files)
+        except:
+            await pool.close()
+            raise
+    else:
+        dump_tasks = await make_dump_batches(ctx, db_conn, queries, files)
+
+    for dump_task in dump_tasks:
+        tasks = await wait_for_dump_concurrency(ctx, pool, tasks)
+        if len(dump_task) > 1:
+            tasks.add(loop.create_task(dump_batch_func(ctx, pool, dump_task, sn_id)))
+        else:
+            file_name, query = next(iter(dump_task.items()))
+            tasks.add(loop.create_task(dump_obj_func(ctx, pool, query, sn_id, file_name)))
+
+    # Wait for the remaining dumps to finish
+    if tasks:
+        await asyncio.wait(tasks)
+    await pool.close()
+    close_archive_segments(ctx)
+
+    await write_dump_metadata(ctx, db_conn, files, partitions, segments_names)
+
+
+async def write_dump_metadata(ctx, db_conn, files: Dict, partitions: Dict, segments_names: List[str]):
+    """
+    Write metadata.json of finished dump into --output-dir
+    :param ctx: context with dump arguments and results of dump tasks
+    :param db_conn: connection with exported snapshot
+    :param files: dict of files info with key by file name
+    :param partitions: partitions of partitioned tables with key by (schema, table)
+    :param segments_names: names of archive segments, if --archive-segments is used
+    """
+    seq_res_dict = await get_seq_lastvals(ctx, db_conn, files)
 
     metadata = dict()
     metadata["db_size"] = await db_conn.fetchval(
@@ -257,25 +2353,41 @@ async def make_dump_impl(ctx, db_conn, sn_id):
             dictionary_content.encode("utf-8")
         ).hexdigest()
     metadata["prepared_sens_dict_files"] = ','.join(ctx.args.prepared_sens_dict_files)
+    if ctx.profile_name:
+        metadata["profile"] = ctx.profile_name
+    if ctx.args.base_dir:
+        metadata["base_dir"] = ctx.args.base_dir
 
-    for v in zipped_list:
-        files[v[1]].update({"rows": ctx.task_results[v[0]]})
+    for file_name in files:
+        files[file_name].update(ctx.task_results[file_name])
 
     metadata["files"] = files
+    if segments_names:
+        metadata["segments"] = segments_names
+    if ctx.args.stripe_dirs:
+        metadata["stripe_dirs"] = ctx.args.stripe_dirs
+    metadata["partitions"] = {
+        f"{schema}.{table}": {
+            "schema": schema,
+            "table": table,
+            "parent_schema": partition["parent_schema"],
+            "parent_table": partition["parent_table"],
+            "root_schema": partition["root_schema"],
+            "root_table": partition["root_table"],
+        }
+        for (schema, table), partition in partitions.items()
+    }
 
-    total_tables_size = 0
     total_rows = 0
     for k, v in files.items():
-        # print("""select pg_total_relation_size('"%s"."%s"')""" % (v['schema'], v['table']))
-        schema = v["schema"].replace("'", "''")
-        table = v["table"].replace("'", "''")
-        total_tables_size += await db_conn.fetchval(
-            """select pg_total_relation_size('"%s"."%s"')""" % (schema, table)
-        )
-        # print('<---------------------------------', int(v["rows"]))
         total_rows += int(v["rows"])
-    metadata["total_tables_size"] = total_tables_size
+    metadata["total_tables_size"] = await get_tables_total_size(db_conn, files)
     metadata["total_rows"] = total_rows
+    if ctx.replication_lag is not None:
+        ctx.replication_lag["end"] = await get_replication_lag(db_conn)
+        metadata["replication_lag"] = ctx.replication_lag
+    if ctx.concurrency_tuner is not None:
+        metadata["auto_concurrency"] = ctx.concurrency_tuner.concurrency
     if ctx.args.dbg_stage_2_validate_data:
         metadata["dbg_stage_2_validate_data"] = True
     else:
@@ -285,9 +2397,152 @@ async def make_dump_impl(ctx, db_conn, sn_id):
     else:
         metadata["dbg_stage_3_validate_full"] = False
 
-    if not ctx.args.dbg_stage_1_validate_dict:
-        with open(os.path.join(ctx.args.output_dir, "metadata.json"), "w", encoding='utf-8') as out_file:
-            out_file.write(json.dumps(metadata, indent=4, ensure_ascii=False))
+    with open(os.path.join(ctx.args.output_dir, "metadata.json"), "w", encoding='utf-8') as out_file:
+        out_file.write(json.dumps(metadata, indent=4, ensure_ascii=False))
+
+
+def get_profile_context(ctx, name: str, dict_files: List[str]) -> Context:
+    """
+    Make context for one profile of --profile, so dump functions can be reused with dictionary of the profile
+    :param ctx: context of dump with all profiles
+    :param name: name of profile, it is also name of its directory in --output-dir
+    :param dict_files: prepared sens dict files of profile
+    :return: context with dictionary of profile
+    """
+    args = copy.copy(ctx.args)
+    args.prepared_sens_dict_files = dict_files
+    args.profiles = None
+
+    profile_ctx = Context(args)
+    profile_ctx.logger = ctx.logger
+    profile_ctx.pg_version = ctx.pg_version
+    profile_ctx.profile_name = name
+    profile_ctx.read_prepared_dict()
+    return profile_ctx
+
+
+async def make_profiles_dump_impl(ctx, db_conn, sn_id, signatures: Optional[Dict] = None):
+    """
+    Dump all profiles of --profile in one snapshot. Table is read once by query with fields of all profiles,
+    if they select its rows by the same FROM clause, and the stream is split into files of profiles.
+    Otherwise, e.g. with different subsets or "raw_sql", each profile reads the table by own query
+    :param ctx: context of dump with profiles
+    :param db_conn: connection with exported snapshot
+    :param sn_id: exported snapshot
+    :param signatures: change signatures of tables with key by (schema, table)
+    """
+    loop = asyncio.get_event_loop()
+    tasks = set()
+    partitions = await get_partitions(excluded_schemas=ctx.exclude_schemas, db_conn=db_conn)
+
+    profiles_files = {}
+    targets = {}  # list of (context of profile, file name, query of profile) with key by file name
+    all_queries = {}
+    all_files = {}
+    for name, profile_ctx in ctx.profiles.items():
+        profile_ctx.compression_executor = ctx.compression_executor
+        profile_ctx.rate_limiter = ctx.rate_limiter
+        profile_ctx.concurrency_tuner = ctx.concurrency_tuner
+        profile_ctx.replication_lag = ctx.replication_lag
+
+        queries, files = await generate_dump_queries(profile_ctx, db_conn, partitions)
+        for file_name, query in queries.items():
+            file_info = files[file_name]
+            file_info["signature"] = (signatures or {}).get((file_info["schema"], file_info["table"]))
+            if file_info.get("subset"):
+                file_info["signature"] = None
+            file_info["query_hash"] = get_file_query_hash(profile_ctx, file_name, query)
+            # name of file is made of table and part, so files with the same name have the same source rows
+            targets.setdefault(file_name, []).append((profile_ctx, file_name, query))
+            all_queries.setdefault(file_name, query)
+            all_files.setdefault(file_name, file_info)
+        profiles_files[name] = files
+
+    if not all_queries:
+        raise Exception("No objects for dump!")
+
+    dump_tasks = []
+    shared_reads = 0
+    for file_name in await order_dump_tasks(ctx, db_conn, all_queries, all_files):
+        query_parts = [profile_ctx.files_query_parts.get(file_name) for profile_ctx, _, _ in targets[file_name]]
+        if len(query_parts) > 1 and all(query_parts) and len({from_clause for _, from_clause, _ in query_parts}) == 1:
+            query = "SELECT %s FROM %s" % (
+                ",\n".join(select_list for select_list, _, _ in query_parts),
+                query_parts[0][1],
+            )
+            dump_tasks.append(
+                functools.partial(dump_profiles_func, ctx, query=query, sn_id=sn_id, targets=targets[file_name])
+            )
+            shared_reads += 1
+        else:
+            for profile_ctx, _, query in targets[file_name]:
+                dump_tasks.append(
+                    functools.partial(dump_obj_func, profile_ctx, task=query, sn_id=sn_id, file_name=file_name)
+                )
+    ctx.logger.info(
+        "Dump of %s profiles: %s tasks, %s of them read tables once for several profiles"
+        % (len(ctx.profiles), len(dump_tasks), shared_reads)
+    )
+
+    pool = await asyncpg.create_pool(
+        **ctx.conn_params, min_size=ctx.args.threads, max_size=ctx.args.threads
+    )
+    for dump_task in dump_tasks:
+        tasks = await wait_for_dump_concurrency(ctx, pool, tasks)
+        tasks.add(loop.create_task(dump_task(pool=pool)))
+
+    # Wait for the remaining dumps to finish
+    if tasks:
+        await asyncio.wait(tasks)
+    await pool.close()
+
+    for name, profile_ctx in ctx.profiles.items():
+        await write_dump_metadata(profile_ctx, db_conn, profiles_files[name], partitions, [])
+
+
+def prepare_output_dirs(ctx):
+    """
+    Create output directories of dump and check that they are empty, or clear them with --clear-output-dir
+    """
+    for dir_path in get_output_dirs(ctx):
+        os.makedirs(dir_path, exist_ok=True)
+        dir_empty = True
+        for root, dirs, files in os.walk(dir_path):
+            for _ in files:
+                dir_empty = False
+                break
+
+        if not dir_empty and not ctx.args.resume:
+            if not ctx.args.clear_output_dir:
+                msg = (
+                    "Output directory " + dir_path + " is not empty! "
+                    "Use --resume to continue interrupted dump or --clear-output-dir to remove previous dump"
+                )
+                ctx.logger.error(msg)
+                raise Exception(msg)
+
+            else:
+                for root, dirs, files in os.walk(dir_path):
+                    for file in files:
+                        if (
+                                file.endswith(".sql")
+                                or file.endswith(".gz")
+                                or file.endswith(".zst")
+                                or file.endswith(".lz4")
+                                or file.endswith(".json")
+                                or file.endswith(".jsonl")
+                                or file.endswith(".backup")
+                                or file.endswith(".bin")
+                                or file.endswith(".seg")
+                        ):
+                            os.remove(os.path.join(root, file))
+                        else:
+                            msg = (
+                                    "Option --clear-output-dir enabled. Unexpected file extension: %s"
+                                    % os.path.join(root, file)
+                            )
+                            ctx.logger.error(msg)
+                            raise Exception(msg)
 
 
 async def make_dump(ctx):
@@ -295,14 +2550,52 @@ async def make_dump(ctx):
     ctx.logger.info("-------------> Started dump mode")
 
     try:
-        ctx.read_prepared_dict()
+        if ctx.args.profiles:
+            if ctx.args.prepared_sens_dict_files:
+                raise ValueError("Options --profile and --prepared-sens-dict-file can't be used together")
+            if ctx.args.mode != AnonMode.DUMP:
+                raise ValueError("Option --profile is supported only in dump mode")
+            if (ctx.args.distributed or ctx.args.archive_segments or ctx.args.stripe_dirs or ctx.args.resume
+                    or ctx.args.base_dir):
+                raise ValueError(
+                    "Options --distributed, --archive-segments, --stripe-dirs, --resume and --base-dir "
+                    "are not supported with --profile"
+                )
+            # stream of one query is split between profiles, so rules can't be evaluated by pg_anon
+            if ctx.args.anon_engine == AnonEngine.CLIENT:
+                raise ValueError("Option --anon-engine=client is not supported with --profile")
+            if (ctx.args.dbg_stage_1_validate_dict or ctx.args.dbg_stage_2_validate_data
+                    or ctx.args.dbg_stage_3_validate_full):
+                raise ValueError("Debug stages are not supported with --profile, dump each profile separately")
+            for name, dict_files in ctx.args.profiles:
+                if name in ctx.profiles:
+                    raise ValueError(f'Profile "{name}" is specified several times')
+                ctx.profiles[name] = get_profile_context(ctx, name, dict_files)
+        else:
+            ctx.read_prepared_dict()
+        check_codec_available(ctx.args.output_codec)
+        get_codec_level(ctx.args.output_codec, ctx.args.output_codec_level)
+        if ctx.args.distributed:
+            if ctx.args.mode not in (AnonMode.DUMP, AnonMode.SYNC_DATA_DUMP):
+                raise ValueError("Option --distributed is supported only in dump and sync-data-dump modes")
+            if ctx.args.archive_segments or ctx.args.stripe_dirs:
+                raise ValueError("Options --archive-segments and --stripe-dirs are not supported with --distributed")
+            # workers get only queries from the plan, so anonymization must be in queries
+            if ctx.args.anon_engine == AnonEngine.CLIENT:
+                raise ValueError("Option --anon-engine=client is not supported with --distributed")
+            # each process claims tasks of the plan by --threads loops
+            if ctx.args.auto_concurrency:
+                raise ValueError("Option --auto-concurrency is not supported with --distributed")
     except:
         ctx.logger.error("<------------- make_dump failed\n" + exception_helper())
         result.result_code = ResultCode.FAIL
         return result
 
     try:
-        if not ctx.args.output_dir:
+        if not ctx.args.output_dir and ctx.profiles:
+            # directory of each profile is named by profile
+            output_dir = os.path.join(ctx.current_dir, "output")
+        elif not ctx.args.output_dir:
             prepared_dict_name = get_file_name_from_path(ctx.args.prepared_sens_dict_files[0])
             output_dir = os.path.join(ctx.current_dir, "output", prepared_dict_name)
         elif ctx.args.output_dir.find("""/""") == -1 and ctx.args.output_dir.find("""\\""") == -1:
@@ -312,45 +2605,32 @@ async def make_dump(ctx):
 
         ctx.args.output_dir = output_dir
         os.makedirs(output_dir, exist_ok=True)
+        if ctx.args.stripe_dirs:
+            # stripe dirs are resolved as --output-dir and saved into metadata.json as absolute paths,
+            # so restore finds them from any working directory
+            ctx.args.stripe_dirs = [
+                os.path.abspath(
+                    os.path.join(ctx.current_dir, "output", stripe_dir)
+                    if stripe_dir.find("""/""") == -1 and stripe_dir.find("""\\""") == -1 else stripe_dir
+                )
+                for stripe_dir in ctx.args.stripe_dirs
+            ]
+        for name, profile_ctx in ctx.profiles.items():
+            profile_ctx.args.output_dir = os.path.join(output_dir, name)
+
+        if ctx.args.base_dir:
+            if ctx.args.base_dir.find("""/""") == -1 and ctx.args.base_dir.find("""\\""") == -1:
+                ctx.args.base_dir = os.path.join(ctx.current_dir, "output", ctx.args.base_dir)
+            if os.path.realpath(ctx.args.base_dir) == os.path.realpath(output_dir):
+                raise ValueError("Option --base-dir must differ from --output-dir")
 
         if not ctx.args.dbg_stage_1_validate_dict:
-            dir_empty = True
-            for root, dirs, files in os.walk(output_dir):
-                for _ in files:
-                    dir_empty = False
-                    break
-
-            if not dir_empty:
-                if not ctx.args.clear_output_dir:
-                    msg = "Output directory " + output_dir + " is not empty!"
-                    ctx.logger.error(msg)
-                    raise Exception(msg)
+            for dump_ctx in list(ctx.profiles.values()) or [ctx]:
+                prepare_output_dirs(dump_ctx)
 
-                else:
-                    for root, dirs, files in os.walk(output_dir):
-                        for file in files:
-                            if (
-                                    file.endswith(".sql")
-                                    or file.endswith(".gz")
-                                    or file.endswith(".json")
-                                    or file.endswith(".backup")
-                                    or file.endswith(".bin")
-                            ):
-                                os.remove(os.path.join(root, file))
-                            else:
-                                msg = (
-                                        "Option --clear-output-dir enabled. Unexpected file extension: %s"
-                                        % os.path.join(root, file)
-                                )
-                                ctx.logger.error(msg)
-                                raise Exception(msg)
-
-            if ctx.args.mode in (AnonMode.SYNC_STRUCT_DUMP, AnonMode.DUMP) and not ctx.args.dbg_stage_2_validate_data:
-                ctx.logger.info("-------------> Started pg_dump")
-                await run_pg_dump(ctx, "pre-data")
-                if not ctx.args.dbg_stage_3_validate_full:
-                    await run_pg_dump(ctx, "post-data")
-                ctx.logger.info("<------------- Finished pg_dump")
+            # In dump mode the structure is dumped concurrently with data in the same snapshot
+            if ctx.args.mode == AnonMode.SYNC_STRUCT_DUMP and not ctx.args.dbg_stage_2_validate_data:
+                await run_pg_dump_sections(ctx)
     except:
         ctx.logger.error("<------------- make_dump failed\n" + exception_helper())
         result.result_code = ResultCode.FAIL
@@ -360,15 +2640,81 @@ async def make_dump(ctx):
 
     if ctx.args.mode in (AnonMode.SYNC_DATA_DUMP, AnonMode.DUMP):
         db_conn = await asyncpg.connect(**ctx.conn_params)
+        ctx.compression_executor = ThreadPoolExecutor(
+            max_workers=ctx.args.compress_threads or ctx.args.threads
+        )
+        if ctx.args.anon_engine == AnonEngine.CLIENT or ctx.profiles:
+            # spawned processes don't inherit threads and random state of the main process
+            ctx.anon_executor = ProcessPoolExecutor(
+                max_workers=ctx.args.anon_processes or os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        schema_dump_task = None
+        load_monitor_task = None
+        if LoadMonitor.is_enabled(ctx):
+            ctx.load_monitor = LoadMonitor(ctx)
+            load_monitor_task = asyncio.create_task(ctx.load_monitor.run())
+        concurrency_tuner_task = None
+        if ctx.args.auto_concurrency:
+            ctx.concurrency_tuner = ConcurrencyTuner(ctx, ctx.args.threads)
+            concurrency_tuner_task = asyncio.create_task(ctx.concurrency_tuner.run())
         try:
+            await check_standby(ctx, db_conn)
+            signatures = None
+            # imported --snapshot is exported earlier, changes committed after its export would get into signatures
+            # but not into dumped data, so signatures are not saved and such tables are dumped by the next dump again.
+            # On standby n_tup_* counters are not updated by WAL replay, so signatures don't reflect changes at all
+            if not ctx.args.snapshot and ctx.replication_lag is None:
+                signatures = await get_tables_signatures(db_conn)
+            # Mapping tables must be committed before the snapshot is exported to be visible in it,
+            # standby is read only, so rules of domains are calculated for each row there
+            # the same domain can have different rules in profiles, so they are calculated for each row too
+            if not (ctx.args.dbg_stage_1_validate_dict or ctx.args.dbg_stage_2_validate_data
+                    or ctx.args.dbg_stage_3_validate_full):
+                if ctx.args.snapshot:
+                    await warn_domains_without_mapping(ctx, db_conn, "with --snapshot")
+                elif ctx.replication_lag is not None:
+                    await warn_domains_without_mapping(ctx, db_conn, "on standby")
+                elif ctx.profiles:
+                    for name, profile_ctx in ctx.profiles.items():
+                        await warn_domains_without_mapping(profile_ctx, db_conn, f'with --profile "{name}"')
+                else:
+                    await build_domain_tables(ctx, db_conn)
             async with db_conn.transaction(isolation='repeatable_read', readonly=True):
-                sn_id = await db_conn.fetchval("select pg_export_snapshot()")
-                await make_dump_impl(ctx, db_conn, sn_id)
+                if ctx.args.snapshot:
+                    # Snapshot is exported by another still open transaction, e.g. by interrupted dump
+                    await db_conn.execute("SET TRANSACTION SNAPSHOT '%s';" % ctx.args.snapshot)
+                    sn_id = ctx.args.snapshot
+                else:
+                    sn_id = await db_conn.fetchval("select pg_export_snapshot()")
+                if (ctx.args.mode == AnonMode.DUMP and not ctx.args.dbg_stage_1_validate_dict
+                        and not ctx.args.dbg_stage_2_validate_data):
+                    schema_dump_task = asyncio.create_task(
+                        run_profiles_pg_dump(ctx, sn_id) if ctx.profiles else run_pg_dump_sections(ctx, sn_id)
+                    )
+                try:
+                    if ctx.profiles:
+                        await make_profiles_dump_impl(ctx, db_conn, sn_id, signatures)
+                    else:
+                        await make_dump_impl(ctx, db_conn, sn_id, signatures)
+                finally:
+                    # Snapshot must stay exported until pg_dump processes are finished
+                    if schema_dump_task is not None:
+                        await schema_dump_task
         except:
             ctx.logger.error("<------------- make_dump failed\n" + exception_helper())
             result.result_code = ResultCode.FAIL
         finally:
+            if load_monitor_task is not None:
+                load_monitor_task.cancel()
+            if concurrency_tuner_task is not None:
+                concurrency_tuner_task.cancel()
+            await drop_domain_tables(ctx, db_conn)
             await db_conn.close()
+            close_archive_segments(ctx)
+            ctx.compression_executor.shutdown()
+            if ctx.anon_executor is not None:
+                ctx.anon_executor.shutdown()
 
     if ctx.args.mode == AnonMode.SYNC_STRUCT_DUMP:
         metadata = dict()
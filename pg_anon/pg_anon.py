@@ -19,8 +19,9 @@ from pg_anon.common.enums import ResultCode, VerboseOptions, AnonMode
 from pg_anon.common.dto import PgAnonResult
 from pg_anon.create_dict import create_dict
 from pg_anon.context import Context
-from pg_anon.dump import make_dump
-from pg_anon.restore import make_restore, run_analyze, validate_restore
+from pg_anon.dump import make_dump, make_dump_worker
+from pg_anon.restore import make_restore, make_verify, run_analyze, validate_restore
+from pg_anon.transfer import make_transfer
 from pg_anon.version import __version__
 from pg_anon.view_fields import ViewFieldsMode
 from pg_anon.view_data import ViewDataMode
@@ -112,6 +113,8 @@ class MainRoutine:
             else:
                 if self.args.prepared_sens_dict_files:
                     base_file_name = os.path.splitext(os.path.basename(self.args.prepared_sens_dict_files[0]))[0]
+                elif self.args.profiles:
+                    base_file_name = "_".join(name for name, _ in self.args.profiles)
                 else:
                     base_file_name = os.path.basename(self.args.input_dir)
 
@@ -166,21 +169,25 @@ class MainRoutine:
             self.ctx.logger.info(params_info)
 
         result = PgAnonResult()
-        try:
-            db_conn = await asyncpg.connect(**self.ctx.conn_params)
-            self.ctx.pg_version = await db_conn.fetchval("select version()")
-            self.ctx.pg_version = re.findall(r"(\d+\.\d+)", str(self.ctx.pg_version))[0]
-            await db_conn.close()
-        except:
-            self.ctx.logger.error(exception_helper(show_traceback=True))
-            result.result_code = ResultCode.FAIL
-            return result
-
-        if not check_pg_util(
-            self.ctx, self.ctx.args.pg_dump, "pg_dump"
-        ) or not check_pg_util(self.ctx, self.ctx.args.pg_restore, "pg_restore"):
-            result.result_code = ResultCode.FAIL
-            return result
+        # verify mode checks only files of dump, database and pg_dump are not needed for it
+        if self.ctx.args.mode != AnonMode.VERIFY:
+            try:
+                db_conn = await asyncpg.connect(**self.ctx.conn_params)
+                self.ctx.pg_version = await db_conn.fetchval("select version()")
+                self.ctx.pg_version = re.findall(r"(\d+\.\d+)", str(self.ctx.pg_version))[0]
+                await db_conn.close()
+            except:
+                self.ctx.logger.error(exception_helper(show_traceback=True))
+                result.result_code = ResultCode.FAIL
+                return result
+
+            # dump worker makes only COPY of tables from the plan
+            if self.ctx.args.mode != AnonMode.DUMP_WORKER and (
+                not check_pg_util(self.ctx, self.ctx.args.pg_dump, "pg_dump")
+                or not check_pg_util(self.ctx, self.ctx.args.pg_restore, "pg_restore")
+            ):
+                result.result_code = ResultCode.FAIL
+                return result
 
         start_t = time.time()
         try:
@@ -200,6 +207,12 @@ class MainRoutine:
                         and not self.ctx.metadata["dbg_stage_2_validate_data"]
                         and not self.ctx.metadata["dbg_stage_3_validate_full"]):
                     await run_analyze(self.ctx)
+            elif self.ctx.args.mode == AnonMode.DUMP_WORKER:
+                result = await make_dump_worker(self.ctx)
+            elif self.ctx.args.mode == AnonMode.TRANSFER:
+                result = await make_transfer(self.ctx)
+            elif self.ctx.args.mode == AnonMode.VERIFY:
+                result = await make_verify(self.ctx)
             elif self.ctx.args.mode == AnonMode.INIT:
                 result = await make_init(self.ctx)
             elif self.ctx.args.mode == AnonMode.CREATE_DICT:
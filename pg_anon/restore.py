@@ -1,23 +1,29 @@
 import asyncio
-import gzip
 import json
 import os
 import re
 import shutil
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
 
 import asyncpg
 
+from pg_anon.common.codecs import check_codec_available, get_file_checksum, open_codec_reader
+from pg_anon.common.throttle import ConcurrencyTuner
 from pg_anon.common.utils import (
     exception_helper,
     get_major_version,
     get_pg_util_version,
     pretty_size,
 )
-from pg_anon.common.enums import ResultCode, AnonMode
+from pg_anon.common.enums import ResultCode, AnonMode, OutputCodec
 from pg_anon.common.dto import PgAnonResult
 from pg_anon.context import Context
 
+DECOMPRESS_CHUNK_SIZE = 524288
+
 
 async def run_pg_restore(ctx, section):
     os.environ["PGPASSWORD"] = ctx.args.db_user_password
@@ -106,10 +112,143 @@ def generate_analyze_queries(ctx):
         schema = target["schema"]
         table = target["table"]
         analyze_query = 'analyze "%s"."%s"' % (schema, table)
-        analyze_queries.append(analyze_query)
+        if analyze_query not in analyze_queries:  # table dumped by parts is analyzed once
+            analyze_queries.append(analyze_query)
+
+    # Partitions are restored directly, so partitioned tables must be analyzed to get statistics for whole tables
+    for file_name, target in ctx.metadata["files"].items():
+        if "partition_root" in target:
+            analyze_query = 'analyze "%s"."%s"' % (target["partition_root"]["schema"], target["partition_root"]["table"])
+            if analyze_query not in analyze_queries:
+                analyze_queries.append(analyze_query)
     return analyze_queries
 
 
+def get_input_file_path(ctx, file_name: str, target: Dict) -> str:
+    """
+    Get path of dump file, which can be placed into one of --stripe-dirs or be a segment of archive
+    :param ctx: context with restore arguments and metadata
+    :param file_name: file name from metadata.json
+    :param target: file info from metadata.json
+    :return: path to the file or to the segment of archive
+    """
+    input_dirs = [ctx.args.input_dir, *(ctx.args.stripe_dirs or ctx.metadata.get("stripe_dirs", []))]
+    return os.path.join(input_dirs[target.get("stripe", 0)], target.get("segment", file_name))
+
+
+def verify_file(path: str, target: Dict) -> Optional[str]:
+    """
+    Check size and sha256 checksum of dump file as it is stored on disk, without decompression
+    :param path: path to the file or to the segment of archive
+    :param target: file info from metadata.json
+    :return: description of the problem, or None if the file is correct
+    """
+    if not os.path.exists(path):
+        return f"file {path} is not found"
+    checksum, size = get_file_checksum(path, target.get("offset"), target.get("length"))
+    if size != target["size"]:
+        return f"size {size} is different from metadata ({target['size']})"
+    if checksum != target["sha256"]:
+        return f"sha256 {checksum} is different from metadata ({target['sha256']})"
+    return None
+
+
+async def verify_dump_files(ctx) -> bool:
+    """
+    Check all files of dump by sizes and checksums from metadata.json in parallel by --threads
+    :param ctx: context with restore arguments and metadata
+    :return: True if all files are correct
+    """
+    files = ctx.metadata.get("files", {})
+    files_to_verify = {file_name: target for file_name, target in files.items() if "sha256" in target}
+    if len(files_to_verify) < len(files):
+        # dumps made by previous versions and dumps of debug stages have no checksums
+        ctx.logger.warning(
+            "%s files have no checksum in metadata.json and are not verified"
+            % (len(files) - len(files_to_verify))
+        )
+
+    start_t = time.time()
+    loop = asyncio.get_event_loop()
+    with ThreadPoolExecutor(max_workers=ctx.args.threads) as executor:
+        errors = await asyncio.gather(*[
+            loop.run_in_executor(executor, verify_file, get_input_file_path(ctx, file_name, target), target)
+            for file_name, target in files_to_verify.items()
+        ])
+
+    failed = 0
+    for file_name, error in zip(files_to_verify.keys(), errors):
+        if error is not None:
+            failed += 1
+            ctx.logger.error(f"Verification of {file_name} failed: {error}")
+
+    ctx.logger.info(
+        "Verified %s files (%s) in %s sec, %s files failed"
+        % (
+            len(files_to_verify),
+            pretty_size(sum(target["size"] for target in files_to_verify.values())),
+            round(time.time() - start_t, 2),
+            failed,
+        )
+    )
+    return failed == 0
+
+
+def decompress_chunk(f_in, size: int):
+    start_t = time.time()
+    chunk = f_in.read(size)
+    return chunk, time.time() - start_t
+
+
+async def copy_file_to_table(
+    ctx: Context,
+    db_conn: asyncpg.Connection,
+    dump_file: str,
+    schema_name: str,
+    table_name: str,
+    codec: OutputCodec = OutputCodec.GZIP,
+    offset: Optional[int] = None,
+    length: Optional[int] = None,
+) -> int:
+    # Dump file is decompressed in ctx.compression_executor chunk by chunk and streamed into COPY,
+    # so the event loop is not blocked and no temporary .bin file is needed
+    loop = asyncio.get_event_loop()
+    decompression_time = 0.0
+
+    async def read_chunks(f_in):
+        nonlocal decompression_time
+        while True:
+            chunk, elapsed = await loop.run_in_executor(
+                ctx.compression_executor, decompress_chunk, f_in, DECOMPRESS_CHUNK_SIZE
+            )
+            decompression_time += elapsed
+            if not chunk:
+                break
+            if ctx.concurrency_tuner is not None:
+                ctx.concurrency_tuner.add(len(chunk))
+            yield chunk
+
+    start_t = time.time()
+    # In archive mode dump_file is a segment, and the table stream is read from [offset, offset + length)
+    with open_codec_reader(dump_file, codec, offset, length) as f_in:
+        result = await db_conn.copy_to_table(
+            schema_name=schema_name,
+            table_name=table_name,
+            source=read_chunks(f_in),
+            format="binary",
+        )
+    ctx.logger.debug(
+        "Restored %s.%s: COPY %s sec, decompression %s sec"
+        % (
+            schema_name,
+            table_name,
+            round(time.time() - start_t - decompression_time, 2),
+            round(decompression_time, 2),
+        )
+    )
+    return int(re.findall(r"(\d+)", result)[0])
+
+
 async def restore_table_data(
     ctx: Context,
     pool: asyncpg.Pool,
@@ -117,61 +256,121 @@ async def restore_table_data(
     schema_name: str,
     table_name: str,
     sn_id: str,
+    codec: OutputCodec = OutputCodec.GZIP,
+    offset: Optional[int] = None,
+    length: Optional[int] = None,
 ):
     ctx.logger.info(f"{'>':=>20} Started task copy_to_table {schema_name}.{table_name}")
-    if dump_file.endswith('.bin.gz'):
-        extracted_file = f"{dump_file[:-7]}.bin"
-    else:
-        extracted_file = f"{dump_file}.bin"
-
-    with gzip.open(dump_file, "rb") as src_file, open(extracted_file, "wb") as trg_file:
-        trg_file.writelines(src_file)
 
     try:
         async with pool.acquire() as db_conn:
             async with db_conn.transaction(isolation='repeatable_read'):
                 await db_conn.execute(f"SET TRANSACTION SNAPSHOT '{sn_id}';")
-
-                result = await db_conn.copy_to_table(
-                    schema_name=schema_name,
-                    table_name=table_name,
-                    source=extracted_file,
-                    format="binary",
+                rows = await copy_file_to_table(
+                    ctx, db_conn, dump_file, schema_name, table_name, codec, offset, length
                 )
-                ctx.total_rows += int(re.findall(r"(\d+)", result)[0])
                 await db_conn.execute("COMMIT;")
+                ctx.total_rows += rows
     except Exception as exc:
         ctx.logger.error(
             f"Exception in restore_obj_func:"
             f" {schema_name=}"
             f" {table_name=}"
-            f" {extracted_file=}"
+            f" {dump_file=}"
             f"\n{exc=}"
         )
-    finally:
-        os.remove(extracted_file)
 
     ctx.logger.info(f"{'>':=>20} Finished task {schema_name}.{str(table_name)}")
 
 
+async def restore_batch_data(ctx: Context, pool: asyncpg.Pool, batch: Dict[str, Dict], sn_id: str):
+    """
+    Restore batch of small tables, which were dumped together, sequentially in one transaction
+    :param ctx: context with restore arguments
+    :param pool: connection pool
+    :param batch: dict of files info from metadata.json with key by file name
+    :param sn_id: exported snapshot
+    """
+    ctx.logger.info(f"{'>':=>20} Started batch task of {len(batch)} tables")
+
+    dump_file = None
+    rows = 0
+    try:
+        async with pool.acquire() as db_conn:
+            async with db_conn.transaction(isolation='repeatable_read'):
+                await db_conn.execute(f"SET TRANSACTION SNAPSHOT '{sn_id}';")
+                for file_name, target in batch.items():
+                    dump_file = get_input_file_path(ctx, file_name, target)
+                    rows += await copy_file_to_table(
+                        ctx=ctx,
+                        db_conn=db_conn,
+                        dump_file=dump_file,
+                        schema_name=target["schema"],
+                        table_name=target["table"],
+                        codec=OutputCodec(target.get("codec", OutputCodec.GZIP.value)),
+                        offset=target.get("offset"),
+                        length=target.get("length"),
+                    )
+                await db_conn.execute("COMMIT;")
+                ctx.total_rows += rows
+    except Exception as exc:
+        ctx.logger.error(f"Exception in restore_batch_data: {dump_file=}\n{exc=}")
+
+    ctx.logger.info(f"{'>':=>20} Finished batch task of {len(batch)} tables")
+
+
+def get_restore_concurrency(ctx) -> int:
+    """
+    Get amount of restore tasks, which can run concurrently: --threads or current limit of concurrency tuner
+    """
+    if ctx.concurrency_tuner is not None:
+        return ctx.concurrency_tuner.concurrency
+    return ctx.args.threads
+
+
 async def make_restore_impl(ctx, sn_id):
     pool = await asyncpg.create_pool(
         **ctx.conn_params, min_size=ctx.args.threads, max_size=ctx.args.threads
     )
+    ctx.compression_executor = ThreadPoolExecutor(
+        max_workers=ctx.args.compress_threads or ctx.args.threads
+    )
+
+    # Files of one batch are restored together, as they were dumped
+    batches = {}
+    for file_name, target in ctx.metadata["files"].items():
+        if "batch" in target:
+            batches.setdefault(target["batch"], {})[file_name] = target
+
+    concurrency_tuner_task = None
+    if ctx.args.auto_concurrency:
+        ctx.concurrency_tuner = ConcurrencyTuner(ctx, ctx.args.threads)
+        concurrency_tuner_task = asyncio.create_task(ctx.concurrency_tuner.run())
 
     loop = asyncio.get_event_loop()
     tasks = set()
     for file_name, target in ctx.metadata["files"].items():
-        full_path = os.path.join(
-            ctx.args.input_dir, file_name
-        )
-        if len(tasks) >= ctx.args.threads:
-            # Wait for some restore to finish before adding a new one
-            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-            exception = done.pop().exception()
-            if exception is not None:
-                await pool.close()
-                raise exception
+        full_path = get_input_file_path(ctx, file_name, target)
+        if "batch" in target and target["batch"] not in batches:
+            continue  # the batch is already restored
+        while len(tasks) >= get_restore_concurrency(ctx):
+            # Wait for some restore to finish before adding a new one,
+            # limit of concurrency tuner can be increased meanwhile, so it is checked again by timeout
+            done, tasks = await asyncio.wait(
+                tasks,
+                timeout=ctx.args.auto_concurrency_interval if ctx.concurrency_tuner is not None else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is not None:
+                    if concurrency_tuner_task is not None:
+                        concurrency_tuner_task.cancel()
+                    await pool.close()
+                    ctx.compression_executor.shutdown()
+                    raise task.exception()
+        if "batch" in target:
+            tasks.add(loop.create_task(restore_batch_data(ctx, pool, batches.pop(target["batch"]), sn_id)))
+            continue
         tasks.add(
             loop.create_task(
                 restore_table_data(
@@ -181,13 +380,20 @@ async def make_restore_impl(ctx, sn_id):
                     schema_name=target["schema"],
                     table_name=target["table"],
                     sn_id=sn_id,
+                    codec=OutputCodec(target.get("codec", OutputCodec.GZIP.value)),
+                    offset=target.get("offset"),
+                    length=target.get("length"),
                 )
             )
         )
 
     # Wait for the remaining restores to finish
-    await asyncio.wait(tasks)
+    if tasks:
+        await asyncio.wait(tasks)
+    if concurrency_tuner_task is not None:
+        concurrency_tuner_task.cancel()
     await pool.close()
+    ctx.compression_executor.shutdown()
 
 
 async def check_free_disk_space(ctx, db_conn):
@@ -214,10 +420,7 @@ async def check_free_disk_space(ctx, db_conn):
         )
 
 
-async def make_restore(ctx):
-    result = PgAnonResult()
-    ctx.logger.info("-------------> Started restore")
-
+def resolve_input_dir(ctx):
     if (
         ctx.args.input_dir.find("""/""") == -1
         and ctx.args.input_dir.find("""\\""") == -1
@@ -229,6 +432,30 @@ async def make_restore(ctx):
         ctx.logger.error(msg)
         raise RuntimeError(msg)
 
+
+async def make_verify(ctx):
+    result = PgAnonResult()
+    ctx.logger.info("-------------> Started verify mode")
+
+    try:
+        resolve_input_dir(ctx)
+        with open(os.path.join(ctx.args.input_dir, "metadata.json"), "r") as metadata_file:
+            ctx.metadata = json.loads(metadata_file.read())
+        result.result_code = ResultCode.DONE if await verify_dump_files(ctx) else ResultCode.FAIL
+    except:
+        ctx.logger.error("<------------- make_verify failed\n" + exception_helper())
+        result.result_code = ResultCode.FAIL
+
+    ctx.logger.info("<------------- Finished verify mode")
+    return result
+
+
+async def make_restore(ctx):
+    result = PgAnonResult()
+    ctx.logger.info("-------------> Started restore")
+
+    resolve_input_dir(ctx)
+
     db_conn = await asyncpg.connect(**ctx.conn_params)
     db_is_empty = await db_conn.fetchval(
         """
@@ -254,6 +481,17 @@ async def make_restore(ctx):
     metadata_file.close()
     ctx.metadata = json.loads(metadata_content)
 
+    try:
+        for codec in {v.get("codec", OutputCodec.GZIP.value) for v in ctx.metadata.get("files", {}).values()}:
+            check_codec_available(OutputCodec(codec))
+    except:
+        await db_conn.close()
+        raise
+
+    if ctx.args.verify_before_restore and not await verify_dump_files(ctx):
+        await db_conn.close()
+        raise Exception(f"Files of dump {ctx.args.input_dir} are corrupted!")
+
     if not ctx.args.disable_checks:
         if get_major_version(ctx.pg_version) < get_major_version(
             ctx.metadata["pg_version"]
@@ -0,0 +1,226 @@
+import asyncio
+import copy
+import re
+import tempfile
+import time
+from typing import Dict
+
+import asyncpg
+
+from pg_anon.common.dto import PgAnonResult
+from pg_anon.common.enums import ResultCode
+from pg_anon.common.utils import exception_helper
+from pg_anon.context import Context
+from pg_anon.dump import (
+    generate_dump_queries,
+    get_seq_lastvals,
+    order_dump_tasks,
+    run_pg_dump,
+)
+from pg_anon.restore import run_analyze, run_pg_restore, seq_init
+
+
+def get_target_context(ctx, work_dir: str) -> Context:
+    """
+    Make context for target database of transfer, so restore functions can be reused with it
+    :param ctx: context of transfer with source database arguments
+    :param work_dir: directory with structure dump of source database
+    :return: context, where connection arguments point to target database
+    """
+    args = copy.copy(ctx.args)
+    args.db_name = ctx.args.target_db_name
+    # Not specified target connection arguments are the same as source ones
+    if ctx.args.target_db_host is not None:
+        args.db_host = ctx.args.target_db_host
+    if ctx.args.target_db_port is not None:
+        args.db_port = ctx.args.target_db_port
+    if ctx.args.target_db_user is not None:
+        args.db_user = ctx.args.target_db_user
+    if ctx.args.target_db_user_password is not None:
+        args.db_user_password = ctx.args.target_db_user_password
+    if ctx.args.target_db_passfile is not None:
+        args.db_passfile = ctx.args.target_db_passfile
+    args.input_dir = work_dir
+
+    target_ctx = Context(args)
+    target_ctx.logger = ctx.logger
+    target_ctx.pg_version = ctx.pg_version
+    return target_ctx
+
+
+async def transfer_table(ctx, src_pool, dst_pool, query: str, sn_id: str, file_name: str, target: Dict):
+    """
+    Copy anonymized table data from source snapshot into target table without intermediate files.
+    COPY BINARY stream of source is passed to COPY of target through bounded queue,
+    so the faster side waits for the slower one and memory usage is limited by --transfer-buffer-size chunks
+    """
+    ctx.logger.info("================> Started task %s" % str(query))
+
+    start_t = time.time()
+    queue = asyncio.Queue(maxsize=ctx.args.transfer_buffer_size)
+
+    async def put_chunk(chunk: bytes):
+        if ctx.rate_limiter is not None:
+            await ctx.rate_limiter.acquire(len(chunk))
+        await queue.put(chunk)
+
+    async def read_source():
+        async with src_pool.acquire() as src_conn:
+            async with src_conn.transaction(isolation='repeatable_read', readonly=True):
+                await src_conn.execute("SET TRANSACTION SNAPSHOT '%s';" % sn_id)
+                res = await src_conn.copy_from_query(query, output=put_chunk, format="binary")
+        await queue.put(None)
+        return res
+
+    async def read_queue():
+        while (chunk := await queue.get()) is not None:
+            yield chunk
+
+    async def write_target():
+        async with dst_pool.acquire() as dst_conn:
+            async with dst_conn.transaction():
+                return await dst_conn.copy_to_table(
+                    schema_name=target["schema"],
+                    table_name=target["table"],
+                    source=read_queue(),
+                    format="binary",
+                )
+
+    reader = asyncio.ensure_future(read_source())
+    writer = asyncio.ensure_future(write_target())
+    try:
+        res, _ = await asyncio.gather(reader, writer)
+    except Exception:
+        # Other side must not wait forever for the queue
+        reader.cancel()
+        writer.cancel()
+        ctx.logger.error("Exception in transfer_table:\n" + exception_helper())
+        raise
+
+    count_rows = re.findall(r"(\d+)", res)[0]
+    ctx.task_results[file_name] = {
+        "rows": count_rows,
+        "elapsed": round(time.time() - start_t, 2),
+    }
+    ctx.logger.info(
+        "<================ Finished task %s (%s rows)" % (str(query), count_rows)
+    )
+
+
+async def make_transfer_impl(ctx, target_ctx, db_conn, sn_id):
+    loop = asyncio.get_event_loop()
+    tasks = set()
+
+    queries, files = await generate_dump_queries(ctx, db_conn)
+    if not queries:
+        raise Exception("No objects for transfer!")
+
+    queries = await order_dump_tasks(ctx, db_conn, queries, files)
+
+    src_pool = await asyncpg.create_pool(
+        **ctx.conn_params, min_size=ctx.args.threads, max_size=ctx.args.threads
+    )
+    dst_pool = await asyncpg.create_pool(
+        **target_ctx.conn_params, min_size=ctx.args.threads, max_size=ctx.args.threads
+    )
+    try:
+        for file_name, query in queries.items():
+            if len(tasks) >= ctx.args.threads:
+                # Wait for some transfer to finish before adding a new one
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                exception = done.pop().exception()
+                if exception is not None:
+                    raise exception
+            tasks.add(
+                loop.create_task(
+                    transfer_table(ctx, src_pool, dst_pool, query, sn_id, file_name, files[file_name])
+                )
+            )
+
+        # Wait for the remaining transfers to finish
+        done, _ = await asyncio.wait(tasks)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    finally:
+        await src_pool.close()
+        await dst_pool.close()
+
+    for file_name in files:
+        files[file_name].update(ctx.task_results[file_name])
+
+    target_ctx.metadata = {
+        "files": files,
+        "seq_lastvals": await get_seq_lastvals(ctx, db_conn, files),
+    }
+    target_ctx.total_rows = sum(int(v["rows"]) for v in files.values())
+
+
+async def make_transfer(ctx):
+    result = PgAnonResult()
+    ctx.logger.info("-------------> Started transfer mode")
+
+    try:
+        ctx.read_prepared_dict()
+        if not ctx.args.target_db_name:
+            raise ValueError("Option --target-db-name is required in transfer mode")
+        if ctx.args.dbg_stage_1_validate_dict or ctx.args.dbg_stage_2_validate_data or ctx.args.dbg_stage_3_validate_full:
+            raise ValueError("Debug stages are not supported in transfer mode, use dump and restore modes")
+    except:
+        ctx.logger.error("<------------- make_transfer failed\n" + exception_helper())
+        result.result_code = ResultCode.FAIL
+        return result
+
+    # Only structure dump of pg_dump is stored on disk, it is needed for pg_restore
+    with tempfile.TemporaryDirectory(prefix="pg_anon_transfer_") as work_dir:
+        ctx.args.output_dir = work_dir
+        target_ctx = get_target_context(ctx, work_dir)
+
+        db_conn = await asyncpg.connect(**ctx.conn_params)
+        try:
+            target_conn = await asyncpg.connect(**target_ctx.conn_params)
+            try:
+                db_is_empty = await target_conn.fetchval(
+                    """
+                    SELECT NOT EXISTS(
+                        SELECT table_schema, table_name
+                        FROM information_schema.tables
+                        WHERE table_schema not in (
+                                'pg_catalog',
+                                'information_schema',
+                                'anon_funcs'
+                            ) AND table_type = 'BASE TABLE'
+                    )"""
+                )
+            finally:
+                await target_conn.close()
+            if not db_is_empty:
+                raise Exception(f"Target DB {target_ctx.conn_params['database']} is not empty!")
+
+            async with db_conn.transaction(isolation='repeatable_read', readonly=True):
+                sn_id = await db_conn.fetchval("select pg_export_snapshot()")
+
+                # post-data is dumped in background, it is restored after data
+                post_data_task = asyncio.create_task(run_pg_dump(ctx, "post-data", sn_id))
+                try:
+                    await run_pg_dump(ctx, "pre-data", sn_id)
+                    await run_pg_restore(target_ctx, "pre-data")
+                    await make_transfer_impl(ctx, target_ctx, db_conn, sn_id)
+                finally:
+                    await post_data_task
+
+            await run_pg_restore(target_ctx, "post-data")
+            await seq_init(target_ctx)
+            await run_analyze(target_ctx)
+            result.result_code = ResultCode.DONE
+        except:
+            ctx.logger.error("<------------- make_transfer failed\n" + exception_helper())
+            result.result_code = ResultCode.FAIL
+        finally:
+            await db_conn.close()
+
+    if result.result_code == ResultCode.DONE:
+        ctx.logger.info(
+            "<------------- Finished transfer mode (%s rows transferred)" % target_ctx.total_rows
+        )
+    return result
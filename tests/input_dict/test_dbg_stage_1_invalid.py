@@ -0,0 +1,19 @@
+{
+	"dictionary": [
+		{
+			"schema":"schm_other_1",
+			"table":"some_tbl",
+			"fields": {
+					"val":"anon_funcs.not_existing_func(\"val\")"
+			}
+		},
+		{
+			"schema":"schm_other_2",
+			"table":"some_tbl",
+			"fields": {
+					"not_existing_field":"'text const'",
+					"val":"anon_funcs.digest(\"not_existing_field\", 'salt_word', 'md5')"
+			}
+		}
+	],
+}
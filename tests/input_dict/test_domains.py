@@ -0,0 +1,36 @@
+{
+	"domains": {
+		"email": "anon_funcs.random_string(12) || '@domain.com'",
+		"login": "anon_funcs.random_string(8)",
+	},
+	"dictionary": [
+		{
+			"schema":"public",
+			"table":"customers",
+			"fields": {
+					"email":"DOMAIN:email"
+			}
+		},
+		{
+			"schema":"public",
+			"table":"orders",
+			"fields": {
+					"customer_email":"DOMAIN:email"
+			}
+		},
+		{
+			"schema":"public",
+			"table":"accounts",
+			"fields": {
+					"login":"DOMAIN:login"
+			}
+		},
+		{
+			"schema":"public",
+			"table":"profiles",
+			"fields": {
+					"login":"DOMAIN:login"
+			}
+		}
+	],
+}
@@ -0,0 +1,11 @@
+{
+	"dictionary": [
+		{
+			"schema":"schm_other_2",
+			"table":"tbl_test_anon_functions",
+			"fields": {
+					"fld_3_txt":"'profile'"
+			}
+		}
+	]
+}
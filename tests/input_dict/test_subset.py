@@ -0,0 +1,28 @@
+{
+	"subset": [
+		{
+			"schema":"public",
+			"table":"orders",
+			"sample": 0.3
+		},
+		{
+			"schema":"public",
+			"table":"employees",
+			"where": "id <= 10"
+		},
+		{
+			"schema":"public",
+			"table":"d_bottom",
+			"where": "id <= 10"
+		}
+	],
+	"dictionary": [
+		{
+			"schema":"public",
+			"table":"customers",
+			"fields": {
+					"email":"anon_funcs.partial_email(email)"
+			}
+		}
+	],
+}
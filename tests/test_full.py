@@ -1,8 +1,13 @@
+import asyncio
 import copy
+import hashlib
 import json
+import logging
 import os
 import re
+import shutil
 import sys
+import time
 import unittest
 from decimal import Decimal
 from typing import Dict, Set
@@ -12,7 +17,10 @@ import asyncpg
 from pg_anon import MainRoutine
 from pg_anon.common.db_utils import get_scan_fields_count
 from pg_anon.common.dto import PgAnonResult
-from pg_anon.common.enums import ResultCode
+from pg_anon.common.enums import OutputCodec, ResultCode
+from pg_anon.common.client_anon import compile_client_rule, split_tuples
+from pg_anon.common.codecs import check_codec_available
+from pg_anon.common.throttle import ConcurrencyTuner, RateLimiter
 from pg_anon.common.utils import (
     exception_helper,
     recordset_to_list_flat,
@@ -20,6 +28,7 @@ from pg_anon.common.utils import (
     get_file_name_from_path,
 )
 from pg_anon.context import Context
+from pg_anon.dump import SubsetGraph, get_query_hash, get_subset_condition, retry_on_recovery_conflict
 from pg_anon.view_data import ViewDataMode
 from pg_anon.view_fields import ViewFieldsMode
 
@@ -455,6 +464,19 @@ class BasicUnitTest:
     def get_test_output_path(dir_name: str) -> str:
         return os.path.join(os.getcwd(), 'tests', 'output', dir_name)
 
+    @staticmethod
+    def get_db_args(db_name: str, extra_args: list = None):
+        return Context.get_arg_parser().parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={db_name}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                *(extra_args or []),
+            ]
+        )
+
     def save_and_compare_result(self, file_name, list_objects):
         saved_results_file_path = os.path.join(os.getcwd(), 'tests', 'saved_results')
         os.makedirs(saved_results_file_path, exist_ok=True)
@@ -673,233 +695,1689 @@ class PGAnonUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
                 "--debug",
             ]
         )
-
-        res = await MainRoutine(args).run()
-        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_2",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+        res = await MainRoutine(args).validate_target_tables()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("test_05_restore")
+
+    async def test_06_sync_struct(self):
+        self.assertTrue("test_05_restore" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test_sync_struct.py")
+        dict_file_name = get_file_name_from_path(prepared_sens_dict_file)
+        output_dir = self.get_test_output_path(dict_file_name)
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=sync-struct-dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                "--verbose=debug",
+                "--clear-output-dir",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_3",  # here will be created 3 empty tables
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=sync-struct-restore",
+                f"--input-dir={output_dir}",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        self.assertTrue(
+            await self.check_list_tables(
+                args,
+                [  # TODO: get list tables from specific dict
+                    ["schm_other_2", "exclude_tbl"],
+                    ["schm_other_2", "some_tbl"],
+                    ["schm_mask_include_1", "tbl_123"],
+                ],
+            )
+        )
+
+        objs = [
+            ["schm_other_2", "exclude_tbl", 0],
+            ["schm_other_2", "some_tbl", 0],
+            ["schm_mask_include_1", "tbl_123", 0],
+        ]
+        self.assertTrue(await self.check_rows_count(args, objs))
+
+        self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("test_06_sync_struct")
+
+    async def test_07_sync_data(self):
+        # --mode=sync-data-dump ---> --mode=sync-data-restore [3 empty tables already exists]
+        self.assertTrue("test_06_sync_struct" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test_sync_data.py")
+        dict_file_name = get_file_name_from_path(prepared_sens_dict_file)
+        output_dir = self.get_test_output_path(dict_file_name)
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=sync-data-dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                "--verbose=debug",
+                "--clear-output-dir",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_3",  # here target DB have 3 empty tables
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=sync-data-restore",
+                f"--input-dir={output_dir}",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        self.assertTrue(
+            await self.check_list_tables(
+                args,
+                [  # TODO: get list tables from specific dict
+                    ["schm_other_2", "exclude_tbl"],
+                    ["schm_other_2", "some_tbl"],
+                    ["schm_mask_include_1", "tbl_123"],
+                ],
+            )
+        )
+
+        objs = [
+            ["schm_other_2", "exclude_tbl", rows_in_init_env * int(params.test_scale)],
+            ["schm_other_2", "some_tbl", rows_in_init_env * int(params.test_scale)],
+            [
+                "schm_mask_include_1",
+                "tbl_123",
+                rows_in_init_env * int(params.test_scale),
+            ],
+        ]
+        self.assertTrue(await self.check_rows_count(args, objs))
+
+        rows = [[3, "t***l_3"], [4, "t***l_4"]]
+        self.assertTrue(
+            await self.check_rows(args, "schm_mask_include_1", "tbl_123", None, rows)
+        )
+
+        self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("test_07_sync_data")
+
+    async def test_08_sync_data(self):
+        # --mode=sync-data-dump ---> --mode=sync-data-restore [target DB is not empty]
+        self.assertTrue("test_07_sync_data" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test_sync_data_2.py")
+        dict_file_name = get_file_name_from_path(prepared_sens_dict_file)
+        output_dir = self.get_test_output_path(dict_file_name)
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=sync-data-dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                "--verbose=debug",
+                "--clear-output-dir",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}",  # here target DB is NOT empty
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=sync-data-restore",  # just sync data of specific tables from test_sync_data_2.py
+                f"--input-dir={output_dir}",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        ctx = Context(args)
+        db_conn = await asyncpg.connect(**ctx.conn_params)
+        # pg_anon does not clear tables on its own
+        await db_conn.execute("TRUNCATE TABLE schm_other_1.some_tbl")  # manual clean
+        await db_conn.execute("TRUNCATE TABLE schm_other_2.some_tbl")
+        await db_conn.close()
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        objs = [
+            ["schm_other_1", "some_tbl", rows_in_init_env * int(params.test_scale)],
+            ["schm_other_2", "some_tbl", rows_in_init_env * int(params.test_scale)],
+        ]
+        self.assertTrue(await self.check_rows_count(args, objs))
+
+        self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("test_08_sync_data")
+
+
+class PGAnonSplitTablesUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_split_dump(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        output_dir = self.get_test_output_path("test_split_tables")
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                f"--threads={params.test_threads}",
+                "--split-table-size=1",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+        for file_name, file_info in metadata["files"].items():
+            self.assertTrue(os.path.exists(os.path.join(output_dir, file_name)))
+            if "part" in file_info:
+                self.assertTrue(1 <= file_info["part"] <= file_info["parts"])
+
+        passed_stages.append("test_02_split_dump")
+
+    async def test_03_split_restore(self):
+        self.assertTrue("test_02_split_dump" in passed_stages)
+
+        input_dir = self.get_test_output_path("test_split_tables")
+        parser = Context.get_arg_parser()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                "--db-name=postgres",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        await DBOperations.init_db(db_conn, params.test_target_db + "_split")
+        await db_conn.close()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_split",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=restore",
+                f"--input-dir={input_dir}",
+                "--drop-custom-check-constr",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_04_split_dump_ordered_by_prev_dump(self):
+        self.assertTrue("test_02_split_dump" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        prev_dump_dir = self.get_test_output_path("test_split_tables")
+        output_dir = self.get_test_output_path("test_split_tables_ordered")
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=sync-data-dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                f"--prev-dump-dir={prev_dump_dir}",
+                f"--threads={params.test_threads}",
+                "--split-table-size=1",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+        for file_info in metadata["files"].values():
+            self.assertIn("elapsed", file_info)
+
+
+    async def test_05_resume_split_dump(self):
+        self.assertTrue("test_02_split_dump" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        output_dir = self.get_test_output_path("test_split_tables")
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+
+        # Imitate dump interrupted after the first task
+        with open(os.path.join(output_dir, "manifest.jsonl"), "r") as manifest_file:
+            manifest_lines = manifest_file.readlines()
+        self.assertEqual(len(manifest_lines), len(metadata["files"]))
+        with open(os.path.join(output_dir, "manifest.jsonl"), "w") as manifest_file:
+            manifest_file.write(manifest_lines[0] + '{"file": "broken')
+        os.remove(os.path.join(output_dir, "metadata.json"))
+        os.remove(os.path.join(output_dir, json.loads(manifest_lines[1])["file"]))
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                f"--threads={params.test_threads}",
+                "--split-table-size=1",
+                "--resume",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            resumed_metadata = json.loads(metadata_file.read())
+        self.assertEqual(resumed_metadata["files"].keys(), metadata["files"].keys())
+        self.assertEqual(resumed_metadata["total_rows"], metadata["total_rows"])
+        for file_name in resumed_metadata["files"]:
+            self.assertTrue(os.path.exists(os.path.join(output_dir, file_name)))
+
+
+    async def test_06_incremental_split_dump(self):
+        self.assertTrue("test_02_split_dump" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        base_dir = self.get_test_output_path("test_split_tables")
+        output_dir = self.get_test_output_path("test_split_tables_incremental")
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=sync-data-dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                f"--base-dir={base_dir}",
+                f"--threads={params.test_threads}",
+                "--split-table-size=1",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(base_dir, "metadata.json"), "r") as metadata_file:
+            base_metadata = json.loads(metadata_file.read())
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+
+        self.assertEqual(metadata["base_dir"], base_dir)
+        self.assertEqual(metadata["total_rows"], base_metadata["total_rows"])
+        for file_name, file_info in metadata["files"].items():
+            base_file_info = base_metadata["files"][file_name]
+            if file_info["signature"] is not None and file_info["signature"] == base_file_info["signature"]:
+                self.assertTrue(
+                    os.path.samefile(os.path.join(output_dir, file_name), os.path.join(base_dir, file_name))
+                )
+
+
+class PGAnonBatchTablesUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_batch_dump(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        output_dir = self.get_test_output_path("test_batch_tables")
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                f"--threads={params.test_threads}",
+                "--batch-table-size=1024",
+                "--batch-tables=3",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+        batches = {}
+        for file_info in metadata["files"].values():
+            if "batch" in file_info:
+                batches[file_info["batch"]] = batches.get(file_info["batch"], 0) + 1
+        self.assertTrue(batches)
+        self.assertTrue(all(1 < batch_size <= 3 for batch_size in batches.values()))
+        passed_stages.append("test_02_batch_dump")
+
+    async def test_03_batch_restore(self):
+        self.assertTrue("test_02_batch_dump" in passed_stages)
+
+        input_dir = self.get_test_output_path("test_batch_tables")
+        parser = Context.get_arg_parser()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                "--db-name=postgres",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        await DBOperations.init_db(db_conn, params.test_target_db + "_batch")
+        await db_conn.close()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_batch",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=restore",
+                f"--input-dir={input_dir}",
+                "--drop-custom-check-constr",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+
+class PGAnonArchiveUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_archive_dump(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        output_dir = self.get_test_output_path("test_archive")
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                f"--threads={params.test_threads}",
+                "--archive-segments=2",
+                "--split-table-size=1",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+        self.assertEqual(metadata["segments"], ["segment_1.seg", "segment_2.seg"])
+        for file_name, file_info in metadata["files"].items():
+            self.assertFalse(os.path.exists(os.path.join(output_dir, file_name)))
+            self.assertIn(file_info["segment"], metadata["segments"])
+            self.assertLessEqual(
+                file_info["offset"] + file_info["length"],
+                os.path.getsize(os.path.join(output_dir, file_info["segment"])),
+            )
+        passed_stages.append("test_02_archive_dump")
+
+    async def test_03_archive_restore(self):
+        self.assertTrue("test_02_archive_dump" in passed_stages)
+
+        input_dir = self.get_test_output_path("test_archive")
+        parser = Context.get_arg_parser()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                "--db-name=postgres",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        await DBOperations.init_db(db_conn, params.test_target_db + "_archive")
+        await db_conn.close()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_archive",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=restore",
+                f"--input-dir={input_dir}",
+                "--drop-custom-check-constr",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+
+class PGAnonDistributedUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_distributed_dump(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        output_dir = self.get_test_output_path("test_distributed")
+        worker_output_dir = self.get_test_output_path("test_distributed_worker")
+        shutil.rmtree(worker_output_dir, ignore_errors=True)
+
+        coordinator_args = self.get_db_args(
+            params.test_source_db,
+            [
+                "--mode=dump",
+                f"--prepared-sens-dict-file={self.get_test_dict_path('test.py')}",
+                f"--output-dir={output_dir}",
+                "--threads=1",
+                "--distributed",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+        coordinator = asyncio.create_task(MainRoutine(coordinator_args).run())
+
+        # worker is started, when the plan is written by coordinator
+        db_conn = await asyncpg.connect(**Context(self.get_db_args(params.test_source_db)).conn_params)
+        snapshot = None
+        for _ in range(600):
+            if coordinator.done():
+                break
+            if await db_conn.fetchval("SELECT to_regclass('anon_funcs.dump_tasks') IS NOT NULL"):
+                snapshot = await db_conn.fetchval("SELECT max(snapshot) FROM anon_funcs.dump_tasks")
+                if snapshot is not None:
+                    break
+            await asyncio.sleep(0.1)
+        await db_conn.close()
+
+        if snapshot is not None:
+            worker_args = self.get_db_args(
+                params.test_source_db,
+                [
+                    "--mode=dump-worker",
+                    f"--snapshot={snapshot}",
+                    f"--output-dir={worker_output_dir}",
+                    f"--threads={params.test_threads}",
+                    "--verbose=debug",
+                ]
+            )
+            res = await MainRoutine(worker_args).run()
+            self.assertEqual(res.result_code, ResultCode.DONE)
+
+        res = await coordinator
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+        for file_name, file_info in metadata["files"].items():
+            self.assertIn("worker", file_info)
+            # files of worker are gathered into the directory of coordinator for restore
+            if file_info["worker"].endswith(f":{worker_output_dir}"):
+                shutil.copy2(os.path.join(worker_output_dir, file_name), os.path.join(output_dir, file_name))
+
+        # plan is removed after dump
+        db_conn = await asyncpg.connect(**Context(self.get_db_args(params.test_source_db)).conn_params)
+        plan_tasks = await db_conn.fetchval("SELECT count(1) FROM anon_funcs.dump_tasks")
+        await db_conn.close()
+        self.assertEqual(plan_tasks, 0)
+        passed_stages.append("test_02_distributed_dump")
+
+    async def test_03_distributed_restore(self):
+        self.assertTrue("test_02_distributed_dump" in passed_stages)
+
+        db_conn = await asyncpg.connect(**Context(self.get_db_args("postgres")).conn_params)
+        await DBOperations.init_db(db_conn, params.test_target_db + "_distributed")
+        await db_conn.close()
+
+        args = self.get_db_args(
+            params.test_target_db + "_distributed",
+            [
+                "--mode=restore",
+                f"--input-dir={self.get_test_output_path('test_distributed')}",
+                f"--threads={params.test_threads}",
+                "--drop-custom-check-constr",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+
+class PGAnonTaskRetriesUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    def get_context(self, extra_args: list):
+        ctx = Context(
+            Context.get_arg_parser().parse_args(
+                [
+                    f"--db-host={params.test_db_host}",
+                    f"--db-name={params.test_source_db}",
+                    f"--db-user={params.test_db_user}",
+                    f"--db-port={params.test_db_port}",
+                    "--mode=dump",
+                    "--task-retry-delay=0.01",
+                    *extra_args,
+                ]
+            )
+        )
+        ctx.logger = logging.getLogger(__name__)
+        return ctx
+
+    async def test_01_retry_on_recovery_conflict(self):
+        ctx = self.get_context(["--task-retries=2"])
+        attempts = []
+
+        async def task():
+            attempts.append(len(attempts))
+            if len(attempts) <= 2:
+                raise asyncpg.exceptions.SerializationError("canceling statement due to conflict with recovery")
+            return "COPY 10"
+
+        self.assertEqual(await retry_on_recovery_conflict(ctx, task, "test"), "COPY 10")
+        self.assertEqual(len(attempts), 3)
+
+    async def test_02_retries_are_limited(self):
+        ctx = self.get_context(["--task-retries=1"])
+        attempts = []
+
+        async def task():
+            attempts.append(len(attempts))
+            raise asyncpg.exceptions.SerializationError("canceling statement due to conflict with recovery")
+
+        with self.assertRaises(asyncpg.exceptions.SerializationError):
+            await retry_on_recovery_conflict(ctx, task, "test")
+        self.assertEqual(len(attempts), 2)
+
+    async def test_03_other_errors_are_not_retried(self):
+        ctx = self.get_context([])
+        attempts = []
+
+        async def task():
+            attempts.append(len(attempts))
+            raise asyncpg.exceptions.UndefinedTableError("relation does not exist")
+
+        with self.assertRaises(asyncpg.exceptions.UndefinedTableError):
+            await retry_on_recovery_conflict(ctx, task, "test")
+        self.assertEqual(len(attempts), 1)
+
+    async def test_04_lost_snapshot_is_not_retried(self):
+        ctx = self.get_context(["--task-retries=2"])
+        attempts = []
+
+        async def task():
+            attempts.append(len(attempts))
+            if len(attempts) == 1:
+                raise asyncpg.exceptions.SerializationError("canceling statement due to conflict with recovery")
+            # exporting session is terminated by conflict too, so the snapshot can't be imported
+            raise asyncpg.exceptions.UndefinedObjectError('snapshot "00000003-0000001B-1" does not exist')
+
+        with self.assertRaisesRegex(Exception, "exported snapshot is lost"):
+            await retry_on_recovery_conflict(ctx, task, "test")
+        self.assertEqual(len(attempts), 2)
+
+
+class PGAnonThrottleUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_rate_limiter(self):
+        rate_limiter = RateLimiter(10 * 1024 * 1024)
+        start_t = time.monotonic()
+        for _ in range(5):
+            await rate_limiter.acquire(1024 * 1024)
+        self.assertGreaterEqual(time.monotonic() - start_t, 0.45)
+
+    async def test_02_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_03_throttled_dump(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={self.get_test_dict_path('test.py')}",
+                f"--output-dir={self.get_test_output_path('test_throttle')}",
+                f"--threads={params.test_threads}",
+                "--throttle-rate=100",
+                # sessions of dump itself exceed the limit, so concurrency is decreased
+                "--load-max-active-sessions=1",
+                "--load-check-interval=0.1",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_04_concurrency_tuner(self):
+        ctx = Context(Context.get_arg_parser().parse_args(["--mode=dump", "--threads=4"]))
+        ctx.logger = logging.getLogger(__name__)
+        tuner = ConcurrencyTuner(ctx, ctx.args.threads)
+        self.assertEqual(tuner.concurrency, 1)
+
+        tuner.tune(0)  # nothing measured yet
+        self.assertEqual(tuner.concurrency, 1)
+        tuner.tune(100)
+        tuner.tune(180)
+        self.assertEqual(tuner.concurrency, 3)
+        tuner.tune(185)  # plateau, the best level is chosen
+        self.assertEqual(tuner.concurrency, 2)
+        self.assertTrue(tuner.settled)
+        tuner.tune(500)
+        self.assertEqual(tuner.concurrency, 2)
+        tuner.tune(100, contention=0.8)
+        self.assertEqual(tuner.concurrency, 1)
+        tuner.tune(100, contention=0.8)
+        self.assertEqual(tuner.concurrency, 1)
+
+        tuner = ConcurrencyTuner(ctx, ctx.args.threads)
+        for throughput in (100, 200, 300, 400):
+            tuner.tune(throughput)
+        self.assertEqual(tuner.concurrency, 4)
+        self.assertTrue(tuner.settled)
+
+    async def test_05_auto_concurrency_dump_restore(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        output_dir = self.get_test_output_path('test_auto_concurrency')
+        args = Context.get_arg_parser().parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={self.get_test_dict_path('test.py')}",
+                f"--output-dir={output_dir}",
+                f"--threads={params.test_threads}",
+                "--auto-concurrency",
+                "--auto-concurrency-interval=0.1",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as f:
+            metadata = json.load(f)
+        self.assertTrue(1 <= metadata["auto_concurrency"] <= params.test_threads)
+
+        target_db = params.test_target_db + "_auto_concurrency"
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        await DBOperations.init_db(db_conn, target_db)
+        await db_conn.close()
+
+        args = Context.get_arg_parser().parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={target_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=restore",
+                f"--input-dir={output_dir}",
+                f"--threads={params.test_threads}",
+                "--auto-concurrency",
+                "--auto-concurrency-interval=0.1",
+                "--drop-custom-check-constr",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+
+class PGAnonClientEngineUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_client_engine_dump(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={self.get_test_dict_path('test.py')}",
+                f"--output-dir={self.get_test_output_path('test_client_engine')}",
+                f"--threads={params.test_threads}",
+                "--anon-engine=client",
+                "--anon-processes=2",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("test_02_client_engine_dump")
+
+    async def test_03_client_engine_restore(self):
+        self.assertTrue("test_02_client_engine_dump" in passed_stages)
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                "--db-name=postgres",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        await DBOperations.init_db(db_conn, params.test_target_db + "_client_engine")
+        await db_conn.close()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_client_engine",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=restore",
+                f"--input-dir={self.get_test_output_path('test_client_engine')}",
+                "--drop-custom-check-constr",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        # deterministic functions give the same values as anon_funcs in database
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        rows = await db_conn.fetch(
+            "SELECT id, fld_3_txt, fld_4_txt, fld_5_email, fld_15_txt FROM schm_other_2.tbl_test_anon_functions"
+        )
+        await db_conn.close()
+        self.assertEqual(len(rows), 1512)
+        for row in rows:
+            v = row["id"]
+            self.assertEqual(row["fld_3_txt"], hashlib.sha256(f"fld_3_txt_{v}salt".encode()).hexdigest())
+            self.assertEqual(row["fld_4_txt"], f"f***{f'fld_4_txt_{v}'[-3:]}")
+            self.assertEqual(row["fld_5_email"], "in******@co******.com")
+            # function, which is not supported by client engine, is evaluated by database
+            self.assertEqual(row["fld_15_txt"], str(v))
+
+    async def test_04_query_hash_with_client_rules(self):
+        query = 'SELECT "fld_3_txt" as "fld_3_txt" FROM "schm_other_2"."tbl_test_anon_functions"'
+        rules = {0: compile_client_rule("anon_funcs.digest(fld_3_txt, 'salt', 'sha256')", "fld_3_txt", "text")}
+        changed_rules = {0: compile_client_rule("anon_funcs.digest(fld_3_txt, 'salt2', 'sha256')", "fld_3_txt", "text")}
+        self.assertEqual(get_query_hash(query, rules), get_query_hash(query, dict(rules)))
+        self.assertNotEqual(get_query_hash(query, rules), get_query_hash(query))
+        self.assertNotEqual(get_query_hash(query, rules), get_query_hash(query, changed_rules))
+
+
+class PGAnonProfilesUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_split_tuples(self):
+        def field(value):
+            return b"\xff\xff\xff\xff" if value is None else len(value).to_bytes(4, "big") + value
+
+        data = b"".join(
+            (3).to_bytes(2, "big") + field(f"{i}".encode()) + field(None) + field(f"v{i}".encode()) for i in range(3)
+        )
+        first, second = split_tuples(data, [2, 1])
+        self.assertEqual(
+            first,
+            b"".join((2).to_bytes(2, "big") + field(f"{i}".encode()) + field(None) for i in range(3)),
+        )
+        self.assertEqual(second, b"".join((1).to_bytes(2, "big") + field(f"v{i}".encode()) for i in range(3)))
+
+    async def test_02_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_03_profiles_dump(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        output_dir = self.get_test_output_path("test_profiles")
+        args = Context.get_arg_parser().parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--profile=full={self.get_test_dict_path('test.py')}",
+                f"--profile=partial={self.get_test_dict_path('test_profile.py')}",
+                f"--output-dir={output_dir}",
+                f"--threads={params.test_threads}",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        profiles_metadata = {}
+        for profile in ("full", "partial"):
+            with open(os.path.join(output_dir, profile, "metadata.json"), "r") as f:
+                profiles_metadata[profile] = json.load(f)
+            self.assertEqual(profiles_metadata[profile]["profile"], profile)
+            self.assertTrue(os.path.exists(os.path.join(output_dir, profile, "pre_data.backup")))
+
+        # the same table has the same rows in all profiles
+        for file_name, file_info in profiles_metadata["partial"]["files"].items():
+            if file_name in profiles_metadata["full"]["files"]:
+                self.assertEqual(file_info["rows"], profiles_metadata["full"]["files"][file_name]["rows"])
+
+    async def test_04_profiles_restore(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        for profile in ("full", "partial"):
+            args = Context.get_arg_parser().parse_args(
+                [
+                    f"--db-host={params.test_db_host}",
+                    f"--db-name={params.test_target_db}_profile_{profile}",
+                    f"--db-user={params.test_db_user}",
+                    f"--db-port={params.test_db_port}",
+                    f"--db-user-password={params.test_db_user_password}",
+                    f"--threads={params.test_threads}",
+                    "--mode=restore",
+                    f"--input-dir={os.path.join(self.get_test_output_path('test_profiles'), profile)}",
+                    "--drop-custom-check-constr",
+                    "--verbose=debug",
+                    "--debug",
+                ]
+            )
+            db_conn = await asyncpg.connect(**Context(args).conn_params)
+            await DBOperations.init_db(db_conn, f"{params.test_target_db}_profile_{profile}")
+            await db_conn.close()
+
+            res = await MainRoutine(args).run()
+            self.assertEqual(res.result_code, ResultCode.DONE)
+
+            db_conn = await asyncpg.connect(**Context(args).conn_params)
+            rows = await db_conn.fetch("SELECT id, fld_3_txt, fld_4_txt FROM schm_other_2.tbl_test_anon_functions")
+            await db_conn.close()
+            self.assertEqual(len(rows), 1512)
+            for row in rows:
+                v = row["id"]
+                if profile == "full":
+                    self.assertEqual(row["fld_3_txt"], hashlib.sha256(f"fld_3_txt_{v}salt".encode()).hexdigest())
+                    self.assertEqual(row["fld_4_txt"], f"f***{f'fld_4_txt_{v}'[-3:]}")
+                else:
+                    self.assertEqual(row["fld_3_txt"], "profile")
+                    self.assertEqual(row["fld_4_txt"], f"fld_4_txt_{v}")
+
+
+class PGAnonStripeDirsUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_stripe_dump(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        output_dir = self.get_test_output_path("test_stripes")
+        stripe_dirs = [self.get_test_output_path("test_stripes_2"), self.get_test_output_path("test_stripes_3")]
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                f"--stripe-dirs={','.join(stripe_dirs)}",
+                f"--threads={params.test_threads}",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+        self.assertEqual(metadata["stripe_dirs"], stripe_dirs)
+        output_dirs = [output_dir, *stripe_dirs]
+        used_stripes = set()
+        for file_name, file_info in metadata["files"].items():
+            stripe = file_info.get("stripe", 0)
+            used_stripes.add(stripe)
+            self.assertTrue(os.path.exists(os.path.join(output_dirs[stripe], file_name)))
+        self.assertEqual(used_stripes, {0, 1, 2})
+        passed_stages.append("test_02_stripe_dump")
+
+    async def test_03_stripe_restore(self):
+        self.assertTrue("test_02_stripe_dump" in passed_stages)
+
+        input_dir = self.get_test_output_path("test_stripes")
+        parser = Context.get_arg_parser()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                "--db-name=postgres",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        await DBOperations.init_db(db_conn, params.test_target_db + "_stripes")
+        await db_conn.close()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_stripes",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--threads={params.test_threads}",
+                "--mode=restore",
+                f"--input-dir={input_dir}",
+                "--drop-custom-check-constr",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+
+class PGAnonTransferUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_transfer(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        parser = Context.get_arg_parser()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                "--db-name=postgres",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        await DBOperations.init_db(db_conn, params.test_target_db + "_transfer")
+        await db_conn.close()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                f"--target-db-name={params.test_target_db}_transfer",
+                "--mode=transfer",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--threads={params.test_threads}",
+                "--split-table-size=1",
+                "--transfer-buffer-size=2",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        target_args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_target_db}_transfer",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        self.assertTrue(
+            await self.check_rows_count(
+                target_args,
+                [
+                    ["schm_other_1", "some_tbl", rows_in_init_env * int(params.test_scale)],
+                    ["schm_other_2", "some_tbl", rows_in_init_env * int(params.test_scale)],
+                    ["schm_other_2", "exclude_tbl", 0],
+                ],
+            )
+        )
+
+
+class PGAnonVerifyUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    async def test_01_init(self):
+        res = await self.init_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_dump_with_checksums(self):
+        self.assertTrue("init_env" in passed_stages)
+
+        prepared_sens_dict_file = self.get_test_dict_path("test.py")
+        output_dir = self.get_test_output_path("test_verify")
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                f"--db-name={params.test_source_db}",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                f"--output-dir={output_dir}",
+                f"--threads={params.test_threads}",
+                "--clear-output-dir",
+                "--verbose=debug",
+                "--debug",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+        for file_name, file_info in metadata["files"].items():
+            self.assertEqual(file_info["size"], os.path.getsize(os.path.join(output_dir, file_name)))
+            self.assertEqual(len(file_info["sha256"]), 64)
+            self.assertGreaterEqual(file_info["raw_size"], 0)
+        passed_stages.append("test_02_dump_with_checksums")
+
+    async def test_03_verify(self):
+        self.assertTrue("test_02_dump_with_checksums" in passed_stages)
+
+        # verify mode doesn't connect to database, so connection arguments are not valid on purpose
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                "--db-host=not-existing-host",
+                "--mode=verify",
+                f"--input-dir={self.get_test_output_path('test_verify')}",
+                f"--threads={params.test_threads}",
+            ]
+        )
+
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("test_03_verify")
+
+    async def test_04_verify_corrupted(self):
+        self.assertTrue("test_03_verify" in passed_stages)
+
+        input_dir = self.get_test_output_path("test_verify")
+        with open(os.path.join(input_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+        file_name = max(metadata["files"], key=lambda v: metadata["files"][v]["size"])
+        with open(os.path.join(input_dir, file_name), "r+b") as f:
+            f.seek(metadata["files"][file_name]["size"] // 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xFF]))
+
+        parser = Context.get_arg_parser()
+        args = parser.parse_args(
+            [
+                "--mode=verify",
+                f"--input-dir={input_dir}",
+                f"--threads={params.test_threads}",
+            ]
+        )
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.FAIL)
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                "--db-name=postgres",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        await DBOperations.init_db(db_conn, params.test_target_db + "_verify")
+        await db_conn.close()
 
         args = parser.parse_args(
             [
                 f"--db-host={params.test_db_host}",
-                f"--db-name={params.test_target_db}_2",
+                f"--db-name={params.test_target_db}_verify",
                 f"--db-user={params.test_db_user}",
                 f"--db-port={params.test_db_port}",
                 f"--db-user-password={params.test_db_user_password}",
                 f"--threads={params.test_threads}",
-                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                "--mode=restore",
+                f"--input-dir={input_dir}",
+                "--verify-before-restore",
                 "--verbose=debug",
-                "--debug",
             ]
         )
-        res = await MainRoutine(args).validate_target_tables()
-        self.assertEqual(res.result_code, ResultCode.DONE)
-        passed_stages.append("test_05_restore")
+        res = await MainRoutine(args).run()
+        self.assertNotEqual(res.result_code, ResultCode.DONE)
 
-    async def test_06_sync_struct(self):
-        self.assertTrue("test_05_restore" in passed_stages)
+        # pre-data must not be restored from corrupted dump
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        tables_count = await db_conn.fetchval(
+            "SELECT count(1) FROM information_schema.tables WHERE table_schema NOT IN ('pg_catalog', 'information_schema')"
+        )
+        await db_conn.close()
+        self.assertEqual(tables_count, 0)
+        passed_stages.append("test_04_verify_corrupted")
 
-        prepared_sens_dict_file = self.get_test_dict_path("test_sync_struct.py")
-        dict_file_name = get_file_name_from_path(prepared_sens_dict_file)
-        output_dir = self.get_test_output_path(dict_file_name)
 
-        parser = Context.get_arg_parser()
-        args = parser.parse_args(
+class PGAnonPartitionsUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    source_db = params.test_source_db + "_partitions"
+    target_db = params.test_target_db + "_partitions"
+
+    async def test_01_init(self):
+        db_conn = await asyncpg.connect(**Context(self.get_db_args("postgres")).conn_params)
+        await DBOperations.init_db(db_conn, self.source_db)
+        await DBOperations.init_db(db_conn, self.target_db)
+        await db_conn.close()
+
+        db_conn = await asyncpg.connect(**Context(self.get_db_args(self.source_db)).conn_params)
+        await db_conn.execute(
+            """
+            CREATE TABLE public.events (id bigint, created date, val text) PARTITION BY RANGE (created);
+            CREATE TABLE public.events_2023 PARTITION OF public.events
+                FOR VALUES FROM ('2023-01-01') TO ('2024-01-01');
+            CREATE TABLE public.events_2024 PARTITION OF public.events
+                FOR VALUES FROM ('2024-01-01') TO ('2025-01-01') PARTITION BY HASH (id);
+            CREATE TABLE public.events_2024_0 PARTITION OF public.events_2024 FOR VALUES WITH (MODULUS 2, REMAINDER 0);
+            CREATE TABLE public.events_2024_1 PARTITION OF public.events_2024 FOR VALUES WITH (MODULUS 2, REMAINDER 1);
+            INSERT INTO public.events
+            SELECT v, date '2023-01-01' + (v % 730), 'val_' || v FROM generate_series(1, 1000) v;
+            """
+        )
+        await db_conn.close()
+
+        res = await MainRoutine(self.get_db_args(self.source_db, ["--mode=init"])).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("init_partitions_env")
+
+    async def test_02_dump(self):
+        self.assertTrue("init_partitions_env" in passed_stages)
+
+        output_dir = self.get_test_output_path("test_partitions")
+        args = self.get_db_args(
+            self.source_db,
             [
-                f"--db-host={params.test_db_host}",
-                f"--db-name={params.test_source_db}",
-                f"--db-user={params.test_db_user}",
-                f"--db-port={params.test_db_port}",
-                f"--db-user-password={params.test_db_user_password}",
-                f"--threads={params.test_threads}",
-                "--mode=sync-struct-dump",
-                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={self.get_test_dict_path('test.py')}",
                 f"--output-dir={output_dir}",
-                "--verbose=debug",
+                f"--threads={params.test_threads}",
                 "--clear-output-dir",
+                "--verbose=debug",
                 "--debug",
             ]
         )
-
         res = await MainRoutine(args).run()
         self.assertEqual(res.result_code, ResultCode.DONE)
 
-        args = parser.parse_args(
+        with open(os.path.join(output_dir, "metadata.json"), "r") as metadata_file:
+            metadata = json.loads(metadata_file.read())
+
+        dumped_tables = {file_info["table"] for file_info in metadata["files"].values()}
+        self.assertEqual(dumped_tables, {"events_2023", "events_2024_0", "events_2024_1"})
+        self.assertEqual(metadata["total_rows"], 1000)
+        self.assertEqual(metadata["partitions"]["public.events_2024_0"]["parent_table"], "events_2024")
+        self.assertEqual(metadata["partitions"]["public.events_2024_0"]["root_table"], "events")
+        passed_stages.append("test_02_partitions_dump")
+
+    async def test_03_restore(self):
+        self.assertTrue("test_02_partitions_dump" in passed_stages)
+
+        args = self.get_db_args(
+            self.target_db,
             [
-                f"--db-host={params.test_db_host}",
-                f"--db-name={params.test_target_db}_3",  # here will be created 3 empty tables
-                f"--db-user={params.test_db_user}",
-                f"--db-port={params.test_db_port}",
-                f"--db-user-password={params.test_db_user_password}",
+                "--mode=restore",
+                f"--input-dir={self.get_test_output_path('test_partitions')}",
                 f"--threads={params.test_threads}",
-                "--mode=sync-struct-restore",
-                f"--input-dir={output_dir}",
                 "--verbose=debug",
                 "--debug",
             ]
         )
-
         res = await MainRoutine(args).run()
         self.assertEqual(res.result_code, ResultCode.DONE)
 
         self.assertTrue(
-            await self.check_list_tables(
-                args,
-                [  # TODO: get list tables from specific dict
-                    ["schm_other_2", "exclude_tbl"],
-                    ["schm_other_2", "some_tbl"],
-                    ["schm_mask_include_1", "tbl_123"],
+            await self.check_rows_count(
+                self.get_db_args(self.target_db),
+                [
+                    ["public", "events", 1000],
+                    ["public", "events_2023", 635],
+                    ["public", "events_2024", 365],
                 ],
             )
         )
 
-        objs = [
-            ["schm_other_2", "exclude_tbl", 0],
-            ["schm_other_2", "some_tbl", 0],
-            ["schm_mask_include_1", "tbl_123", 0],
-        ]
-        self.assertTrue(await self.check_rows_count(args, objs))
 
-        self.assertEqual(res.result_code, ResultCode.DONE)
-        passed_stages.append("test_06_sync_struct")
+class PGAnonDomainsUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    source_db = params.test_source_db + "_domains"
+    target_db = params.test_target_db + "_domains"
 
-    async def test_07_sync_data(self):
-        # --mode=sync-data-dump ---> --mode=sync-data-restore [3 empty tables already exists]
-        self.assertTrue("test_06_sync_struct" in passed_stages)
+    async def test_01_init(self):
+        db_conn = await asyncpg.connect(**Context(self.get_db_args("postgres")).conn_params)
+        await DBOperations.init_db(db_conn, self.source_db)
+        await DBOperations.init_db(db_conn, self.target_db)
+        await db_conn.close()
 
-        prepared_sens_dict_file = self.get_test_dict_path("test_sync_data.py")
-        dict_file_name = get_file_name_from_path(prepared_sens_dict_file)
-        output_dir = self.get_test_output_path(dict_file_name)
+        db_conn = await asyncpg.connect(**Context(self.get_db_args(self.source_db)).conn_params)
+        await db_conn.execute(
+            """
+            CREATE TABLE public.customers (id bigint PRIMARY KEY, email text);
+            CREATE TABLE public.orders (id bigint PRIMARY KEY, customer_email varchar(64));
+            INSERT INTO public.customers SELECT v, 'customer_' || v || '@mail.com' FROM generate_series(1, 100) v;
+            INSERT INTO public.orders
+            SELECT v, 'customer_' || (v % 100 + 1) || '@mail.com' FROM generate_series(1, 5000) v;
+            CREATE TABLE public.accounts (id bigint PRIMARY KEY, login text UNIQUE);
+            CREATE TABLE public.profiles (id bigint PRIMARY KEY, login text UNIQUE);
+            INSERT INTO public.accounts SELECT v, 'login_' || v FROM generate_series(1, 100) v;
+            INSERT INTO public.profiles SELECT v, 'login_' || v FROM generate_series(1, 100) v;
+            ANALYZE public.customers, public.orders, public.accounts, public.profiles;
+            """
+        )
+        await db_conn.close()
 
-        parser = Context.get_arg_parser()
-        args = parser.parse_args(
+        res = await MainRoutine(self.get_db_args(self.source_db, ["--mode=init"])).run()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("init_domains_env")
+
+    async def test_02_dump(self):
+        self.assertTrue("init_domains_env" in passed_stages)
+
+        args = self.get_db_args(
+            self.source_db,
             [
-                f"--db-host={params.test_db_host}",
-                f"--db-name={params.test_source_db}",
-                f"--db-user={params.test_db_user}",
-                f"--db-port={params.test_db_port}",
-                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={self.get_test_dict_path('test_domains.py')}",
+                f"--output-dir={self.get_test_output_path('test_domains')}",
                 f"--threads={params.test_threads}",
-                "--mode=sync-data-dump",
-                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
-                f"--output-dir={output_dir}",
-                "--verbose=debug",
                 "--clear-output-dir",
+                "--verbose=debug",
                 "--debug",
             ]
         )
-
         res = await MainRoutine(args).run()
         self.assertEqual(res.result_code, ResultCode.DONE)
 
-        args = parser.parse_args(
+        # mapping tables are dropped after dump
+        db_conn = await asyncpg.connect(**Context(self.get_db_args(self.source_db)).conn_params)
+        domain_tables_count = await db_conn.fetchval(
+            "SELECT count(1) FROM pg_tables WHERE schemaname = 'anon_funcs' AND tablename LIKE 'domain_%'"
+        )
+        await db_conn.close()
+        self.assertEqual(domain_tables_count, 0)
+        passed_stages.append("test_02_domains_dump")
+
+    async def test_03_restore(self):
+        self.assertTrue("test_02_domains_dump" in passed_stages)
+
+        args = self.get_db_args(
+            self.target_db,
             [
-                f"--db-host={params.test_db_host}",
-                f"--db-name={params.test_target_db}_3",  # here target DB have 3 empty tables
-                f"--db-user={params.test_db_user}",
-                f"--db-port={params.test_db_port}",
-                f"--db-user-password={params.test_db_user_password}",
+                "--mode=restore",
+                f"--input-dir={self.get_test_output_path('test_domains')}",
                 f"--threads={params.test_threads}",
-                "--mode=sync-data-restore",
-                f"--input-dir={output_dir}",
                 "--verbose=debug",
                 "--debug",
             ]
         )
-
         res = await MainRoutine(args).run()
         self.assertEqual(res.result_code, ResultCode.DONE)
 
-        self.assertTrue(
-            await self.check_list_tables(
-                args,
-                [  # TODO: get list tables from specific dict
-                    ["schm_other_2", "exclude_tbl"],
-                    ["schm_other_2", "some_tbl"],
-                    ["schm_mask_include_1", "tbl_123"],
-                ],
-            )
+        # random rule of domain is calculated once per value, so anonymized values are still joinable
+        db_conn = await asyncpg.connect(**Context(self.get_db_args(self.target_db)).conn_params)
+        joined_rows = await db_conn.fetchval(
+            "SELECT count(1) FROM public.orders o JOIN public.customers c ON c.email = o.customer_email"
         )
+        distinct_emails = await db_conn.fetchval("SELECT count(DISTINCT email) FROM public.customers")
+        source_emails = await db_conn.fetchval(
+            "SELECT count(1) FROM public.customers WHERE email NOT LIKE '%@domain.com'"
+        )
+        # unique values in several fields get mapping table too, so random rule gives the same value in both tables
+        joined_logins = await db_conn.fetchval(
+            "SELECT count(1) FROM public.accounts a JOIN public.profiles p ON p.login = a.login"
+        )
+        await db_conn.close()
+        self.assertEqual(joined_rows, 5000)
+        self.assertEqual(joined_logins, 100)
+        self.assertEqual(distinct_emails, 100)
+        self.assertEqual(source_emails, 0)
 
-        objs = [
-            ["schm_other_2", "exclude_tbl", rows_in_init_env * int(params.test_scale)],
-            ["schm_other_2", "some_tbl", rows_in_init_env * int(params.test_scale)],
-            [
-                "schm_mask_include_1",
-                "tbl_123",
-                rows_in_init_env * int(params.test_scale),
-            ],
-        ]
-        self.assertTrue(await self.check_rows_count(args, objs))
+    async def test_04_query_hash_with_domains(self):
+        # mapping tables have the same names in all runs, so files made with mappings of another run are not reused
+        query = 'SELECT "email" FROM "public"."customers" LEFT JOIN (SELECT value, anon FROM anon_funcs."domain_1")'
+        self.assertEqual(get_query_hash(query, None, "run_1"), get_query_hash(query, None, "run_1"))
+        self.assertNotEqual(get_query_hash(query, None, "run_1"), get_query_hash(query, None, "run_2"))
+        self.assertNotEqual(get_query_hash(query, None, "run_1"), get_query_hash(query))
 
-        rows = [[3, "t***l_3"], [4, "t***l_4"]]
-        self.assertTrue(
-            await self.check_rows(args, "schm_mask_include_1", "tbl_123", None, rows)
+
+class PGAnonSubsetUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    source_db = params.test_source_db + "_subset"
+    target_db = params.test_target_db + "_subset"
+
+    async def test_01_init(self):
+        db_conn = await asyncpg.connect(**Context(self.get_db_args("postgres")).conn_params)
+        await DBOperations.init_db(db_conn, self.source_db)
+        await DBOperations.init_db(db_conn, self.target_db)
+        await db_conn.close()
+
+        db_conn = await asyncpg.connect(**Context(self.get_db_args(self.source_db)).conn_params)
+        await db_conn.execute(
+            """
+            CREATE TABLE public.customers (id bigint PRIMARY KEY, email text);
+            CREATE TABLE public.orders (id bigint PRIMARY KEY, customer_id bigint REFERENCES public.customers(id));
+            CREATE TABLE public.payments (id bigint PRIMARY KEY, order_id bigint REFERENCES public.orders(id));
+            CREATE TABLE public.employees (id bigint PRIMARY KEY, manager_id bigint REFERENCES public.employees(id));
+            CREATE TABLE public.settings (name text PRIMARY KEY, value text);
+            INSERT INTO public.customers SELECT v, 'customer_' || v || '@mail.com' FROM generate_series(1, 1000) v;
+            INSERT INTO public.orders SELECT v, v % 1000 + 1 FROM generate_series(1, 5000) v;
+            INSERT INTO public.payments SELECT v, CASE WHEN v > 100 THEN v - 100 END FROM generate_series(1, 5100) v;
+            INSERT INTO public.employees SELECT v, CASE WHEN v > 1 THEN v / 2 END FROM generate_series(1, 100) v;
+            INSERT INTO public.settings SELECT 'name_' || v, 'value_' || v FROM generate_series(1, 10) v;
+            CREATE TABLE public.d_top (id bigint PRIMARY KEY);
+            CREATE TABLE public.d_left (id bigint PRIMARY KEY, top_id bigint REFERENCES public.d_top(id));
+            CREATE TABLE public.d_right (id bigint PRIMARY KEY, top_id bigint REFERENCES public.d_top(id));
+            CREATE TABLE public.d_bottom (
+                id bigint PRIMARY KEY,
+                left_id bigint REFERENCES public.d_left(id),
+                right_id bigint REFERENCES public.d_right(id)
+            );
+            INSERT INTO public.d_top SELECT v FROM generate_series(1, 100) v;
+            INSERT INTO public.d_left SELECT v, v FROM generate_series(1, 100) v;
+            INSERT INTO public.d_right SELECT v, 101 - v FROM generate_series(1, 100) v;
+            INSERT INTO public.d_bottom SELECT v, v % 100 + 1, v % 100 + 1 FROM generate_series(1, 1000) v;
+            """
         )
+        await db_conn.close()
 
+        res = await MainRoutine(self.get_db_args(self.source_db, ["--mode=init"])).run()
         self.assertEqual(res.result_code, ResultCode.DONE)
-        passed_stages.append("test_07_sync_data")
-
-    async def test_08_sync_data(self):
-        # --mode=sync-data-dump ---> --mode=sync-data-restore [target DB is not empty]
-        self.assertTrue("test_07_sync_data" in passed_stages)
+        passed_stages.append("init_subset_env")
 
-        prepared_sens_dict_file = self.get_test_dict_path("test_sync_data_2.py")
-        dict_file_name = get_file_name_from_path(prepared_sens_dict_file)
-        output_dir = self.get_test_output_path(dict_file_name)
+    async def test_02_dump(self):
+        self.assertTrue("init_subset_env" in passed_stages)
 
-        parser = Context.get_arg_parser()
-        args = parser.parse_args(
+        args = self.get_db_args(
+            self.source_db,
             [
-                f"--db-host={params.test_db_host}",
-                f"--db-name={params.test_source_db}",
-                f"--db-user={params.test_db_user}",
-                f"--db-port={params.test_db_port}",
-                f"--db-user-password={params.test_db_user_password}",
+                "--mode=dump",
+                f"--prepared-sens-dict-file={self.get_test_dict_path('test_subset.py')}",
+                f"--output-dir={self.get_test_output_path('test_subset')}",
                 f"--threads={params.test_threads}",
-                "--mode=sync-data-dump",
-                f"--prepared-sens-dict-file={prepared_sens_dict_file}",
-                f"--output-dir={output_dir}",
-                "--verbose=debug",
                 "--clear-output-dir",
+                "--verbose=debug",
                 "--debug",
             ]
         )
-
         res = await MainRoutine(args).run()
         self.assertEqual(res.result_code, ResultCode.DONE)
+        passed_stages.append("test_02_subset_dump")
 
-        args = parser.parse_args(
+    async def test_03_restore(self):
+        self.assertTrue("test_02_subset_dump" in passed_stages)
+
+        args = self.get_db_args(
+            self.target_db,
             [
-                f"--db-host={params.test_db_host}",
-                f"--db-name={params.test_target_db}",  # here target DB is NOT empty
-                f"--db-user={params.test_db_user}",
-                f"--db-port={params.test_db_port}",
-                f"--db-user-password={params.test_db_user_password}",
+                "--mode=restore",
+                f"--input-dir={self.get_test_output_path('test_subset')}",
                 f"--threads={params.test_threads}",
-                "--mode=sync-data-restore",  # just sync data of specific tables from test_sync_data_2.py
-                f"--input-dir={output_dir}",
                 "--verbose=debug",
                 "--debug",
             ]
         )
-
-        ctx = Context(args)
-        db_conn = await asyncpg.connect(**ctx.conn_params)
-        # pg_anon does not clear tables on its own
-        await db_conn.execute("TRUNCATE TABLE schm_other_1.some_tbl")  # manual clean
-        await db_conn.execute("TRUNCATE TABLE schm_other_2.some_tbl")
-        await db_conn.close()
-
+        # foreign keys are created after data, so restore fails if subset is not consistent
         res = await MainRoutine(args).run()
         self.assertEqual(res.result_code, ResultCode.DONE)
 
-        objs = [
-            ["schm_other_1", "some_tbl", rows_in_init_env * int(params.test_scale)],
-            ["schm_other_2", "some_tbl", rows_in_init_env * int(params.test_scale)],
-        ]
-        self.assertTrue(await self.check_rows_count(args, objs))
+        db_conn = await asyncpg.connect(**Context(self.get_db_args(self.target_db)).conn_params)
+        tables_rows = {
+            table: await db_conn.fetchval(f"SELECT count(1) FROM public.{table}")
+            for table in (
+                "customers", "orders", "payments", "employees", "settings", "d_top", "d_left", "d_right", "d_bottom"
+            )
+        }
+        referenced_customers = await db_conn.fetchval("SELECT count(DISTINCT customer_id) FROM public.orders")
+        await db_conn.close()
 
-        self.assertEqual(res.result_code, ResultCode.DONE)
-        passed_stages.append("test_08_sync_data")
+        self.assertTrue(0 < tables_rows["orders"] < 5000)
+        self.assertEqual(tables_rows["customers"], referenced_customers)
+        # payments of dumped orders (one per order) and payments without order
+        self.assertEqual(tables_rows["payments"], tables_rows["orders"] + 100)
+        # employees with id <= 10 and their managers up to the root (id / 2), which are all in 1..10
+        self.assertEqual(tables_rows["employees"], 10)
+        # table without subset rule is dumped as is
+        self.assertEqual(tables_rows["settings"], 10)
+        # diamond of foreign keys: d_top rows are referenced by 10 rows of d_left (2..11) and d_right (90..99)
+        self.assertEqual(
+            [tables_rows[table] for table in ("d_top", "d_left", "d_right", "d_bottom")], [20, 10, 10, 10]
+        )
+
+        with open(os.path.join(self.get_test_output_path("test_subset"), "metadata.json"), "r") as metadata_file:
+            metadata = json.load(metadata_file)
+        metadata_rows = {v["table"]: int(v["rows"]) for v in metadata["files"].values() if v["schema"] == "public"}
+        self.assertEqual(metadata_rows, tables_rows)
+
+    async def test_04_subset_condition_of_diamonds(self):
+        def get_subset_of_layers(depth):
+            # two tables in each layer, each of them references both tables of the previous layer
+            references = {}
+            foreign_keys = {}
+            for layer in range(1, depth + 1):
+                for child in range(2):
+                    for parent in range(2):
+                        fk = {
+                            "child_schema": "public",
+                            "child_table": f"t{layer}_{child}",
+                            "parent_schema": "public",
+                            "parent_table": f"t{layer - 1}_{parent}",
+                            "child_columns": [f"t{layer - 1}_{parent}_id"],
+                            "parent_columns": ["id"],
+                        }
+                        references.setdefault(("public", fk["parent_table"]), []).append(fk)
+                        foreign_keys.setdefault(("public", fk["child_table"]), []).append(fk)
+            tables = {("public", f"t{layer}_{i}") for layer in range(depth + 1) for i in range(2)}
+            return SubsetGraph(
+                rules={("public", f"t{depth}_0"): {"sample": 0.1}},
+                restricted=tables,
+                filtered=set(),
+                references=references,
+                foreign_keys=foreign_keys,
+                cycles={},
+            )
+
+        conditions = {
+            depth: get_subset_condition(get_subset_of_layers(depth), ("public", "t0_0"), '"public"."t0_0"')
+            for depth in (4, 8)
+        }
+        # rows of each table are selected once for each child of dumped table, and condition grows linearly
+        self.assertLessEqual(conditions[8].count('"public"."t8_0" AS'), 2)
+        self.assertLess(len(conditions[8]), 3 * len(conditions[4]))
+        self.assertEqual(conditions[8].count("TABLESAMPLE SYSTEM (10.0) REPEATABLE (0)"), 2)
 
 
 class PGAnonValidateUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
@@ -983,6 +2461,11 @@ class PGAnonValidateUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
         self.assertEqual(res.result_code, ResultCode.DONE)
         passed_stages.append("test_03_validate_dict")
 
+        # queries are only planned, so all invalid rules are reported and the data is not read
+        args.prepared_sens_dict_files = [self.get_test_dict_path("test_dbg_stage_1_invalid.py")]
+        res = await MainRoutine(args).run()
+        self.assertEqual(res.result_code, ResultCode.FAIL)
+
     async def test_04_validate_data(self):
         self.assertTrue("test_03_validate_dict" in passed_stages)
 
@@ -1627,6 +3110,101 @@ class PGAnonDictGenStressUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTes
         )
 
 
+class PGAnonCodecsBenchmarkUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
+    """
+    Compares output codecs by dump and restore of the stress environment.
+    For meaningful results scale the stress environment up, for example: TEST_SCALE=100
+    """
+    codecs = ["gzip", "zstd", "lz4", "none"]
+
+    @staticmethod
+    def get_available_codecs():
+        # zstd and lz4 are optional extras ("codecs"), the benchmark runs only installed ones
+        available_codecs = []
+        for codec in PGAnonCodecsBenchmarkUnitTest.codecs:
+            try:
+                check_codec_available(OutputCodec(codec))
+            except ImportError:
+                continue
+            available_codecs.append(codec)
+        return available_codecs
+
+    async def test_01_stress_init(self):
+        res = await self.init_stress_env()
+        self.assertEqual(res.result_code, ResultCode.DONE)
+
+    async def test_02_codecs_benchmark(self):
+        self.assertTrue("init_stress_env" in passed_stages)
+        codecs = self.get_available_codecs()
+        skipped_codecs = set(self.codecs) - set(codecs)
+        if skipped_codecs:
+            print(f"Codecs {', '.join(sorted(skipped_codecs))} are not installed and skipped")
+
+        prepared_sens_dict_file = self.get_test_dict_path("test_empty_dictionary.py")
+        parser = Context.get_arg_parser()
+
+        args = parser.parse_args(
+            [
+                f"--db-host={params.test_db_host}",
+                "--db-name=postgres",
+                f"--db-user={params.test_db_user}",
+                f"--db-port={params.test_db_port}",
+                f"--db-user-password={params.test_db_user_password}",
+            ]
+        )
+        db_conn = await asyncpg.connect(**Context(args).conn_params)
+        for codec in codecs:
+            await DBOperations.init_db(db_conn, f"{params.test_target_db}_codec_{codec}")
+        await db_conn.close()
+
+        results = []
+        for codec in codecs:
+            output_dir = self.get_test_output_path(f"stress_codec_{codec}")
+            args = parser.parse_args(
+                [
+                    f"--db-host={params.test_db_host}",
+                    f"--db-name={params.test_source_db}_stress",
+                    f"--db-user={params.test_db_user}",
+                    f"--db-port={params.test_db_port}",
+                    f"--db-user-password={params.test_db_user_password}",
+                    "--mode=dump",
+                    f"--prepared-sens-dict-file={prepared_sens_dict_file}",
+                    f"--output-dir={output_dir}",
+                    f"--output-codec={codec}",
+                    f"--threads={params.test_threads}",
+                    "--clear-output-dir",
+                ]
+            )
+            res_dump = await MainRoutine(args).run()
+            self.assertEqual(res_dump.result_code, ResultCode.DONE)
+
+            files_size = 0
+            for file_name in os.listdir(output_dir):
+                if ".bin" in file_name:
+                    files_size += os.path.getsize(os.path.join(output_dir, file_name))
+
+            args = parser.parse_args(
+                [
+                    f"--db-host={params.test_db_host}",
+                    f"--db-name={params.test_target_db}_codec_{codec}",
+                    f"--db-user={params.test_db_user}",
+                    f"--db-port={params.test_db_port}",
+                    f"--db-user-password={params.test_db_user_password}",
+                    "--mode=restore",
+                    f"--input-dir={output_dir}",
+                    f"--threads={params.test_threads}",
+                ]
+            )
+            res_restore = await MainRoutine(args).run()
+            self.assertEqual(res_restore.result_code, ResultCode.DONE)
+
+            results.append([codec, res_dump.elapsed, res_restore.elapsed, files_size])
+
+        print("%-6s %12s %15s %15s" % ("codec", "dump [sec]", "restore [sec]", "size [bytes]"))
+        for codec, dump_elapsed, restore_elapsed, files_size in results:
+            print("%-6s %12s %15s %15s" % (codec, dump_elapsed, restore_elapsed, files_size))
+
+
 class PGAnonMaskUnitTest(unittest.IsolatedAsyncioTestCase, BasicUnitTest):
     args = {}
 